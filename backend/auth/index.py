@@ -7,42 +7,1118 @@ Returns: HTTP response dict with JWT token or error
 
 import json
 import os
+import re
 import hashlib
-import secrets
+import threading
+import hmac
+from time import perf_counter
+import time
+import math
+import random
 import jwt
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Tuple, Callable
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 
 # JWT secret key
 JWT_SECRET = os.environ.get('JWT_SECRET', 'labubu-finance-secret-key-2024')
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_HOURS = 24 * 30  # 30 days
+# Identifier claims in tokens: cid - card id, rc - referral code. Bump the
+# version when their meaning changes; functions then fall back to the database
+TOKEN_CLAIMS_VERSION = 1
 
-def get_db_connection():
-    '''Get database connection using DATABASE_URL'''
+# Responses that do not depend on the request, built once per instance
+CORS_PREFLIGHT_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': ''
+}
+JSON_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*'
+}
+AUTH_REQUIRED_BODY = json.dumps({'error': 'Требуется авторизация'})
+INVALID_TOKEN_BODY = json.dumps({'error': 'Недействительный токен'})
+
+# Open the database connection at import time instead of on the first request
+DB_PREWARM = os.environ.get('DB_PREWARM') == '1'
+
+# Retries for the rare referral code collision on registration
+REFERRAL_CODE_ATTEMPTS = 5
+
+# Token buckets for login/registration: (capacity, refill tokens per second)
+RATE_LIMIT_EMAIL = (5, 5 / 60)
+RATE_LIMIT_IP = (30, 30 / 60)
+RATE_LIMIT_GLOBAL = (500, 200)
+RATE_LIMIT_WINDOW_SECONDS = 60  # shared counter window
+RATE_LIMIT_SYNC_SECONDS = 5  # how often local hits are pushed to the shared store
+RATE_LIMIT_MAX_KEYS = 100000  # in-process buckets kept before LRU eviction
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'postgres')  # 'postgres' or 'local'
+# Proxies in front of the function that append to X-Forwarded-For. 0: the header is
+# client-controlled and ignored, the platform's source IP is used
+RATE_LIMIT_TRUSTED_PROXY_HOPS = int(os.environ.get('RATE_LIMIT_TRUSTED_PROXY_HOPS', '0'))
+
+# Per-request phase timings: Server-Timing header, log line and per-action histograms.
+# This and every other block closed by an '# End of the shared ... block' line
+# is identical in auth, card, loans and referrals; edit all four (scripts/test_shared_blocks.py).
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_timing_local = threading.local()
+_latency_histograms: Dict[str, List[float]] = {}
+_histograms_lock = threading.Lock()
+
+def record_phase(name: str, started: float) -> None:
+    '''Add the time since started to a phase of the current request'''
+    phases = getattr(_timing_local, 'phases', None)
+    if phases is not None:
+        entry = phases.get(name)
+        if entry is None:
+            phases[name] = [perf_counter() - started, 1]
+        else:
+            entry[0] += perf_counter() - started
+            entry[1] += 1
+
+def observe_latency(action: str, seconds: float) -> None:
+    '''Count a request in its action's latency histogram'''
+    ms = seconds * 1000
+    index = len(LATENCY_BUCKETS_MS)
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if ms <= bound:
+            index = i
+            break
+    with _histograms_lock:
+        histogram = _latency_histograms.get(action)
+        if histogram is None:
+            # bucket counts, then +Inf bucket, request count and total ms
+            histogram = _latency_histograms[action] = [0] * (len(LATENCY_BUCKETS_MS) + 3)
+        histogram[index] += 1
+        histogram[-2] += 1
+        histogram[-1] += ms
+
+def latency_report() -> Dict[str, Any]:
+    '''Histograms with approximate percentiles (bucket upper bounds) per action'''
+    bounds = [str(b) for b in LATENCY_BUCKETS_MS] + ['+Inf']
+    report = {}
+    with _histograms_lock:
+        snapshot = {action: list(h) for action, h in _latency_histograms.items()}
+    for action, histogram in snapshot.items():
+        count = histogram[-2]
+        percentiles = {}
+        for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            seen = 0
+            for bound, bucket in zip(bounds, histogram):
+                seen += bucket
+                if seen >= q * count:
+                    percentiles[name] = bound
+                    break
+        report[action] = {
+            'count': count,
+            'mean_ms': round(histogram[-1] / count, 3),
+            'buckets_ms': dict(zip(bounds, histogram[:len(bounds)])),
+            **percentiles
+        }
+    return report
+
+def encode_json(data: Any) -> str:
+    '''Serialize response body, timed as the encode phase'''
+    started = perf_counter()
+    body = json.dumps(data)
+    record_phase('encode', started)
+    return body
+
+# SQL fingerprints: per normalized statement call count, total/max latency and rows
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+FINGERPRINT_CACHE_SIZE = 1000
+QUERY_REPORT_TOP = 20  # fingerprints in ?admin=queries by default
+QUERY_REPORT_MAX_TOP = 200
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s|\$\d+")
+_SQL_IN_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_fingerprints: Dict[str, str] = {}
+_query_stats: Dict[str, List[float]] = {}
+_query_stats_lock = threading.Lock()
+
+def fingerprint_sql(query: str) -> str:
+    '''Normalize a statement: literals and placeholders become ?, whitespace is collapsed'''
+    fingerprint = _fingerprints.get(query)
+    if fingerprint is None:
+        fingerprint = _SQL_IN_LISTS.sub('(?)', _SQL_LITERALS.sub('?', ' '.join(query.split())))
+        if len(_fingerprints) >= FINGERPRINT_CACHE_SIZE:
+            _fingerprints.clear()
+        _fingerprints[query] = fingerprint
+    return fingerprint
+
+def redact_params(vars: Any) -> Any:
+    '''Replace parameter values with their types for logging'''
+    if vars is None:
+        return None
+    if isinstance(vars, dict):
+        return {key: type(value).__name__ for key, value in vars.items()}
+    return [type(value).__name__ for value in vars]
+
+def query_report(top: int) -> List[Dict[str, Any]]:
+    '''Fingerprints of this instance ordered by total time'''
+    with _query_stats_lock:
+        snapshot = [(fingerprint, list(stats)) for fingerprint, stats in _query_stats.items()]
+    snapshot.sort(key=lambda item: -item[1][1])
+    return [{
+        'fingerprint': fingerprint,
+        'calls': int(stats[0]),
+        'total_ms': round(stats[1] * 1000, 3),
+        'mean_ms': round(stats[1] * 1000 / stats[0], 3),
+        'max_ms': round(stats[2] * 1000, 3),
+        'rows': int(stats[3])
+    } for fingerprint, stats in snapshot[:top]]
+
+class InstrumentedCursor(RealDictCursor):
+    '''
+    RealDictCursor that adds every execute to the db phase of the current
+    request, aggregates it under its SQL fingerprint and logs slow statements
+    '''
+    
+    def execute(self, query, vars=None):
+        started = perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except psycopg2.OperationalError:
+            # Lost connections and statement timeouts both count against the database
+            self.connection.breaker.failure()
+            raise
+        except psycopg2.Error:
+            # Constraint, data and syntax errors are answers: the database is up
+            self.connection.breaker.success()
+            raise
+        else:
+            self.connection.breaker.success()
+            return result
+        finally:
+            elapsed = perf_counter() - started
+            record_phase('db', started)
+            fingerprint = fingerprint_sql(query)
+            rows = max(self.rowcount, 0)
+            with _query_stats_lock:
+                stats = _query_stats.get(fingerprint)
+                if stats is None:
+                    _query_stats[fingerprint] = [1, elapsed, elapsed, rows]
+                else:
+                    stats[0] += 1
+                    stats[1] += elapsed
+                    stats[3] += rows
+                    if elapsed > stats[2]:
+                        stats[2] = elapsed
+            if elapsed * 1000 >= SLOW_QUERY_MS:
+                print(json.dumps({
+                    'event': 'slow_query',
+                    'request_id': getattr(_timing_local, 'request_id', None),
+                    'fingerprint': fingerprint,
+                    'ms': round(elapsed * 1000, 3),
+                    'rows': rows,
+                    'params': redact_params(vars)
+                }))
+# End of the shared instrumentation block
+
+# Slower actions of this function; the rest run under DEFAULT_STATEMENT_TIMEOUT_MS
+STATEMENT_TIMEOUTS_MS = {'register': 3000, 'login': 1500, 'profile': 1000}
+
+# Fail fast while the database is slow or down instead of piling requests up
+DB_CONNECT_TIMEOUT_SECONDS = int(os.environ.get('DB_CONNECT_TIMEOUT_SECONDS', '2'))
+DEFAULT_STATEMENT_TIMEOUT_MS = 3000
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN_SECONDS = 10
+# A probe that reports nothing within its connect and statement timeouts is presumed lost
+BREAKER_PROBE_TIMEOUT_SECONDS = DB_CONNECT_TIMEOUT_SECONDS + max(DEFAULT_STATEMENT_TIMEOUT_MS, *STATEMENT_TIMEOUTS_MS.values()) / 1000
+DB_UNAVAILABLE_BODY = json.dumps({'error': 'Сервис временно недоступен, попробуйте позже', 'code': 'DB_UNAVAILABLE'})
+
+class DatabaseUnavailable(Exception):
+    '''Raised instead of connecting while the circuit breaker is open'''
+    
+    def __init__(self, retry_after: float):
+        super().__init__('Database unavailable')
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    '''
+    Closed: requests pass, consecutive failures are counted.
+    Open: requests are rejected until the cooldown ends.
+    Half-open: a single probe request passes; its outcome closes or reopens the breaker.
+    A probe that ends without an outcome frees the slot (release_probe), and
+    one still silent after probe_timeout is replaced by the next request.
+    '''
+    
+    def __init__(self, threshold: int, cooldown: float, probe_timeout: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_owner: Optional[int] = None
+        self.probe_started = 0.0
+        self.lock = threading.Lock()
+    
+    def check(self) -> None:
+        '''Raise DatabaseUnavailable unless a request may use the database now'''
+        if self.state == 'closed':
+            return
+        with self.lock:
+            now = time.monotonic()
+            if self.state == 'open':
+                remaining = self.opened_at + self.cooldown - now
+                if remaining > 0:
+                    raise DatabaseUnavailable(remaining)
+            elif self.probe_owner == threading.get_ident():
+                # The probe opening another connection to the same database
+                return
+            elif now - self.probe_started < self.probe_timeout:
+                # A probe is already in flight
+                raise DatabaseUnavailable(self.probe_started + self.probe_timeout - now)
+            self.state = 'half-open'
+            self.probe_owner = threading.get_ident()
+            self.probe_started = now
+    
+    def success(self) -> None:
+        if self.state == 'closed' and not self.failures:
+            return
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.probe_owner = None
+    
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.probe_owner = None
+    
+    def release_probe(self) -> None:
+        '''End of a request: a probe it held without an outcome lets the next request probe at once'''
+        if self.probe_owner != threading.get_ident():
+            return
+        with self.lock:
+            if self.state == 'half-open' and self.probe_owner == threading.get_ident():
+                self.state = 'open'
+                self.opened_at = time.monotonic() - self.cooldown
+                self.probe_owner = None
+
+def db_unavailable_response(retry_after: float) -> Dict[str, Any]:
+    return {
+        'statusCode': 503,
+        'headers': {**JSON_HEADERS, 'Retry-After': str(max(1, math.ceil(retry_after)))},
+        'body': DB_UNAVAILABLE_BODY
+    }
+
+# User-id sharding: DATABASE_SHARDS is a JSON list of shard DSNs; unset means a
+# single database at DATABASE_URL. Users are routed by bucket (user_id % SHARD_BUCKETS)
+# through the shard_buckets map, and emails, referral codes and user ids are
+# allocated in the directory database (DATABASE_DIRECTORY_URL, default the first shard)
+DATABASE_SHARDS: List[str] = json.loads(os.environ.get('DATABASE_SHARDS') or '[]')
+SHARD_BUCKETS = 1024
+SHARD_MAP_TTL_SECONDS = 30
+
+def shard_urls() -> List[str]:
+    '''DSN of every shard; just DATABASE_URL when sharding is off'''
+    if DATABASE_SHARDS:
+        return DATABASE_SHARDS
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
         raise Exception('DATABASE_URL not found in environment')
-    return psycopg2.connect(database_url, cursor_factory=RealDictCursor)
+    return [database_url]
+
+def directory_url() -> str:
+    return os.environ.get('DATABASE_DIRECTORY_URL') or shard_urls()[0]
+
+class ShardMap:
+    '''
+    Bucket to shard routing, loaded from the directory's shard_buckets and
+    cached for SHARD_MAP_TTL_SECONDS. Buckets without a row live on shard 0;
+    buckets being moved by scripts/shard_rebalance.py are frozen and their
+    users get 503 until the move switches them to the new shard.
+    '''
+    
+    def __init__(self):
+        self.buckets: Optional[List[Optional[int]]] = None
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+    
+    def shard_for(self, user_id: int) -> int:
+        if not DATABASE_SHARDS:
+            return 0
+        if self.buckets is None or time.monotonic() - self.loaded_at > SHARD_MAP_TTL_SECONDS:
+            with self.lock:
+                if self.buckets is None or time.monotonic() - self.loaded_at > SHARD_MAP_TTL_SECONDS:
+                    self.buckets = self.load()
+                    self.loaded_at = time.monotonic()
+        shard = self.buckets[user_id % SHARD_BUCKETS]
+        if shard is None:
+            raise DatabaseUnavailable(SHARD_MAP_TTL_SECONDS)
+        return shard
+    
+    def load(self) -> List[Optional[int]]:
+        buckets: List[Optional[int]] = [0] * SHARD_BUCKETS
+        conn = get_directory_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT bucket, shard, moving FROM shard_buckets")
+        for row in cur.fetchall():
+            buckets[row['bucket']] = None if row['moving'] else row['shard']
+        cur.close()
+        release_db_connection(conn)
+        return buckets
+
+shard_map = ShardMap()
+
+class BreakerConnection(psycopg2.extensions.connection):
+    '''Connection carrying the circuit breaker of the database it points at'''
+    breaker: CircuitBreaker
+
+# Connections are per thread, so prewarm() at import time only warms the
+# importing thread. Every other thread warms lazily: its first connection to a
+# database prepares the hot statements as it opens. The gateway runs prewarm()
+# in each worker thread as it starts.
+_db_local = threading.local()
+db_breakers: Dict[str, CircuitBreaker] = {}
+
+def connect_pooled(database_url: str):
+    '''Get this instance's pooled connection to database_url, reconnecting if it was closed'''
+    started = perf_counter()
+    breaker = db_breakers.get(database_url)
+    if breaker is None:
+        breaker = db_breakers.setdefault(database_url, CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN_SECONDS,
+                                                                      BREAKER_PROBE_TIMEOUT_SECONDS))
+    breaker.check()
+    timeout_ms = STATEMENT_TIMEOUTS_MS.get(getattr(_timing_local, 'action', None), DEFAULT_STATEMENT_TIMEOUT_MS)
+    
+    conns = getattr(_db_local, 'conns', None)
+    if conns is None:
+        conns = _db_local.conns = {}
+        _db_local.statement_timeouts = {}
+    conn = conns.get(database_url)
+    if conn is None or conn.closed:
+        if conn is not None:
+            _prepared.pop(id(conn), None)
+        try:
+            conn = psycopg2.connect(
+                database_url,
+                connection_factory=BreakerConnection,
+                cursor_factory=InstrumentedCursor,
+                connect_timeout=DB_CONNECT_TIMEOUT_SECONDS,
+                options=f'-c statement_timeout={timeout_ms}'
+            )
+        except psycopg2.OperationalError:
+            breaker.failure()
+            raise
+        conn.breaker = breaker
+        conns[database_url] = conn
+        _db_local.statement_timeouts[database_url] = timeout_ms
+        prepare_statements(conn)
+    elif conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+    
+    # Only pay for a SET when the action's timeout differs from the session's
+    if _db_local.statement_timeouts[database_url] != timeout_ms:
+        cur = conn.cursor()
+        cur.execute("SET statement_timeout = %s", (timeout_ms,))
+        cur.close()
+        conn.commit()
+        _db_local.statement_timeouts[database_url] = timeout_ms
+    
+    record_phase('db-acquire', started)
+    return conn
+
+def get_db_connection(user_id: Optional[int] = None):
+    '''Get the pooled connection to the shard owning user_id, or to the directory when user_id is None'''
+    if user_id is None:
+        return get_directory_connection()
+    return connect_pooled(shard_urls()[shard_map.shard_for(user_id)])
+
+def get_shard_connection(shard: int):
+    return connect_pooled(shard_urls()[shard])
+
+def get_directory_connection():
+    return connect_pooled(directory_url())
+
+def release_probes() -> None:
+    '''Free the probe slots this thread holds; runs after every request'''
+    for breaker in list(db_breakers.values()):
+        breaker.release_probe()
+
+def release_db_connection(conn) -> None:
+    '''Return connection to the pool, discarding any unfinished transaction'''
+    if not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+# End of the shared connection pool block
+
+# Hot read-only statements, prepared once per pooled connection and executed by name
+PREPARED_STATEMENTS = {
+    'user_login': """SELECT id, email, name, phone, referral_code,
+                         (SELECT id FROM virtual_cards WHERE user_id = users.id) AS card_id
+                  FROM users WHERE email = $1 AND password_hash = $2""",
+    'user_profile': "SELECT id, email, name, phone, referral_code, created_at FROM users WHERE id = $1"
+}
+
+# Names prepared on each pooled connection, by id(conn), with the server pid they were prepared in
+_prepared: Dict[int, Tuple[int, set]] = {}
+
+def prepared_names(conn) -> set:
+    '''Names already prepared on this connection, reset when the server session changed'''
+    pid = conn.get_backend_pid()
+    entry = _prepared.get(id(conn))
+    if entry is None or entry[0] != pid:
+        entry = (pid, set())
+        _prepared[id(conn)] = entry
+    return entry[1]
+
+def execute_prepared(cur, name: str, params: tuple = ()) -> None:
+    '''Execute a statement from PREPARED_STATEMENTS by name, preparing it on first use per connection'''
+    conn = cur.connection
+    for attempt in range(2):
+        prepared = prepared_names(conn)
+        try:
+            if name not in prepared:
+                cur.execute(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}')
+                prepared.add(name)
+            cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+            return
+        except psycopg2.Error as e:
+            # Registered statements are read-only, so rolling back loses nothing
+            if attempt or e.pgcode not in ('26000', '42P05'):
+                raise
+            conn.rollback()
+            if e.pgcode == '26000':
+                # Statement is gone: the server session was recycled
+                prepared.clear()
+            else:
+                # Already prepared on this session by an earlier owner of the connection
+                prepared.add(name)
+
+def prepare_statements(conn) -> None:
+    '''Prepare the hot statements missing on a connection in one round trip; execute_prepared retries any that fail'''
+    prepared = prepared_names(conn)
+    missing = [name for name in PREPARED_STATEMENTS if name not in prepared]
+    if not missing:
+        return
+    cur = conn.cursor()
+    try:
+        cur.execute('; '.join(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}' for name in missing))
+        conn.commit()
+        prepared.update(missing)
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(json.dumps({'event': 'prepare_failed', 'error': str(e)}))
+    finally:
+        cur.close()
+# End of the shared prepared statements block
+
+def prewarm() -> None:
+    '''Open this thread's pooled shard connections, prepare hot statements and start the background syncs before the first invocation'''
+    try:
+        for shard in range(len(shard_urls())):
+            conn = get_shard_connection(shard)
+            release_db_connection(conn)
+        rate_limiter.start()
+        read_cache.start()
+    except Exception as e:
+        print(json.dumps({'event': 'prewarm_failed', 'error': str(e)}))
+
+class TokenBucket:
+    '''In-process token bucket for one rate limit key'''
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated_at', 'blocked_until')
+    
+    def __init__(self, capacity: float, rate: float, now: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated_at = now
+        self.blocked_until = 0.0
+    
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def retry_after(self, now: float) -> float:
+        '''Seconds until one token is available, 0 if allowed now'''
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class LocalCounterStore:
+    '''In-process stand-in for the shared counter store (single instance, local runs)'''
+    
+    def __init__(self):
+        self.counters: Dict[Tuple[str, int], int] = {}
+    
+    def add(self, hits: Dict[Tuple[str, int], int], expire_before: int) -> Dict[Tuple[str, int], int]:
+        for key in [k for k in self.counters if k[1] < expire_before]:
+            del self.counters[key]
+        for key, count in hits.items():
+            self.counters[key] = self.counters.get(key, 0) + count
+        return {key: self.counters[key] for key in hits}
+
+class PostgresCounterStore:
+    '''Shared fixed-window counters in auth_rate_limits, consistent across instances'''
+    
+    def __init__(self):
+        self.last_cleanup = 0.0
+    
+    def add(self, hits: Dict[Tuple[str, int], int], expire_before: int) -> Dict[Tuple[str, int], int]:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        keys = [key for key, _ in hits]
+        windows = [window for _, window in hits]
+        cur.execute(
+            """INSERT INTO auth_rate_limits (key, window_start, hits)
+               SELECT * FROM unnest(%s::varchar[], %s::bigint[], %s::integer[])
+               ON CONFLICT (key, window_start) DO UPDATE
+               SET hits = auth_rate_limits.hits + EXCLUDED.hits
+               RETURNING key, window_start, hits""",
+            (keys, windows, list(hits.values()))
+        )
+        totals = {(row['key'], row['window_start']): row['hits'] for row in cur.fetchall()}
+        
+        now = time.time()
+        if now - self.last_cleanup > RATE_LIMIT_WINDOW_SECONDS:
+            cur.execute("DELETE FROM auth_rate_limits WHERE window_start < %s", (expire_before,))
+            self.last_cleanup = now
+        
+        conn.commit()
+        cur.close()
+        release_db_connection(conn)
+        return totals
+
+class RateLimiter:
+    '''
+    Token buckets checked in-process (no DB access on the request path), with
+    local hits merged into a shared counter store by a background thread so
+    that limits hold across function instances
+    '''
+    
+    def __init__(self, store):
+        self.store = store
+        self.buckets: 'OrderedDict[str, TokenBucket]' = OrderedDict()
+        self.pending: Dict[Tuple[str, int], int] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+    
+    def _bucket(self, key: str, limit: Tuple[float, float], now: float) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(limit[0], limit[1], now)
+            self.buckets[key] = bucket
+            if len(self.buckets) > RATE_LIMIT_MAX_KEYS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket.refill(now)
+        return bucket
+    
+    def acquire(self, limits: List[Tuple[str, Tuple[float, float]]]) -> float:
+        '''Take one token from every key; return seconds to wait if any key is over limit'''
+        now = time.time()
+        window = int(now // RATE_LIMIT_WINDOW_SECONDS) * RATE_LIMIT_WINDOW_SECONDS
+        with self.lock:
+            buckets = [self._bucket(key, limit, now) for key, limit in limits]
+            retry_after = max(bucket.retry_after(now) for bucket in buckets)
+            if retry_after > 0:
+                return retry_after
+            for (key, _), bucket in zip(limits, buckets):
+                bucket.tokens -= 1
+                self.pending[(key, window)] = self.pending.get((key, window), 0) + 1
+        return 0.0
+    
+    def start(self) -> None:
+        '''Start the background sync with the shared store once per process'''
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='rate-limit-sync', daemon=True)
+                self.thread.start()
+    
+    def run(self) -> None:
+        while True:
+            time.sleep(RATE_LIMIT_SYNC_SECONDS)
+            try:
+                self.sync()
+            except Exception as e:
+                print(json.dumps({'event': 'rate_limit_sync_failed', 'error': str(e)}))
+    
+    def sync(self) -> None:
+        '''Push local hits to the shared store and block keys that are over the shared limit'''
+        now = time.time()
+        with self.lock:
+            if not self.pending:
+                return
+            hits, self.pending = self.pending, {}
+        
+        expire_before = int(now) - 2 * RATE_LIMIT_WINDOW_SECONDS
+        try:
+            totals = self.store.add(hits, expire_before)
+        except Exception as e:
+            # Shared store is best effort: keep admitting on local buckets only
+            print(json.dumps({'event': 'rate_limit_sync_failed', 'error': str(e)}))
+            return
+        
+        with self.lock:
+            for (key, window), total in totals.items():
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    continue
+                window_limit = bucket.capacity + bucket.rate * RATE_LIMIT_WINDOW_SECONDS
+                if total >= window_limit:
+                    bucket.blocked_until = max(bucket.blocked_until, window + RATE_LIMIT_WINDOW_SECONDS)
+
+rate_limiter = RateLimiter(LocalCounterStore() if RATE_LIMIT_STORE == 'local' else PostgresCounterStore())
+
+def get_source_ip(event: Dict[str, Any]) -> str:
+    '''
+    Client IP for rate limiting: the platform's source IP, or with trusted
+    proxies the X-Forwarded-For entry the outermost of them appended.
+    Entries left of it are whatever the client sent.
+    '''
+    if RATE_LIMIT_TRUSTED_PROXY_HOPS > 0:
+        headers = event.get('headers') or {}
+        forwarded = [ip.strip() for ip in (headers.get('X-Forwarded-For') or headers.get('x-forwarded-for') or '').split(',')]
+        if len(forwarded) >= RATE_LIMIT_TRUSTED_PROXY_HOPS and forwarded[-RATE_LIMIT_TRUSTED_PROXY_HOPS]:
+            return forwarded[-RATE_LIMIT_TRUSTED_PROXY_HOPS]
+    return ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp') or 'unknown'
 
 def hash_password(password: str) -> str:
     '''Hash password using SHA-256'''
     return hashlib.sha256(password.encode()).hexdigest()
 
-def generate_token(user_id: int, email: str) -> str:
-    '''Generate JWT token for user'''
+def generate_token(user_id: int, email: str, referral_code: Optional[str] = None, card_id: Optional[int] = None) -> str:
+    '''Generate JWT token for user, with the identifiers other functions would otherwise look up'''
     payload = {
         'user_id': user_id,
         'email': email,
+        'cv': TOKEN_CLAIMS_VERSION,
         'exp': datetime.utcnow() + timedelta(hours=JWT_EXPIRATION_HOURS),
         'iat': datetime.utcnow()
     }
+    if referral_code:
+        payload['rc'] = referral_code
+    if card_id:
+        payload['cid'] = card_id
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+# Read-through cache for per-user reads that rarely change, keyed by (user_id, resource).
+# Shared block: identical in auth, card, loans and referrals so the gateway can
+# share one instance; edit all four (scripts/test_shared_blocks.py compares them).
+# CACHE_STORE: 'local' (this process), 'sqlite' (a file shared by the function
+# processes of one host) or 'off'. Either way every process drops entries on the
+# NOTIFY user_changes sent by the write triggers (V0008, V0013), so a write made
+# by any function or instance reaches every cache.
+CACHE_STORE = os.environ.get('CACHE_STORE', 'local')
+CACHE_SQLITE_PATH = os.environ.get('CACHE_SQLITE_PATH', '/tmp/labubu-read-cache.sqlite3')
+CACHE_TTL_SECONDS = {'profile': 300, 'card': 30, 'loan_stats': 60, 'referral_stats': 60}
+CACHE_MAX_ENTRIES = 10000  # entries kept before LRU eviction
+CACHE_TOMBSTONE_SECONDS = 60  # invalidations remembered so loads started before them are not stored
+CACHE_STALE_SAMPLE_RATE = float(os.environ.get('CACHE_STALE_SAMPLE_RATE', '0.01'))  # hits re-read to measure staleness
+CACHE_COUNTERS = ('hits', 'misses', 'coalesced', 'bypassed', 'sampled', 'stale', 'invalidations')
+CACHE_NOTIFY_CHANNEL = 'user_changes'
+# Resource in a change notification -> cached resources it makes stale (profiles are never updated)
+CACHE_NOTIFY_RESOURCES = {'card': ('card',), 'loans': ('loan_stats',), 'referrals': ('referral_stats',)}
+CACHE_LISTEN_RETRY_SECONDS = 5
+
+class LocalCacheStore:
+    '''In-process LRU of JSON-encoded values with expiry and invalidation tombstones'''
+    
+    def __init__(self):
+        self.entries: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+        self.invalidated: Dict[str, float] = {}
+        self.cleared_at = 0.0
+        self.lock = threading.Lock()
+    
+    def get(self, key: str, now: float) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+    
+    def set(self, key: str, value: str, loaded_from: float, expires_at: float) -> None:
+        '''Store value unless the key was invalidated after the load that produced it started'''
+        with self.lock:
+            if max(self.invalidated.get(key, 0), self.cleared_at) >= loaded_from:
+                return
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            if len(self.entries) > CACHE_MAX_ENTRIES:
+                self.entries.popitem(last=False)
+    
+    def invalidate(self, keys: List[str], now: float) -> None:
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+                self.invalidated[key] = now
+            if len(self.invalidated) > CACHE_MAX_ENTRIES:
+                expire_before = now - CACHE_TOMBSTONE_SECONDS
+                for key in [k for k, at in self.invalidated.items() if at < expire_before]:
+                    del self.invalidated[key]
+    
+    def clear(self, now: float) -> None:
+        '''Drop every entry and refuse loads started before now'''
+        with self.lock:
+            self.entries.clear()
+            self.cleared_at = now
+
+class SqliteCacheStore:
+    '''Cache table in a SQLite file, shared by the function processes of one host'''
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        self.cleared_at = 0.0
+    
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Only paid for when this store is selected
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS read_cache (
+                       key TEXT PRIMARY KEY,
+                       value TEXT,
+                       expires_at REAL NOT NULL,
+                       invalidated_at REAL NOT NULL DEFAULT 0,
+                       used_at REAL NOT NULL
+                   )"""
+            )
+            self.local.conn = conn
+        return conn
+    
+    def get(self, key: str, now: float) -> Optional[str]:
+        conn = self.connection()
+        row = conn.execute(
+            "SELECT value, used_at FROM read_cache WHERE key = ? AND value IS NOT NULL AND expires_at > ?",
+            (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        # Recency for LRU eviction, written at most once a second per key
+        if now - row[1] > 1:
+            conn.execute("UPDATE read_cache SET used_at = ? WHERE key = ?", (now, key))
+        return row[0]
+    
+    def set(self, key: str, value: str, loaded_from: float, expires_at: float) -> None:
+        if self.cleared_at >= loaded_from:
+            return
+        conn = self.connection()
+        conn.execute(
+            """INSERT INTO read_cache (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT (key) DO UPDATE
+               SET value = excluded.value, expires_at = excluded.expires_at, used_at = excluded.used_at
+               WHERE read_cache.invalidated_at < ?""",
+            (key, value, expires_at, loaded_from, loaded_from)
+        )
+        self.writes += 1
+        if self.writes % 100 == 0:
+            self.evict(conn, loaded_from)
+    
+    def invalidate(self, keys: List[str], now: float) -> None:
+        self.connection().executemany(
+            """INSERT INTO read_cache (key, value, expires_at, invalidated_at, used_at) VALUES (?, NULL, 0, ?, ?)
+               ON CONFLICT (key) DO UPDATE SET value = NULL, expires_at = 0, invalidated_at = excluded.invalidated_at""",
+            [(key, now, now) for key in keys]
+        )
+    
+    def clear(self, now: float) -> None:
+        '''Drop every entry but keep the tombstones other processes rely on'''
+        self.cleared_at = now
+        self.connection().execute("UPDATE read_cache SET value = NULL, expires_at = 0")
+    
+    def evict(self, conn, now: float) -> None:
+        '''Drop expired entries and old tombstones, then the least recently used beyond CACHE_MAX_ENTRIES'''
+        conn.execute(
+            "DELETE FROM read_cache WHERE expires_at <= ? AND invalidated_at < ?",
+            (now, now - CACHE_TOMBSTONE_SECONDS)
+        )
+        conn.execute(
+            """DELETE FROM read_cache WHERE key IN (
+                   SELECT key FROM read_cache ORDER BY used_at
+                   LIMIT MAX((SELECT COUNT(*) FROM read_cache) - ?, 0)
+               )""",
+            (CACHE_MAX_ENTRIES,)
+        )
+
+class CacheFlight:
+    '''One in-progress load that concurrent misses for the same key wait on'''
+    __slots__ = ('done', 'value', 'error')
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+class CacheInvalidationListener:
+    '''
+    One LISTEN connection per shard for the change notifications the write
+    triggers send, dropping the changed users' entries whichever function or
+    instance made the write. Notifications sent while a connection is down
+    are lost, so the cache serves only while every shard is listened to and
+    is cleared each time a connection comes back.
+    '''
+    
+    def __init__(self, cache: 'ReadThroughCache'):
+        self.cache = cache
+        self.shards: Optional[int] = None
+        self.listening: set = set()
+        self.lock = threading.Lock()
+    
+    def start(self) -> None:
+        '''Start one listener thread per shard once per process'''
+        if self.shards is not None:
+            return
+        with self.lock:
+            if self.shards is not None:
+                return
+            urls = shard_urls()
+            for shard, url in enumerate(urls):
+                threading.Thread(target=self.run, args=(shard, url), name=f'cache-listen-{shard}', daemon=True).start()
+            self.shards = len(urls)
+    
+    def live(self) -> bool:
+        return self.shards is not None and len(self.listening) == self.shards
+    
+    def run(self, shard: int, url: str) -> None:
+        # Only paid for when the cache is on
+        import select
+        while True:
+            conn = None
+            try:
+                # Keepalives make a silently dropped connection fail instead of waiting forever
+                conn = psycopg2.connect(url, keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+                conn.autocommit = True
+                conn.cursor().execute('LISTEN ' + CACHE_NOTIFY_CHANNEL)
+                self.cache.clear()
+                with self.lock:
+                    self.listening.add(shard)
+                while True:
+                    if select.select([conn], [], [], 60)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            self.dispatch(conn.notifies.pop(0).payload)
+            except (psycopg2.Error, OSError) as e:
+                print(json.dumps({'event': 'cache_listen_failed', 'shard': shard, 'error': str(e).strip()}))
+            finally:
+                with self.lock:
+                    self.listening.discard(shard)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+            time.sleep(CACHE_LISTEN_RETRY_SECONDS)
+    
+    def dispatch(self, payload: str) -> None:
+        try:
+            change = json.loads(payload)
+            user_id, resources = int(change['user_id']), CACHE_NOTIFY_RESOURCES.get(change['resource'], ())
+        except (ValueError, KeyError, TypeError):
+            return
+        self.cache.invalidate([(user_id, resource) for resource in resources])
+
+class ReadThroughCache:
+    '''
+    Serves per-user reads from a cache store and loads misses from the
+    database. Concurrent misses for one key share a single load, error
+    results are never stored, and a sample of hits is re-read to count stale
+    answers. Writes invalidate the keys they change, directly in the writing
+    process and through the listener everywhere else; loads that started
+    before an invalidation are not stored.
+    '''
+    
+    def __init__(self, store):
+        self.store = store
+        self.listener = CacheInvalidationListener(self)
+        self.inflight: Dict[str, CacheFlight] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self.lock = threading.Lock()
+    
+    def start(self) -> None:
+        if self.store is not None:
+            self.listener.start()
+    
+    def count(self, resource: str, counter: str, n: int = 1) -> None:
+        with self.lock:
+            stats = self.stats.get(resource)
+            if stats is None:
+                stats = self.stats[resource] = dict.fromkeys(CACHE_COUNTERS, 0)
+            stats[counter] += n
+    
+    def get(self, user_id: int, resource: str, load: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        if self.store is None:
+            return load()
+        
+        self.listener.start()
+        if not self.listener.live():
+            # Invalidations could be missed: read through without storing
+            self.count(resource, 'bypassed')
+            return load()
+        
+        key = f'{user_id}:{resource}'
+        started = perf_counter()
+        try:
+            cached = self.store.get(key, time.time())
+        except Exception as e:
+            print(json.dumps({'event': 'cache_store_failed', 'error': str(e)}))
+            cached = None
+        record_phase('cache', started)
+        
+        if cached is None:
+            self.count(resource, 'misses')
+            return self.load(key, resource, load)
+        
+        if random.random() >= CACHE_STALE_SAMPLE_RATE:
+            self.count(resource, 'hits')
+            return json.loads(cached)
+        
+        # Sampled hit: answer from the database and record whether the cache was behind
+        fresh = self.load(key, resource, load)
+        self.count(resource, 'sampled')
+        if json.dumps(fresh) != cached:
+            self.count(resource, 'stale')
+        return fresh
+    
+    def load(self, key: str, resource: str, load: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = CacheFlight()
+        
+        if not leader:
+            self.count(resource, 'coalesced')
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return json.loads(flight.value)
+        
+        loaded_from = time.time()
+        try:
+            result = load()
+            flight.value = json.dumps(result)
+            if 'error' not in result:
+                try:
+                    self.store.set(key, flight.value, loaded_from, loaded_from + CACHE_TTL_SECONDS[resource])
+                except Exception as e:
+                    print(json.dumps({'event': 'cache_store_failed', 'error': str(e)}))
+            return result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.done.set()
+    
+    def invalidate(self, keys: List[Tuple[int, str]]) -> None:
+        '''Drop (user_id, resource) entries after a write that changed them'''
+        if self.store is None or not keys:
+            return
+        try:
+            self.store.invalidate([f'{user_id}:{resource}' for user_id, resource in keys], time.time())
+        except Exception as e:
+            # Entries still expire after their TTL
+            print(json.dumps({'event': 'cache_invalidate_failed', 'error': str(e)}))
+        for _, resource in keys:
+            self.count(resource, 'invalidations')
+    
+    def clear(self) -> None:
+        try:
+            self.store.clear(time.time())
+        except Exception as e:
+            print(json.dumps({'event': 'cache_invalidate_failed', 'error': str(e)}))
+    
+    def report(self) -> Dict[str, Any]:
+        '''Per-resource counters with hit ratio and the stale share of sampled hits'''
+        with self.lock:
+            resources = {resource: dict(stats) for resource, stats in self.stats.items()}
+        for stats in resources.values():
+            lookups = stats['hits'] + stats['misses'] + stats['sampled']
+            stats['hit_ratio'] = round((stats['hits'] + stats['sampled']) / lookups, 4) if lookups else None
+            stats['stale_ratio'] = round(stats['stale'] / stats['sampled'], 4) if stats['sampled'] else None
+        return {'store': CACHE_STORE, 'live': self.listener.live(), 'resources': resources}
+
+read_cache = ReadThroughCache(
+    SqliteCacheStore(CACHE_SQLITE_PATH) if CACHE_STORE == 'sqlite'
+    else LocalCacheStore() if CACHE_STORE == 'local'
+    else None
+)
+# End of the shared read cache block
+
+# Pool, registries and read cache handed between the functions that
+# scripts/gateway.py hosts in one process. Shared block: identical in auth,
+# card, loans and referrals; edit all four (scripts/test_shared_blocks.py).
+_shared_state_lock = threading.Lock()
+
+def shared_state() -> Dict[str, Any]:
+    '''This instance's request-timing local, pool, breakers, registries, read cache and token check'''
+    return {
+        'timing_local': _timing_local,
+        'db_local': _db_local,
+        'db_breakers': db_breakers,
+        'prepared': _prepared,
+        'shard_map': shard_map,
+        'fingerprints': _fingerprints,
+        'query_stats': _query_stats,
+        'query_stats_lock': _query_stats_lock,
+        'unavailable': DatabaseUnavailable,
+        'read_cache': read_cache,
+        'verify_token': verify_token
+    }
+
+def use_shared_state(state: Dict[str, Any]) -> None:
+    '''
+    Switch this instance to another function's shared_state() in one step,
+    before it serves anything: an instance that already connected, ran a
+    statement or started its cache listener refuses, since requests in
+    flight would mix its own state with the shared one. Shared breakers and
+    shard map raise the other function's DatabaseUnavailable, so the
+    handler catches that class from then on.
+    '''
+    global _timing_local, _db_local, db_breakers, _prepared, shard_map, _fingerprints, _query_stats, \
+        _query_stats_lock, DatabaseUnavailable, read_cache, verify_token
+    with _shared_state_lock:
+        if db_breakers or _fingerprints or read_cache.listener.shards is not None:
+            raise RuntimeError('shared state must be set before the first request')
+        _timing_local = state['timing_local']
+        _db_local = state['db_local']
+        db_breakers = state['db_breakers']
+        _prepared = state['prepared']
+        shard_map = state['shard_map']
+        _fingerprints = state['fingerprints']
+        _query_stats = state['query_stats']
+        _query_stats_lock = state['query_stats_lock']
+        DatabaseUnavailable = state['unavailable']
+        read_cache = state['read_cache']
+        verify_token = state['verify_token']
+# End of the shared state block
+
 def verify_token(token: str) -> Optional[Dict[str, Any]]:
     '''Verify JWT token and return payload'''
+    started = perf_counter()
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         return payload
@@ -50,46 +1126,78 @@ def verify_token(token: str) -> Optional[Dict[str, Any]]:
         return None
     except jwt.InvalidTokenError:
         return None
+    finally:
+        record_phase('auth', started)
 
 def register_user(email: str, password: str, phone: str, name: str, referral_code: Optional[str] = None) -> Dict[str, Any]:
-    '''Register new user'''
+    '''Register new user in a single statement, resolving the referrer inline'''
+    # Registration is a rare path: keep its imports off the cold start
+    import secrets
+    from psycopg2.errors import UniqueViolation
+    
+    if DATABASE_SHARDS:
+        return register_user_sharded(email, password, phone, name, referral_code)
+    
     conn = get_db_connection()
     cur = conn.cursor()
     
-    # Check if user exists
-    cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-    if cur.fetchone():
-        cur.close()
-        conn.close()
-        return {'error': 'Пользователь с таким email уже существует', 'code': 'USER_EXISTS'}
-    
     # Hash password
     password_hash = hash_password(password)
     
-    # Generate unique referral code
-    user_referral_code = secrets.token_urlsafe(8)
+    # Email conflicts come back as an empty RETURNING; referral code
+    # collisions raise UniqueViolation and are retried with a fresh code.
+    # Referred sign-ups append a user.registered outbox event for bonus accrual
+    user_id = None
+    for _ in range(REFERRAL_CODE_ATTEMPTS):
+        user_referral_code = secrets.token_urlsafe(8)
+        try:
+            cur.execute(
+                """WITH created AS (
+                       INSERT INTO users (email, password_hash, phone, name, referral_code, referred_by, created_at)
+                       SELECT %(email)s, %(password_hash)s, %(phone)s, %(name)s, %(user_referral_code)s,
+                              (SELECT id FROM users WHERE referral_code = %(referral_code)s), NOW()
+                       ON CONFLICT (email) DO NOTHING
+                       RETURNING id, referred_by
+                   ), event AS (
+                       INSERT INTO outbox_events (event_type, user_id, payload)
+                       SELECT 'user.registered', id, jsonb_build_object('referred_by', referred_by)
+                       FROM created
+                       WHERE referred_by IS NOT NULL
+                   )
+                   SELECT id, referred_by FROM created""",
+                {'email': email, 'password_hash': password_hash, 'phone': phone, 'name': name,
+                 'user_referral_code': user_referral_code, 'referral_code': referral_code}
+            )
+        except UniqueViolation:
+            conn.rollback()
+            continue
+        
+        row = cur.fetchone()
+        if not row:
+            conn.rollback()
+            cur.close()
+            release_db_connection(conn)
+            return {'error': 'Пользователь с таким email уже существует', 'code': 'USER_EXISTS'}
+        
+        user_id = row['id']
+        referred_by = row['referred_by']
+        break
     
-    # Get referrer user_id if referral code provided
-    referrer_id = None
-    if referral_code:
-        cur.execute("SELECT id FROM users WHERE referral_code = %s", (referral_code,))
-        referrer = cur.fetchone()
-        if referrer:
-            referrer_id = referrer['id']
-    
-    # Insert user
-    cur.execute(
-        "INSERT INTO users (email, password_hash, phone, name, referral_code, referred_by, created_at) VALUES (%s, %s, %s, %s, %s, %s, NOW()) RETURNING id",
-        (email, password_hash, phone, name, user_referral_code, referrer_id)
-    )
-    user_id = cur.fetchone()['id']
+    if user_id is None:
+        cur.close()
+        release_db_connection(conn)
+        raise Exception('Не удалось сгенерировать уникальный реферальный код')
     
     conn.commit()
     cur.close()
-    conn.close()
+    release_db_connection(conn)
+    
+    # The referrer's referral count just changed
+    if referred_by:
+        read_cache.invalidate([(referred_by, 'referral_stats')])
     
     # Generate token
-    token = generate_token(user_id, email)
+    token = generate_token(user_id, email, referral_code=user_referral_code)
     
     return {
         'success': True,
@@ -103,27 +1211,133 @@ def register_user(email: str, password: str, phone: str, name: str, referral_cod
         }
     }
 
+def register_user_sharded(email: str, password: str, phone: str, name: str, referral_code: Optional[str] = None) -> Dict[str, Any]:
+    '''Register new user: claim id, email and referral code in the directory, then insert on the owning shard'''
+    import secrets
+    from psycopg2.errors import UniqueViolation
+    
+    password_hash = hash_password(password)
+    
+    directory = get_directory_connection()
+    cur = directory.cursor()
+    entry = None
+    for _ in range(REFERRAL_CODE_ATTEMPTS):
+        user_referral_code = secrets.token_urlsafe(8)
+        try:
+            cur.execute(
+                """INSERT INTO user_directory (email, referral_code, referred_by)
+                   SELECT %(email)s, %(user_referral_code)s,
+                          (SELECT user_id FROM user_directory WHERE referral_code = %(referral_code)s)
+                   ON CONFLICT (email) DO NOTHING
+                   RETURNING user_id, referred_by""",
+                {'email': email, 'user_referral_code': user_referral_code, 'referral_code': referral_code}
+            )
+        except UniqueViolation:
+            directory.rollback()
+            continue
+        
+        entry = cur.fetchone()
+        if not entry:
+            directory.rollback()
+            cur.close()
+            release_db_connection(directory)
+            return {'error': 'Пользователь с таким email уже существует', 'code': 'USER_EXISTS'}
+        break
+    
+    if entry is None:
+        cur.close()
+        release_db_connection(directory)
+        raise Exception('Не удалось сгенерировать уникальный реферальный код')
+    
+    directory.commit()
+    cur.close()
+    release_db_connection(directory)
+    
+    user_id = entry['user_id']
+    try:
+        conn = get_db_connection(user_id)
+        cur = conn.cursor()
+        cur.execute(
+            """WITH created AS (
+                   INSERT INTO users (id, email, password_hash, phone, name, referral_code, referred_by, created_at)
+                   VALUES (%(user_id)s, %(email)s, %(password_hash)s, %(phone)s, %(name)s,
+                           %(user_referral_code)s, %(referred_by)s, NOW())
+                   RETURNING id, referred_by
+               ), event AS (
+                   INSERT INTO outbox_events (event_type, user_id, payload)
+                   SELECT 'user.registered', id, jsonb_build_object('referred_by', referred_by)
+                   FROM created
+                   WHERE referred_by IS NOT NULL
+               )
+               SELECT id FROM created""",
+            {'user_id': user_id, 'email': email, 'password_hash': password_hash, 'phone': phone, 'name': name,
+             'user_referral_code': user_referral_code, 'referred_by': entry['referred_by']}
+        )
+        conn.commit()
+        cur.close()
+        release_db_connection(conn)
+    except Exception:
+        # Free the email again so the user can retry
+        directory = get_directory_connection()
+        cur = directory.cursor()
+        cur.execute("DELETE FROM user_directory WHERE user_id = %s", (user_id,))
+        directory.commit()
+        cur.close()
+        release_db_connection(directory)
+        raise
+    
+    if entry['referred_by']:
+        read_cache.invalidate([(entry['referred_by'], 'referral_stats')])
+    
+    token = generate_token(user_id, email, referral_code=user_referral_code)
+    
+    return {
+        'success': True,
+        'token': token,
+        'user': {
+            'id': user_id,
+            'email': email,
+            'name': name,
+            'phone': phone,
+            'referral_code': user_referral_code
+        }
+    }
+
+def lookup_user_id(email: str) -> Optional[int]:
+    '''Resolve email to user id through the shard directory'''
+    conn = get_directory_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT user_id FROM user_directory WHERE email = %s", (email,))
+    entry = cur.fetchone()
+    cur.close()
+    release_db_connection(conn)
+    return entry['user_id'] if entry else None
+
 def login_user(email: str, password: str) -> Dict[str, Any]:
     '''Login existing user'''
-    conn = get_db_connection()
+    # Sharded: find the user's shard by email first; otherwise the one database
+    user_id = None
+    if DATABASE_SHARDS:
+        user_id = lookup_user_id(email)
+        if user_id is None:
+            return {'error': 'Неверный email или пароль', 'code': 'INVALID_CREDENTIALS'}
+    
+    conn = get_db_connection(user_id)
     cur = conn.cursor()
     
     # Get user
     password_hash = hash_password(password)
-    cur.execute(
-        "SELECT id, email, name, phone, referral_code FROM users WHERE email = %s AND password_hash = %s",
-        (email, password_hash)
-    )
+    execute_prepared(cur, 'user_login', (email, password_hash))
     user = cur.fetchone()
     
     cur.close()
-    conn.close()
+    release_db_connection(conn)
     
     if not user:
         return {'error': 'Неверный email или пароль', 'code': 'INVALID_CREDENTIALS'}
     
     # Generate token
-    token = generate_token(user['id'], user['email'])
+    token = generate_token(user['id'], user['email'], referral_code=user['referral_code'], card_id=user['card_id'])
     
     return {
         'success': True,
@@ -139,52 +1353,55 @@ def login_user(email: str, password: str) -> Dict[str, Any]:
 
 def get_user_profile(user_id: int) -> Dict[str, Any]:
     '''Get user profile by ID'''
-    conn = get_db_connection()
+    conn = get_db_connection(user_id)
     cur = conn.cursor()
     
-    cur.execute(
-        "SELECT id, email, name, phone, referral_code, created_at FROM users WHERE id = %s",
-        (user_id,)
-    )
+    execute_prepared(cur, 'user_profile', (user_id,))
     user = cur.fetchone()
     
     cur.close()
-    conn.close()
+    release_db_connection(conn)
     
     if not user:
         return {'error': 'Пользователь не найден', 'code': 'USER_NOT_FOUND'}
     
+    profile = dict(user)
+    profile['created_at'] = profile['created_at'].isoformat()
+    
     return {
         'success': True,
-        'user': dict(user)
+        'user': profile
     }
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+def handle_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     
     # Handle CORS
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return CORS_PREFLIGHT_RESPONSE
     
-    headers = {
-        'Content-Type': 'application/json',
-        'Access-Control-Allow-Origin': '*'
-    }
+    headers = JSON_HEADERS
     
     try:
         if method == 'POST':
             body = json.loads(event.get('body', '{}'))
             action = body.get('action')
             
+            # Shed over-limit login/registration attempts before touching the database
+            if action in ('register', 'login'):
+                rate_limiter.start()
+                limits = [('global', RATE_LIMIT_GLOBAL), ('ip:' + get_source_ip(event), RATE_LIMIT_IP)]
+                if body.get('email'):
+                    limits.append(('email:' + str(body['email']).strip().lower(), RATE_LIMIT_EMAIL))
+                
+                retry_after = rate_limiter.acquire(limits)
+                if retry_after > 0:
+                    return {
+                        'statusCode': 429,
+                        'headers': {**headers, 'Retry-After': str(math.ceil(retry_after))},
+                        'body': encode_json({'error': 'Слишком много попыток, попробуйте позже', 'code': 'RATE_LIMITED'})
+                    }
+            
             if action == 'register':
                 result = register_user(
                     email=body.get('email'),
@@ -198,13 +1415,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     return {
                         'statusCode': 400,
                         'headers': headers,
-                        'body': json.dumps(result)
+                        'body': encode_json(result)
                     }
                 
                 return {
                     'statusCode': 200,
                     'headers': headers,
-                    'body': json.dumps(result)
+                    'body': encode_json(result)
                 }
             
             elif action == 'login':
@@ -217,20 +1434,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     return {
                         'statusCode': 401,
                         'headers': headers,
-                        'body': json.dumps(result)
+                        'body': encode_json(result)
                     }
                 
                 return {
                     'statusCode': 200,
                     'headers': headers,
-                    'body': json.dumps(result)
+                    'body': encode_json(result)
                 }
             
             else:
                 return {
                     'statusCode': 400,
                     'headers': headers,
-                    'body': json.dumps({'error': 'Неизвестное действие'})
+                    'body': encode_json({'error': 'Неизвестное действие'})
                 }
         
         elif method == 'GET':
@@ -241,7 +1458,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 return {
                     'statusCode': 401,
                     'headers': headers,
-                    'body': json.dumps({'error': 'Требуется авторизация'})
+                    'body': AUTH_REQUIRED_BODY
                 }
             
             payload = verify_token(auth_token)
@@ -249,34 +1466,133 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 return {
                     'statusCode': 401,
                     'headers': headers,
-                    'body': json.dumps({'error': 'Недействительный токен'})
+                    'body': INVALID_TOKEN_BODY
                 }
             
-            result = get_user_profile(payload['user_id'])
+            result = read_cache.get(payload['user_id'], 'profile', lambda: get_user_profile(payload['user_id']))
             
             if 'error' in result:
                 return {
                     'statusCode': 404,
                     'headers': headers,
-                    'body': json.dumps(result)
+                    'body': encode_json(result)
                 }
             
             return {
                 'statusCode': 200,
                 'headers': headers,
-                'body': json.dumps(result)
+                'body': encode_json(result)
             }
         
         else:
             return {
                 'statusCode': 405,
                 'headers': headers,
-                'body': json.dumps({'error': 'Метод не поддерживается'})
+                'body': encode_json({'error': 'Метод не поддерживается'})
             }
     
+    except DatabaseUnavailable as e:
+        return db_unavailable_response(e.retry_after)
+    
+    except psycopg2.OperationalError:
+        return db_unavailable_response(1)
+    
     except Exception as e:
         return {
             'statusCode': 500,
             'headers': headers,
-            'body': json.dumps({'error': str(e)})
+            'body': encode_json({'error': str(e)})
+        }
+
+def request_action(event: Dict[str, Any]) -> str:
+    '''Action name used for latency histograms'''
+    if event.get('httpMethod') == 'GET':
+        return 'profile'
+    try:
+        return str(json.loads(event.get('body') or '{}').get('action'))
+    except (ValueError, AttributeError):
+        return 'unknown'
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    if event.get('httpMethod') == 'OPTIONS':
+        return CORS_PREFLIGHT_RESPONSE
+    
+    params = event.get('queryStringParameters') or {}
+    if params.get('admin'):
+        return admin_action(event, params)
+    
+    started = perf_counter()
+    action = request_action(event)
+    _timing_local.phases = {}
+    _timing_local.request_id = getattr(context, 'request_id', None)
+    _timing_local.action = action
+    try:
+        response = handle_request(event, context)
+    finally:
+        release_probes()
+        phases = _timing_local.phases
+        _timing_local.phases = None
+    total = perf_counter() - started
+    
+    observe_latency(action, total)
+    
+    timings = [
+        f'{name};dur={value[0] * 1000:.3f}' + (f';desc="{value[1]} calls"' if value[1] > 1 else '')
+        for name, value in phases.items()
+    ]
+    timings.append(f'total;dur={total * 1000:.3f}')
+    print(json.dumps({
+        'event': 'request',
+        'request_id': getattr(context, 'request_id', None),
+        'action': action,
+        'status': response.get('statusCode'),
+        'total_ms': round(total * 1000, 3),
+        'phases_ms': {name: round(value[0] * 1000, 3) for name, value in phases.items()}
+    }))
+    
+    return {
+        **response,
+        'headers': {**response.get('headers', {}), 'Server-Timing': ', '.join(timings), 'Timing-Allow-Origin': '*'}
+    }
+# End of the shared handler block
+
+def admin_action(event: Dict[str, Any], params: Dict[str, Any]) -> Dict[str, Any]:
+    '''Instance metrics for requests with a valid X-Admin-Token: ?admin=metrics, ?admin=queries&top=N or ?admin=cache'''
+    headers = event.get('headers') or {}
+    token = headers.get('X-Admin-Token') or headers.get('x-admin-token') or ''
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        return {
+            'statusCode': 403,
+            'headers': JSON_HEADERS,
+            'body': json.dumps({'error': 'Доступ запрещен'})
         }
+    
+    if params['admin'] == 'metrics':
+        result = {'success': True, 'latency': latency_report()}
+    elif params['admin'] == 'queries':
+        try:
+            top = int(params.get('top') or QUERY_REPORT_TOP)
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'headers': JSON_HEADERS,
+                'body': json.dumps({'error': 'Некорректный параметр top'})
+            }
+        result = {'success': True, 'queries': query_report(max(1, min(top, QUERY_REPORT_MAX_TOP)))}
+    elif params['admin'] == 'cache':
+        result = {'success': True, 'cache': read_cache.report()}
+    else:
+        return {
+            'statusCode': 400,
+            'headers': JSON_HEADERS,
+            'body': json.dumps({'error': 'Неизвестное действие'})
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': JSON_HEADERS,
+        'body': json.dumps(result)
+    }
+
+if DB_PREWARM:
+    prewarm()
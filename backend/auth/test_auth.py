@@ -0,0 +1,118 @@
+'''
+Unit tests for the auth function: python -m pytest backend/auth
+The database is replaced by scripted fake connections; tests.json covers the deployed HTTP contract.
+'''
+
+import json
+from datetime import datetime
+
+import pytest
+from psycopg2.errors import UniqueViolation
+
+@pytest.fixture
+def auth(load_function):
+    return load_function('auth')
+
+def test_register_existing_email_is_rejected_in_one_statement(auth, use_connection):
+    conn = use_connection(auth, [[]])
+    
+    result = auth.register_user('taken@example.com', 'secret', '+79990000000', 'Taken')
+    
+    assert result['code'] == 'USER_EXISTS'
+    assert len(conn.cur.queries) == 1
+    assert conn.rollbacks == 1 and conn.commits == 0
+
+def test_register_retries_referral_code_collisions(auth, use_connection):
+    conn = use_connection(auth, [UniqueViolation(), [{'id': 7, 'referred_by': None}]])
+    
+    result = auth.register_user('new@example.com', 'secret', '+79990000000', 'New')
+    
+    assert result['success'] and result['user']['id'] == 7
+    assert len(conn.cur.queries) == 2
+    assert conn.commits == 1
+
+def test_register_gives_up_after_repeated_code_collisions(auth, use_connection):
+    use_connection(auth, [UniqueViolation() for _ in range(auth.REFERRAL_CODE_ATTEMPTS)])
+    
+    with pytest.raises(Exception, match='реферальный код'):
+        auth.register_user('new@example.com', 'secret', '+79990000000', 'New')
+
+def test_token_bucket_refills_at_its_rate(auth):
+    bucket = auth.TokenBucket(2, 0.5, now=100.0)
+    bucket.tokens = 0
+    
+    assert bucket.retry_after(100.0) == pytest.approx(2.0)
+    bucket.refill(101.0)
+    assert bucket.retry_after(101.0) == pytest.approx(1.0)
+    bucket.refill(110.0)
+    assert bucket.tokens == 2 and bucket.retry_after(110.0) == 0.0
+
+def test_rate_limiter_rejects_over_limit_email_without_taking_other_tokens(auth, monkeypatch):
+    monkeypatch.setattr(auth.time, 'time', lambda: 1000.0)
+    limiter = auth.RateLimiter(auth.LocalCounterStore())
+    limits = [('ip:1.2.3.4', (30, 0.5)), ('email:a@example.com', (5, 5 / 60))]
+    
+    assert all(limiter.acquire(limits) == 0.0 for _ in range(5))
+    
+    assert limiter.acquire(limits) == pytest.approx(12.0)
+    assert limiter.buckets['ip:1.2.3.4'].tokens == 25
+    assert limiter.acquire([('ip:1.2.3.4', (30, 0.5))]) == 0.0
+
+def test_rate_limiter_blocks_keys_over_the_shared_window_total(auth, monkeypatch):
+    monkeypatch.setattr(auth.time, 'time', lambda: 1000.0)
+    store = auth.LocalCounterStore()
+    # Another instance already used up this email's window
+    store.counters[('email:a@example.com', 960)] = 10
+    limiter = auth.RateLimiter(store)
+    limits = [('email:a@example.com', (5, 5 / 60))]
+    
+    assert limiter.acquire(limits) == 0.0
+    limiter.sync()
+    
+    assert limiter.acquire(limits) == pytest.approx(20.0)
+    assert not limiter.pending
+
+def test_login_over_limit_returns_429_before_the_database(auth, monkeypatch):
+    monkeypatch.setattr(auth, 'rate_limiter', auth.RateLimiter(auth.LocalCounterStore()))
+    monkeypatch.setattr(auth, 'get_db_connection', lambda user_id=None: pytest.fail('database touched'))
+    monkeypatch.setattr(auth, 'login_user', lambda email, password: {'error': 'Неверный email или пароль'})
+    event = {'httpMethod': 'POST', 'headers': {'X-Forwarded-For': '10.0.0.1'},
+             'body': '{"action": "login", "email": "a@example.com", "password": "x"}'}
+    
+    statuses = [auth.handle_request(event, None)['statusCode'] for _ in range(6)]
+    
+    assert statuses == [401] * 5 + [429]
+    response = auth.handle_request(event, None)
+    assert response['headers']['Retry-After'] == '12'
+    assert '"RATE_LIMITED"' in response['body']
+
+def test_source_ip_ignores_client_supplied_forwarded_for(auth, monkeypatch):
+    event = {'headers': {'X-Forwarded-For': '1.1.1.1, 203.0.113.7'},
+             'requestContext': {'identity': {'sourceIp': '198.51.100.2'}}}
+    
+    assert auth.get_source_ip(event) == '198.51.100.2'
+    
+    # Behind one trusted proxy only the entry it appended counts
+    monkeypatch.setattr(auth, 'RATE_LIMIT_TRUSTED_PROXY_HOPS', 1)
+    assert auth.get_source_ip(event) == '203.0.113.7'
+    monkeypatch.setattr(auth, 'RATE_LIMIT_TRUSTED_PROXY_HOPS', 3)
+    assert auth.get_source_ip(event) == '198.51.100.2'
+
+def test_second_profile_read_is_a_cache_hit(auth, monkeypatch, use_connection, listening):
+    listening(auth)
+    monkeypatch.setattr(auth, 'CACHE_STALE_SAMPLE_RATE', 0.0)
+    monkeypatch.setattr(auth, 'verify_token', lambda token: {'user_id': 7})
+    monkeypatch.setattr(auth, 'execute_prepared', lambda cur, name, params=(): cur.execute(name, params))
+    row = {'id': 7, 'email': 'a@example.com', 'name': 'A', 'phone': '+79990000000', 'referral_code': 'ABC',
+           'created_at': datetime(2026, 1, 2, 3, 4, 5)}
+    conn = use_connection(auth, [[row]])
+    event = {'httpMethod': 'GET', 'headers': {'X-Auth-Token': 'token'}}
+    
+    first = auth.handle_request(event, None)
+    second = auth.handle_request(event, None)
+    
+    assert first['statusCode'] == second['statusCode'] == 200
+    assert second['body'] == first['body']
+    assert json.loads(first['body'])['user']['created_at'] == '2026-01-02T03:04:05'
+    assert len(conn.cur.queries) == 1
+    assert auth.read_cache.report()['resources']['profile']['hits'] == 1
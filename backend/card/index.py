@@ -7,131 +7,1357 @@ Returns: HTTP response dict with card data or transaction result
 
 import json
 import os
-from typing import Dict, Any, Optional
+import re
+import threading
+import time
+import math
+import random
+import hmac
+from array import array
+from collections import OrderedDict
+from time import perf_counter
+from typing import Dict, Any, Optional, Tuple, List, Callable
 from datetime import datetime
-import secrets
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 import jwt
 
 JWT_SECRET = os.environ.get('JWT_SECRET', 'labubu-finance-secret-key-2024')
 JWT_ALGORITHM = 'HS256'
+# Must match backend/auth/index.py: tokens of another claims version fall back to the database
+TOKEN_CLAIMS_VERSION = 1
+TOKEN_CLAIM_NAMES = ('cv', 'cid', 'rc')
 
-def get_db_connection():
-    '''Get database connection using DATABASE_URL'''
+# Responses that do not depend on the request, built once per instance
+CORS_PREFLIGHT_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': ''
+}
+JSON_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*'
+}
+AUTH_REQUIRED_BODY = json.dumps({'error': 'Требуется авторизация'})
+INVALID_TOKEN_BODY = json.dumps({'error': 'Недействительный токен'})
+
+# Open the database connection at import time instead of on the first request
+DB_PREWARM = os.environ.get('DB_PREWARM') == '1'
+
+# Virtual card number prefix and retries for issuing a card
+CARD_BIN = '220070'
+CARD_ISSUE_ATTEMPTS = 3
+
+# Months of card history served by the API; older monthly partitions are archived
+TRANSACTION_HISTORY_MONTHS = 12
+
+# Per-request phase timings: Server-Timing header, log line and per-action histograms.
+# This and every other block closed by an '# End of the shared ... block' line
+# is identical in auth, card, loans and referrals; edit all four (scripts/test_shared_blocks.py).
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_timing_local = threading.local()
+_latency_histograms: Dict[str, List[float]] = {}
+_histograms_lock = threading.Lock()
+
+def record_phase(name: str, started: float) -> None:
+    '''Add the time since started to a phase of the current request'''
+    phases = getattr(_timing_local, 'phases', None)
+    if phases is not None:
+        entry = phases.get(name)
+        if entry is None:
+            phases[name] = [perf_counter() - started, 1]
+        else:
+            entry[0] += perf_counter() - started
+            entry[1] += 1
+
+def observe_latency(action: str, seconds: float) -> None:
+    '''Count a request in its action's latency histogram'''
+    ms = seconds * 1000
+    index = len(LATENCY_BUCKETS_MS)
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if ms <= bound:
+            index = i
+            break
+    with _histograms_lock:
+        histogram = _latency_histograms.get(action)
+        if histogram is None:
+            # bucket counts, then +Inf bucket, request count and total ms
+            histogram = _latency_histograms[action] = [0] * (len(LATENCY_BUCKETS_MS) + 3)
+        histogram[index] += 1
+        histogram[-2] += 1
+        histogram[-1] += ms
+
+def latency_report() -> Dict[str, Any]:
+    '''Histograms with approximate percentiles (bucket upper bounds) per action'''
+    bounds = [str(b) for b in LATENCY_BUCKETS_MS] + ['+Inf']
+    report = {}
+    with _histograms_lock:
+        snapshot = {action: list(h) for action, h in _latency_histograms.items()}
+    for action, histogram in snapshot.items():
+        count = histogram[-2]
+        percentiles = {}
+        for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            seen = 0
+            for bound, bucket in zip(bounds, histogram):
+                seen += bucket
+                if seen >= q * count:
+                    percentiles[name] = bound
+                    break
+        report[action] = {
+            'count': count,
+            'mean_ms': round(histogram[-1] / count, 3),
+            'buckets_ms': dict(zip(bounds, histogram[:len(bounds)])),
+            **percentiles
+        }
+    return report
+
+def encode_json(data: Any) -> str:
+    '''Serialize response body, timed as the encode phase'''
+    started = perf_counter()
+    body = json.dumps(data)
+    record_phase('encode', started)
+    return body
+
+# SQL fingerprints: per normalized statement call count, total/max latency and rows
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+FINGERPRINT_CACHE_SIZE = 1000
+QUERY_REPORT_TOP = 20  # fingerprints in ?admin=queries by default
+QUERY_REPORT_MAX_TOP = 200
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s|\$\d+")
+_SQL_IN_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_fingerprints: Dict[str, str] = {}
+_query_stats: Dict[str, List[float]] = {}
+_query_stats_lock = threading.Lock()
+
+def fingerprint_sql(query: str) -> str:
+    '''Normalize a statement: literals and placeholders become ?, whitespace is collapsed'''
+    fingerprint = _fingerprints.get(query)
+    if fingerprint is None:
+        fingerprint = _SQL_IN_LISTS.sub('(?)', _SQL_LITERALS.sub('?', ' '.join(query.split())))
+        if len(_fingerprints) >= FINGERPRINT_CACHE_SIZE:
+            _fingerprints.clear()
+        _fingerprints[query] = fingerprint
+    return fingerprint
+
+def redact_params(vars: Any) -> Any:
+    '''Replace parameter values with their types for logging'''
+    if vars is None:
+        return None
+    if isinstance(vars, dict):
+        return {key: type(value).__name__ for key, value in vars.items()}
+    return [type(value).__name__ for value in vars]
+
+def query_report(top: int) -> List[Dict[str, Any]]:
+    '''Fingerprints of this instance ordered by total time'''
+    with _query_stats_lock:
+        snapshot = [(fingerprint, list(stats)) for fingerprint, stats in _query_stats.items()]
+    snapshot.sort(key=lambda item: -item[1][1])
+    return [{
+        'fingerprint': fingerprint,
+        'calls': int(stats[0]),
+        'total_ms': round(stats[1] * 1000, 3),
+        'mean_ms': round(stats[1] * 1000 / stats[0], 3),
+        'max_ms': round(stats[2] * 1000, 3),
+        'rows': int(stats[3])
+    } for fingerprint, stats in snapshot[:top]]
+
+class InstrumentedCursor(RealDictCursor):
+    '''
+    RealDictCursor that adds every execute to the db phase of the current
+    request, aggregates it under its SQL fingerprint and logs slow statements
+    '''
+    
+    def execute(self, query, vars=None):
+        started = perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except psycopg2.OperationalError:
+            # Lost connections and statement timeouts both count against the database
+            self.connection.breaker.failure()
+            raise
+        except psycopg2.Error:
+            # Constraint, data and syntax errors are answers: the database is up
+            self.connection.breaker.success()
+            raise
+        else:
+            self.connection.breaker.success()
+            return result
+        finally:
+            elapsed = perf_counter() - started
+            record_phase('db', started)
+            fingerprint = fingerprint_sql(query)
+            rows = max(self.rowcount, 0)
+            with _query_stats_lock:
+                stats = _query_stats.get(fingerprint)
+                if stats is None:
+                    _query_stats[fingerprint] = [1, elapsed, elapsed, rows]
+                else:
+                    stats[0] += 1
+                    stats[1] += elapsed
+                    stats[3] += rows
+                    if elapsed > stats[2]:
+                        stats[2] = elapsed
+            if elapsed * 1000 >= SLOW_QUERY_MS:
+                print(json.dumps({
+                    'event': 'slow_query',
+                    'request_id': getattr(_timing_local, 'request_id', None),
+                    'fingerprint': fingerprint,
+                    'ms': round(elapsed * 1000, 3),
+                    'rows': rows,
+                    'params': redact_params(vars)
+                }))
+# End of the shared instrumentation block
+
+# Slower actions of this function; the rest run under DEFAULT_STATEMENT_TIMEOUT_MS
+STATEMENT_TIMEOUTS_MS = {'card': 1500, 'transactions': 2000, 'balance_at': 5000, 'sbp_transfer': 3000}
+
+# Fail fast while the database is slow or down instead of piling requests up
+DB_CONNECT_TIMEOUT_SECONDS = int(os.environ.get('DB_CONNECT_TIMEOUT_SECONDS', '2'))
+DEFAULT_STATEMENT_TIMEOUT_MS = 3000
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN_SECONDS = 10
+# A probe that reports nothing within its connect and statement timeouts is presumed lost
+BREAKER_PROBE_TIMEOUT_SECONDS = DB_CONNECT_TIMEOUT_SECONDS + max(DEFAULT_STATEMENT_TIMEOUT_MS, *STATEMENT_TIMEOUTS_MS.values()) / 1000
+DB_UNAVAILABLE_BODY = json.dumps({'error': 'Сервис временно недоступен, попробуйте позже', 'code': 'DB_UNAVAILABLE'})
+
+class DatabaseUnavailable(Exception):
+    '''Raised instead of connecting while the circuit breaker is open'''
+    
+    def __init__(self, retry_after: float):
+        super().__init__('Database unavailable')
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    '''
+    Closed: requests pass, consecutive failures are counted.
+    Open: requests are rejected until the cooldown ends.
+    Half-open: a single probe request passes; its outcome closes or reopens the breaker.
+    A probe that ends without an outcome frees the slot (release_probe), and
+    one still silent after probe_timeout is replaced by the next request.
+    '''
+    
+    def __init__(self, threshold: int, cooldown: float, probe_timeout: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_owner: Optional[int] = None
+        self.probe_started = 0.0
+        self.lock = threading.Lock()
+    
+    def check(self) -> None:
+        '''Raise DatabaseUnavailable unless a request may use the database now'''
+        if self.state == 'closed':
+            return
+        with self.lock:
+            now = time.monotonic()
+            if self.state == 'open':
+                remaining = self.opened_at + self.cooldown - now
+                if remaining > 0:
+                    raise DatabaseUnavailable(remaining)
+            elif self.probe_owner == threading.get_ident():
+                # The probe opening another connection to the same database
+                return
+            elif now - self.probe_started < self.probe_timeout:
+                # A probe is already in flight
+                raise DatabaseUnavailable(self.probe_started + self.probe_timeout - now)
+            self.state = 'half-open'
+            self.probe_owner = threading.get_ident()
+            self.probe_started = now
+    
+    def success(self) -> None:
+        if self.state == 'closed' and not self.failures:
+            return
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.probe_owner = None
+    
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.probe_owner = None
+    
+    def release_probe(self) -> None:
+        '''End of a request: a probe it held without an outcome lets the next request probe at once'''
+        if self.probe_owner != threading.get_ident():
+            return
+        with self.lock:
+            if self.state == 'half-open' and self.probe_owner == threading.get_ident():
+                self.state = 'open'
+                self.opened_at = time.monotonic() - self.cooldown
+                self.probe_owner = None
+
+def db_unavailable_response(retry_after: float) -> Dict[str, Any]:
+    return {
+        'statusCode': 503,
+        'headers': {**JSON_HEADERS, 'Retry-After': str(max(1, math.ceil(retry_after)))},
+        'body': DB_UNAVAILABLE_BODY
+    }
+
+# User-id sharding: DATABASE_SHARDS is a JSON list of shard DSNs; unset means a
+# single database at DATABASE_URL. Users are routed by bucket (user_id % SHARD_BUCKETS)
+# through the shard_buckets map, and emails, referral codes and user ids are
+# allocated in the directory database (DATABASE_DIRECTORY_URL, default the first shard)
+DATABASE_SHARDS: List[str] = json.loads(os.environ.get('DATABASE_SHARDS') or '[]')
+SHARD_BUCKETS = 1024
+SHARD_MAP_TTL_SECONDS = 30
+
+def shard_urls() -> List[str]:
+    '''DSN of every shard; just DATABASE_URL when sharding is off'''
+    if DATABASE_SHARDS:
+        return DATABASE_SHARDS
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
         raise Exception('DATABASE_URL not found in environment')
-    return psycopg2.connect(database_url, cursor_factory=RealDictCursor)
+    return [database_url]
+
+def directory_url() -> str:
+    return os.environ.get('DATABASE_DIRECTORY_URL') or shard_urls()[0]
+
+class ShardMap:
+    '''
+    Bucket to shard routing, loaded from the directory's shard_buckets and
+    cached for SHARD_MAP_TTL_SECONDS. Buckets without a row live on shard 0;
+    buckets being moved by scripts/shard_rebalance.py are frozen and their
+    users get 503 until the move switches them to the new shard.
+    '''
+    
+    def __init__(self):
+        self.buckets: Optional[List[Optional[int]]] = None
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+    
+    def shard_for(self, user_id: int) -> int:
+        if not DATABASE_SHARDS:
+            return 0
+        if self.buckets is None or time.monotonic() - self.loaded_at > SHARD_MAP_TTL_SECONDS:
+            with self.lock:
+                if self.buckets is None or time.monotonic() - self.loaded_at > SHARD_MAP_TTL_SECONDS:
+                    self.buckets = self.load()
+                    self.loaded_at = time.monotonic()
+        shard = self.buckets[user_id % SHARD_BUCKETS]
+        if shard is None:
+            raise DatabaseUnavailable(SHARD_MAP_TTL_SECONDS)
+        return shard
+    
+    def load(self) -> List[Optional[int]]:
+        buckets: List[Optional[int]] = [0] * SHARD_BUCKETS
+        conn = get_directory_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT bucket, shard, moving FROM shard_buckets")
+        for row in cur.fetchall():
+            buckets[row['bucket']] = None if row['moving'] else row['shard']
+        cur.close()
+        release_db_connection(conn)
+        return buckets
+
+shard_map = ShardMap()
+
+class BreakerConnection(psycopg2.extensions.connection):
+    '''Connection carrying the circuit breaker of the database it points at'''
+    breaker: CircuitBreaker
+
+# Connections are per thread, so prewarm() at import time only warms the
+# importing thread. Every other thread warms lazily: its first connection to a
+# database prepares the hot statements as it opens. The gateway runs prewarm()
+# in each worker thread as it starts.
+_db_local = threading.local()
+db_breakers: Dict[str, CircuitBreaker] = {}
+
+def connect_pooled(database_url: str):
+    '''Get this instance's pooled connection to database_url, reconnecting if it was closed'''
+    started = perf_counter()
+    breaker = db_breakers.get(database_url)
+    if breaker is None:
+        breaker = db_breakers.setdefault(database_url, CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN_SECONDS,
+                                                                      BREAKER_PROBE_TIMEOUT_SECONDS))
+    breaker.check()
+    timeout_ms = STATEMENT_TIMEOUTS_MS.get(getattr(_timing_local, 'action', None), DEFAULT_STATEMENT_TIMEOUT_MS)
+    
+    conns = getattr(_db_local, 'conns', None)
+    if conns is None:
+        conns = _db_local.conns = {}
+        _db_local.statement_timeouts = {}
+    conn = conns.get(database_url)
+    if conn is None or conn.closed:
+        if conn is not None:
+            _prepared.pop(id(conn), None)
+        try:
+            conn = psycopg2.connect(
+                database_url,
+                connection_factory=BreakerConnection,
+                cursor_factory=InstrumentedCursor,
+                connect_timeout=DB_CONNECT_TIMEOUT_SECONDS,
+                options=f'-c statement_timeout={timeout_ms}'
+            )
+        except psycopg2.OperationalError:
+            breaker.failure()
+            raise
+        conn.breaker = breaker
+        conns[database_url] = conn
+        _db_local.statement_timeouts[database_url] = timeout_ms
+        prepare_statements(conn)
+    elif conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+    
+    # Only pay for a SET when the action's timeout differs from the session's
+    if _db_local.statement_timeouts[database_url] != timeout_ms:
+        cur = conn.cursor()
+        cur.execute("SET statement_timeout = %s", (timeout_ms,))
+        cur.close()
+        conn.commit()
+        _db_local.statement_timeouts[database_url] = timeout_ms
+    
+    record_phase('db-acquire', started)
+    return conn
+
+def get_db_connection(user_id: Optional[int] = None):
+    '''Get the pooled connection to the shard owning user_id, or to the directory when user_id is None'''
+    if user_id is None:
+        return get_directory_connection()
+    return connect_pooled(shard_urls()[shard_map.shard_for(user_id)])
+
+def get_shard_connection(shard: int):
+    return connect_pooled(shard_urls()[shard])
+
+def get_directory_connection():
+    return connect_pooled(directory_url())
+
+def release_probes() -> None:
+    '''Free the probe slots this thread holds; runs after every request'''
+    for breaker in list(db_breakers.values()):
+        breaker.release_probe()
+
+def release_db_connection(conn) -> None:
+    '''Return connection to the pool, discarding any unfinished transaction'''
+    if not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+# End of the shared connection pool block
+
+# Hot read-only statements, prepared once per pooled connection and executed by name
+PREPARED_STATEMENTS = {
+    'card_by_user': "SELECT id, card_number, balance, status, created_at FROM virtual_cards WHERE user_id = $1",
+    'card_id_by_user': "SELECT id FROM virtual_cards WHERE user_id = $1",
+    'card_transactions_page': """SELECT id, type, amount, phone, comment, status, created_at
+           FROM card_transactions
+           WHERE card_id = $1 AND created_at >= $2
+           ORDER BY created_at DESC
+           LIMIT $3"""
+}
+
+# Names prepared on each pooled connection, by id(conn), with the server pid they were prepared in
+_prepared: Dict[int, Tuple[int, set]] = {}
+
+def prepared_names(conn) -> set:
+    '''Names already prepared on this connection, reset when the server session changed'''
+    pid = conn.get_backend_pid()
+    entry = _prepared.get(id(conn))
+    if entry is None or entry[0] != pid:
+        entry = (pid, set())
+        _prepared[id(conn)] = entry
+    return entry[1]
+
+def execute_prepared(cur, name: str, params: tuple = ()) -> None:
+    '''Execute a statement from PREPARED_STATEMENTS by name, preparing it on first use per connection'''
+    conn = cur.connection
+    for attempt in range(2):
+        prepared = prepared_names(conn)
+        try:
+            if name not in prepared:
+                cur.execute(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}')
+                prepared.add(name)
+            cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+            return
+        except psycopg2.Error as e:
+            # Registered statements are read-only, so rolling back loses nothing
+            if attempt or e.pgcode not in ('26000', '42P05'):
+                raise
+            conn.rollback()
+            if e.pgcode == '26000':
+                # Statement is gone: the server session was recycled
+                prepared.clear()
+            else:
+                # Already prepared on this session by an earlier owner of the connection
+                prepared.add(name)
+
+def prepare_statements(conn) -> None:
+    '''Prepare the hot statements missing on a connection in one round trip; execute_prepared retries any that fail'''
+    prepared = prepared_names(conn)
+    missing = [name for name in PREPARED_STATEMENTS if name not in prepared]
+    if not missing:
+        return
+    cur = conn.cursor()
+    try:
+        cur.execute('; '.join(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}' for name in missing))
+        conn.commit()
+        prepared.update(missing)
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(json.dumps({'event': 'prepare_failed', 'error': str(e)}))
+    finally:
+        cur.close()
+# End of the shared prepared statements block
+
+def prewarm() -> None:
+    '''Open this thread's pooled shard connections, prepare hot statements, start loading velocity counters and start the read cache listener before the first invocation'''
+    try:
+        for shard in range(len(shard_urls())):
+            conn = get_shard_connection(shard)
+            release_db_connection(conn)
+        sbp_velocity.start()
+        read_cache.start()
+    except Exception as e:
+        print(json.dumps({'event': 'prewarm_failed', 'error': str(e)}))
+
+# SBP transfer velocity limits per card and per recipient phone:
+# (max transfers, max amount) over the last minute, hour and day
+VELOCITY_LIMIT_SCALE = float(os.environ.get('VELOCITY_LIMIT_SCALE', '1'))  # load tests only: multiplies every limit
+VELOCITY_LIMITS = {
+    kind: {name: (count * VELOCITY_LIMIT_SCALE, amount * VELOCITY_LIMIT_SCALE) for name, (count, amount) in limits.items()}
+    for kind, limits in {
+        'card': {'minute': (3, 50000), 'hour': (20, 150000), 'day': (50, 300000)},
+        'phone': {'minute': (3, 50000), 'hour': (10, 150000), 'day': (30, 300000)},
+    }.items()
+}
+VELOCITY_WINDOWS = (('minute', 5, 12), ('hour', 300, 12), ('day', 3600, 24))  # (name, slot seconds, slots)
+VELOCITY_SYNC_SECONDS = 2  # how often transfers made by other instances are read from the ledger
+VELOCITY_OVERLAP_SECONDS = 30  # ledger re-read on every sync to catch transfers committed late
+VELOCITY_MAX_KEYS = 200000  # in-process counters kept before LRU eviction
+VELOCITY_REBUILD_BATCH = 5000  # ledger rows fetched per round trip while rebuilding
+VELOCITY_LIMIT_BODY = 'Превышен лимит переводов, попробуйте позже'
+PHONE_KEY_DIGITS = 10  # +7 and 8 prefixes of one number share its last 10 digits
+
+class SlidingWindow:
+    '''Transfer count and amount over the last slots * width seconds, as a ring of time slots'''
+    __slots__ = ('width', 'counts', 'amounts', 'head')
+    
+    def __init__(self, width: int, slots: int):
+        self.width = width
+        self.counts = array('I', bytes(4 * slots))
+        self.amounts = array('d', bytes(8 * slots))
+        self.head = 0
+    
+    def advance(self, slot: int) -> None:
+        '''Make slot the newest one, clearing the slots that fell out of the window'''
+        if slot <= self.head:
+            return
+        size = len(self.counts)
+        for s in range(max(self.head + 1, slot - size + 1), slot + 1):
+            self.counts[s % size] = 0
+            self.amounts[s % size] = 0.0
+        self.head = slot
+    
+    def add(self, at: float, count: int, amount: float) -> None:
+        slot = int(at // self.width)
+        self.advance(slot)
+        if slot <= self.head - len(self.counts):
+            return
+        # Released reservations subtract; the slot may have been evicted and recreated since
+        index = slot % len(self.counts)
+        self.counts[index] = max(0, self.counts[index] + count)
+        self.amounts[index] = max(0.0, self.amounts[index] + amount)
+    
+    def totals(self, now: float) -> Tuple[int, float]:
+        self.advance(int(now // self.width))
+        return sum(self.counts), sum(self.amounts)
+
+class VelocityCounter:
+    '''Minute, hour and day windows of one card or recipient phone'''
+    __slots__ = ('windows', 'last_at')
+    
+    def __init__(self):
+        self.windows = tuple(SlidingWindow(width, slots) for _, width, slots in VELOCITY_WINDOWS)
+        self.last_at = 0.0
+    
+    def add(self, at: float, count: int, amount: float) -> None:
+        for window in self.windows:
+            window.add(at, count, amount)
+        self.last_at = max(self.last_at, at)
+
+def phone_key(phone: Any) -> Optional[str]:
+    '''
+    Velocity key of a recipient phone: its last PHONE_KEY_DIGITS digits. None
+    for shorter numbers, which would otherwise all share one key
+    '''
+    digits = re.sub(r'\D', '', str(phone or ''))
+    if len(digits) < PHONE_KEY_DIGITS:
+        return None
+    return 'phone:' + digits[-PHONE_KEY_DIGITS:]
+
+class VelocityLimiter:
+    '''
+    Sliding-window counters checked in-process, so the transfer path does no
+    extra database work. A transfer reserves its count and amount under the
+    lock before it runs and gives them back if it fails, so concurrent
+    transfers of one card cannot all pass the same check. Cards are counted
+    by card id, which the ledger rows carry, so reading them needs no join.
+    The ledger is the shared store. A background thread, started by prewarm
+    or the first transfer, rebuilds the counters from the last day of SBP
+    transfers, oldest first, and then every VELOCITY_SYNC_SECONDS merges in
+    the newest ledger rows of every shard, which adds transfers made by
+    other instances.
+    Until the rebuild finishes only this instance's transfers are counted.
+    Rows re-read in the overlap and rows this instance already reserved are
+    skipped by id. Keys idle for a day hold no counts and are evicted.
+    '''
+    
+    def __init__(self):
+        self.counters: 'OrderedDict[str, VelocityCounter]' = OrderedDict()
+        self.seen: Dict[Tuple[int, int], float] = {}
+        self.synced_at: Optional[List[float]] = None
+        self.rejected = 0
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+    
+    def _counter(self, key: str) -> VelocityCounter:
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = self.counters[key] = VelocityCounter()
+            if len(self.counters) > VELOCITY_MAX_KEYS:
+                self.counters.popitem(last=False)
+        else:
+            self.counters.move_to_end(key)
+        return counter
+    
+    def _add(self, card_id: int, phone: str, at: float, count: int, amount: float) -> None:
+        self._counter(f'card:{card_id}').add(at, count, amount)
+        # Ledger rows from before phones were validated may have none: only the card is counted
+        key = phone_key(phone)
+        if key is not None:
+            self._counter(key).add(at, count, amount)
+    
+    def reserve(self, card_id: int, phone: str, amount: float) -> Tuple[Optional[tuple], Optional[Tuple[str, float]]]:
+        '''
+        Count a transfer before it runs: (reservation, None) if it fits every
+        limit, else (None, (violated limit, seconds to retry))
+        '''
+        started = perf_counter()
+        now = time.time()
+        try:
+            with self.lock:
+                for key in (f'card:{card_id}', phone_key(phone)):
+                    counter = self.counters.get(key) if key is not None else None
+                    if counter is None:
+                        continue
+                    limits = VELOCITY_LIMITS[key.split(':', 1)[0]]
+                    for (name, width, _), window in zip(VELOCITY_WINDOWS, counter.windows):
+                        count, total = window.totals(now)
+                        max_count, max_amount = limits[name]
+                        if count + 1 > max_count or total + amount > max_amount:
+                            self.rejected += 1
+                            # The oldest slot leaves the window within one slot width
+                            return None, (f"{key.split(':', 1)[0]}:{name}", width - now % width)
+                self._add(card_id, phone, now, 1, amount)
+            return (card_id, phone, now, amount), None
+        finally:
+            record_phase('velocity', started)
+    
+    def release(self, reservation: tuple) -> None:
+        '''Give back the count and amount of a transfer that did not happen'''
+        card_id, phone, at, amount = reservation
+        with self.lock:
+            self._add(card_id, phone, at, -1, -amount)
+    
+    def confirm(self, reservation: tuple, shard: int, transaction_id: int) -> None:
+        '''Tie a reservation to its committed ledger row so the sync does not count it again'''
+        with self.lock:
+            if (shard, transaction_id) in self.seen:
+                # The sync read the row before this call and already counted it
+                card_id, phone, at, amount = reservation
+                self._add(card_id, phone, at, -1, -amount)
+            else:
+                self.seen[(shard, transaction_id)] = reservation[2]
+    
+    def start(self) -> None:
+        '''Start the background rebuild and sync once per process'''
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='velocity-sync', daemon=True)
+                self.thread.start()
+    
+    def run(self) -> None:
+        while self.synced_at is None:
+            try:
+                self.rebuild()
+            except Exception as e:
+                print(json.dumps({'event': 'velocity_rebuild_failed', 'error': str(e)}))
+                time.sleep(VELOCITY_SYNC_SECONDS)
+        
+        while True:
+            time.sleep(VELOCITY_SYNC_SECONDS)
+            for shard in range(len(self.synced_at)):
+                try:
+                    self.sync_shard(shard)
+                except Exception as e:
+                    # Best effort: keep checking against the counters already loaded
+                    print(json.dumps({'event': 'velocity_sync_failed', 'shard': shard, 'error': str(e)}))
+    
+    def rebuild(self) -> None:
+        '''Load the last day of SBP transfers from every shard, oldest first'''
+        started = perf_counter()
+        synced_at = []
+        for shard in range(len(shard_urls())):
+            conn = get_shard_connection(shard)
+            # A day of transfers is streamed in batches and kept as tuples, not dicts
+            cur = conn.cursor(name='velocity_rebuild')
+            cur.itersize = VELOCITY_REBUILD_BATCH
+            cur.execute(
+                """SELECT id, card_id, phone, amount::float8 AS amount,
+                          EXTRACT(EPOCH FROM created_at - LOCALTIMESTAMP)::float8 AS age
+                   FROM card_transactions
+                   WHERE created_at >= LOCALTIMESTAMP - INTERVAL '1 day'
+                     AND type = 'sbp_transfer' AND status = 'completed'
+                   ORDER BY created_at"""
+            )
+            transfers = [(row['id'], row['card_id'], row['phone'], row['amount'], row['age']) for row in cur]
+            cur.close()
+            release_db_connection(conn)
+            now = time.time()
+            synced_at.append(time.monotonic())
+            
+            # Added oldest first, so the least recently used keys are the ones idle longest
+            with self.lock:
+                for transaction_id, card_id, phone, amount, age in transfers:
+                    at = now + age
+                    if age >= -VELOCITY_OVERLAP_SECONDS:
+                        # The first sync re-reads these rows
+                        if (shard, transaction_id) in self.seen:
+                            continue
+                        self.seen[(shard, transaction_id)] = at
+                    self._add(card_id, phone, at, 1, amount)
+        
+        self.synced_at = synced_at
+        record_phase('velocity-rebuild', started)
+    
+    def sync_shard(self, shard: int) -> None:
+        started = perf_counter()
+        synced_at = time.monotonic()
+        # From the last successful sync of this shard, so a failed one leaves no gap
+        since = synced_at - self.synced_at[shard] + VELOCITY_OVERLAP_SECONDS
+        
+        conn = get_shard_connection(shard)
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT id, card_id, phone, amount::float8 AS amount,
+                      EXTRACT(EPOCH FROM created_at - LOCALTIMESTAMP)::float8 AS age
+               FROM card_transactions
+               WHERE created_at >= LOCALTIMESTAMP - make_interval(secs => %s)
+                 AND type = 'sbp_transfer' AND status = 'completed'
+               ORDER BY created_at""",
+            (since,)
+        )
+        rows = cur.fetchall()
+        cur.close()
+        release_db_connection(conn)
+        self.synced_at[shard] = synced_at
+        
+        now = time.time()
+        with self.lock:
+            for row in rows:
+                if (shard, row['id']) in self.seen:
+                    continue
+                at = now + row['age']
+                self.seen[(shard, row['id'])] = at
+                self._add(row['card_id'], row['phone'], at, 1, row['amount'])
+            
+            expire_before = now - 2 * VELOCITY_OVERLAP_SECONDS - VELOCITY_SYNC_SECONDS
+            for key in [k for k, at in self.seen.items() if at < expire_before]:
+                del self.seen[key]
+            
+            # Least recently used first: stop at the first key with counts left
+            idle_before = now - VELOCITY_WINDOWS[-1][1] * VELOCITY_WINDOWS[-1][2]
+            while self.counters:
+                key, counter = next(iter(self.counters.items()))
+                if counter.last_at >= idle_before:
+                    break
+                del self.counters[key]
+        record_phase('velocity-sync', started)
+    
+    def report(self) -> Dict[str, Any]:
+        return {'keys': len(self.counters), 'rejected': self.rejected}
+
+sbp_velocity = VelocityLimiter()
+
+# Read-through cache for per-user reads that rarely change, keyed by (user_id, resource).
+# Shared block: identical in auth, card, loans and referrals so the gateway can
+# share one instance; edit all four (scripts/test_shared_blocks.py compares them).
+# CACHE_STORE: 'local' (this process), 'sqlite' (a file shared by the function
+# processes of one host) or 'off'. Either way every process drops entries on the
+# NOTIFY user_changes sent by the write triggers (V0008, V0013), so a write made
+# by any function or instance reaches every cache.
+CACHE_STORE = os.environ.get('CACHE_STORE', 'local')
+CACHE_SQLITE_PATH = os.environ.get('CACHE_SQLITE_PATH', '/tmp/labubu-read-cache.sqlite3')
+CACHE_TTL_SECONDS = {'profile': 300, 'card': 30, 'loan_stats': 60, 'referral_stats': 60}
+CACHE_MAX_ENTRIES = 10000  # entries kept before LRU eviction
+CACHE_TOMBSTONE_SECONDS = 60  # invalidations remembered so loads started before them are not stored
+CACHE_STALE_SAMPLE_RATE = float(os.environ.get('CACHE_STALE_SAMPLE_RATE', '0.01'))  # hits re-read to measure staleness
+CACHE_COUNTERS = ('hits', 'misses', 'coalesced', 'bypassed', 'sampled', 'stale', 'invalidations')
+CACHE_NOTIFY_CHANNEL = 'user_changes'
+# Resource in a change notification -> cached resources it makes stale (profiles are never updated)
+CACHE_NOTIFY_RESOURCES = {'card': ('card',), 'loans': ('loan_stats',), 'referrals': ('referral_stats',)}
+CACHE_LISTEN_RETRY_SECONDS = 5
+
+class LocalCacheStore:
+    '''In-process LRU of JSON-encoded values with expiry and invalidation tombstones'''
+    
+    def __init__(self):
+        self.entries: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+        self.invalidated: Dict[str, float] = {}
+        self.cleared_at = 0.0
+        self.lock = threading.Lock()
+    
+    def get(self, key: str, now: float) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+    
+    def set(self, key: str, value: str, loaded_from: float, expires_at: float) -> None:
+        '''Store value unless the key was invalidated after the load that produced it started'''
+        with self.lock:
+            if max(self.invalidated.get(key, 0), self.cleared_at) >= loaded_from:
+                return
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            if len(self.entries) > CACHE_MAX_ENTRIES:
+                self.entries.popitem(last=False)
+    
+    def invalidate(self, keys: List[str], now: float) -> None:
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+                self.invalidated[key] = now
+            if len(self.invalidated) > CACHE_MAX_ENTRIES:
+                expire_before = now - CACHE_TOMBSTONE_SECONDS
+                for key in [k for k, at in self.invalidated.items() if at < expire_before]:
+                    del self.invalidated[key]
+    
+    def clear(self, now: float) -> None:
+        '''Drop every entry and refuse loads started before now'''
+        with self.lock:
+            self.entries.clear()
+            self.cleared_at = now
+
+class SqliteCacheStore:
+    '''Cache table in a SQLite file, shared by the function processes of one host'''
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        self.cleared_at = 0.0
+    
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Only paid for when this store is selected
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS read_cache (
+                       key TEXT PRIMARY KEY,
+                       value TEXT,
+                       expires_at REAL NOT NULL,
+                       invalidated_at REAL NOT NULL DEFAULT 0,
+                       used_at REAL NOT NULL
+                   )"""
+            )
+            self.local.conn = conn
+        return conn
+    
+    def get(self, key: str, now: float) -> Optional[str]:
+        conn = self.connection()
+        row = conn.execute(
+            "SELECT value, used_at FROM read_cache WHERE key = ? AND value IS NOT NULL AND expires_at > ?",
+            (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        # Recency for LRU eviction, written at most once a second per key
+        if now - row[1] > 1:
+            conn.execute("UPDATE read_cache SET used_at = ? WHERE key = ?", (now, key))
+        return row[0]
+    
+    def set(self, key: str, value: str, loaded_from: float, expires_at: float) -> None:
+        if self.cleared_at >= loaded_from:
+            return
+        conn = self.connection()
+        conn.execute(
+            """INSERT INTO read_cache (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT (key) DO UPDATE
+               SET value = excluded.value, expires_at = excluded.expires_at, used_at = excluded.used_at
+               WHERE read_cache.invalidated_at < ?""",
+            (key, value, expires_at, loaded_from, loaded_from)
+        )
+        self.writes += 1
+        if self.writes % 100 == 0:
+            self.evict(conn, loaded_from)
+    
+    def invalidate(self, keys: List[str], now: float) -> None:
+        self.connection().executemany(
+            """INSERT INTO read_cache (key, value, expires_at, invalidated_at, used_at) VALUES (?, NULL, 0, ?, ?)
+               ON CONFLICT (key) DO UPDATE SET value = NULL, expires_at = 0, invalidated_at = excluded.invalidated_at""",
+            [(key, now, now) for key in keys]
+        )
+    
+    def clear(self, now: float) -> None:
+        '''Drop every entry but keep the tombstones other processes rely on'''
+        self.cleared_at = now
+        self.connection().execute("UPDATE read_cache SET value = NULL, expires_at = 0")
+    
+    def evict(self, conn, now: float) -> None:
+        '''Drop expired entries and old tombstones, then the least recently used beyond CACHE_MAX_ENTRIES'''
+        conn.execute(
+            "DELETE FROM read_cache WHERE expires_at <= ? AND invalidated_at < ?",
+            (now, now - CACHE_TOMBSTONE_SECONDS)
+        )
+        conn.execute(
+            """DELETE FROM read_cache WHERE key IN (
+                   SELECT key FROM read_cache ORDER BY used_at
+                   LIMIT MAX((SELECT COUNT(*) FROM read_cache) - ?, 0)
+               )""",
+            (CACHE_MAX_ENTRIES,)
+        )
+
+class CacheFlight:
+    '''One in-progress load that concurrent misses for the same key wait on'''
+    __slots__ = ('done', 'value', 'error')
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+class CacheInvalidationListener:
+    '''
+    One LISTEN connection per shard for the change notifications the write
+    triggers send, dropping the changed users' entries whichever function or
+    instance made the write. Notifications sent while a connection is down
+    are lost, so the cache serves only while every shard is listened to and
+    is cleared each time a connection comes back.
+    '''
+    
+    def __init__(self, cache: 'ReadThroughCache'):
+        self.cache = cache
+        self.shards: Optional[int] = None
+        self.listening: set = set()
+        self.lock = threading.Lock()
+    
+    def start(self) -> None:
+        '''Start one listener thread per shard once per process'''
+        if self.shards is not None:
+            return
+        with self.lock:
+            if self.shards is not None:
+                return
+            urls = shard_urls()
+            for shard, url in enumerate(urls):
+                threading.Thread(target=self.run, args=(shard, url), name=f'cache-listen-{shard}', daemon=True).start()
+            self.shards = len(urls)
+    
+    def live(self) -> bool:
+        return self.shards is not None and len(self.listening) == self.shards
+    
+    def run(self, shard: int, url: str) -> None:
+        # Only paid for when the cache is on
+        import select
+        while True:
+            conn = None
+            try:
+                # Keepalives make a silently dropped connection fail instead of waiting forever
+                conn = psycopg2.connect(url, keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+                conn.autocommit = True
+                conn.cursor().execute('LISTEN ' + CACHE_NOTIFY_CHANNEL)
+                self.cache.clear()
+                with self.lock:
+                    self.listening.add(shard)
+                while True:
+                    if select.select([conn], [], [], 60)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            self.dispatch(conn.notifies.pop(0).payload)
+            except (psycopg2.Error, OSError) as e:
+                print(json.dumps({'event': 'cache_listen_failed', 'shard': shard, 'error': str(e).strip()}))
+            finally:
+                with self.lock:
+                    self.listening.discard(shard)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+            time.sleep(CACHE_LISTEN_RETRY_SECONDS)
+    
+    def dispatch(self, payload: str) -> None:
+        try:
+            change = json.loads(payload)
+            user_id, resources = int(change['user_id']), CACHE_NOTIFY_RESOURCES.get(change['resource'], ())
+        except (ValueError, KeyError, TypeError):
+            return
+        self.cache.invalidate([(user_id, resource) for resource in resources])
+
+class ReadThroughCache:
+    '''
+    Serves per-user reads from a cache store and loads misses from the
+    database. Concurrent misses for one key share a single load, error
+    results are never stored, and a sample of hits is re-read to count stale
+    answers. Writes invalidate the keys they change, directly in the writing
+    process and through the listener everywhere else; loads that started
+    before an invalidation are not stored.
+    '''
+    
+    def __init__(self, store):
+        self.store = store
+        self.listener = CacheInvalidationListener(self)
+        self.inflight: Dict[str, CacheFlight] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self.lock = threading.Lock()
+    
+    def start(self) -> None:
+        if self.store is not None:
+            self.listener.start()
+    
+    def count(self, resource: str, counter: str, n: int = 1) -> None:
+        with self.lock:
+            stats = self.stats.get(resource)
+            if stats is None:
+                stats = self.stats[resource] = dict.fromkeys(CACHE_COUNTERS, 0)
+            stats[counter] += n
+    
+    def get(self, user_id: int, resource: str, load: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        if self.store is None:
+            return load()
+        
+        self.listener.start()
+        if not self.listener.live():
+            # Invalidations could be missed: read through without storing
+            self.count(resource, 'bypassed')
+            return load()
+        
+        key = f'{user_id}:{resource}'
+        started = perf_counter()
+        try:
+            cached = self.store.get(key, time.time())
+        except Exception as e:
+            print(json.dumps({'event': 'cache_store_failed', 'error': str(e)}))
+            cached = None
+        record_phase('cache', started)
+        
+        if cached is None:
+            self.count(resource, 'misses')
+            return self.load(key, resource, load)
+        
+        if random.random() >= CACHE_STALE_SAMPLE_RATE:
+            self.count(resource, 'hits')
+            return json.loads(cached)
+        
+        # Sampled hit: answer from the database and record whether the cache was behind
+        fresh = self.load(key, resource, load)
+        self.count(resource, 'sampled')
+        if json.dumps(fresh) != cached:
+            self.count(resource, 'stale')
+        return fresh
+    
+    def load(self, key: str, resource: str, load: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = CacheFlight()
+        
+        if not leader:
+            self.count(resource, 'coalesced')
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return json.loads(flight.value)
+        
+        loaded_from = time.time()
+        try:
+            result = load()
+            flight.value = json.dumps(result)
+            if 'error' not in result:
+                try:
+                    self.store.set(key, flight.value, loaded_from, loaded_from + CACHE_TTL_SECONDS[resource])
+                except Exception as e:
+                    print(json.dumps({'event': 'cache_store_failed', 'error': str(e)}))
+            return result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.done.set()
+    
+    def invalidate(self, keys: List[Tuple[int, str]]) -> None:
+        '''Drop (user_id, resource) entries after a write that changed them'''
+        if self.store is None or not keys:
+            return
+        try:
+            self.store.invalidate([f'{user_id}:{resource}' for user_id, resource in keys], time.time())
+        except Exception as e:
+            # Entries still expire after their TTL
+            print(json.dumps({'event': 'cache_invalidate_failed', 'error': str(e)}))
+        for _, resource in keys:
+            self.count(resource, 'invalidations')
+    
+    def clear(self) -> None:
+        try:
+            self.store.clear(time.time())
+        except Exception as e:
+            print(json.dumps({'event': 'cache_invalidate_failed', 'error': str(e)}))
+    
+    def report(self) -> Dict[str, Any]:
+        '''Per-resource counters with hit ratio and the stale share of sampled hits'''
+        with self.lock:
+            resources = {resource: dict(stats) for resource, stats in self.stats.items()}
+        for stats in resources.values():
+            lookups = stats['hits'] + stats['misses'] + stats['sampled']
+            stats['hit_ratio'] = round((stats['hits'] + stats['sampled']) / lookups, 4) if lookups else None
+            stats['stale_ratio'] = round(stats['stale'] / stats['sampled'], 4) if stats['sampled'] else None
+        return {'store': CACHE_STORE, 'live': self.listener.live(), 'resources': resources}
+
+read_cache = ReadThroughCache(
+    SqliteCacheStore(CACHE_SQLITE_PATH) if CACHE_STORE == 'sqlite'
+    else LocalCacheStore() if CACHE_STORE == 'local'
+    else None
+)
+# End of the shared read cache block
+
+# Pool, registries and read cache handed between the functions that
+# scripts/gateway.py hosts in one process. Shared block: identical in auth,
+# card, loans and referrals; edit all four (scripts/test_shared_blocks.py).
+_shared_state_lock = threading.Lock()
+
+def shared_state() -> Dict[str, Any]:
+    '''This instance's request-timing local, pool, breakers, registries, read cache and token check'''
+    return {
+        'timing_local': _timing_local,
+        'db_local': _db_local,
+        'db_breakers': db_breakers,
+        'prepared': _prepared,
+        'shard_map': shard_map,
+        'fingerprints': _fingerprints,
+        'query_stats': _query_stats,
+        'query_stats_lock': _query_stats_lock,
+        'unavailable': DatabaseUnavailable,
+        'read_cache': read_cache,
+        'verify_token': verify_token
+    }
+
+def use_shared_state(state: Dict[str, Any]) -> None:
+    '''
+    Switch this instance to another function's shared_state() in one step,
+    before it serves anything: an instance that already connected, ran a
+    statement or started its cache listener refuses, since requests in
+    flight would mix its own state with the shared one. Shared breakers and
+    shard map raise the other function's DatabaseUnavailable, so the
+    handler catches that class from then on.
+    '''
+    global _timing_local, _db_local, db_breakers, _prepared, shard_map, _fingerprints, _query_stats, \
+        _query_stats_lock, DatabaseUnavailable, read_cache, verify_token
+    with _shared_state_lock:
+        if db_breakers or _fingerprints or read_cache.listener.shards is not None:
+            raise RuntimeError('shared state must be set before the first request')
+        _timing_local = state['timing_local']
+        _db_local = state['db_local']
+        db_breakers = state['db_breakers']
+        _prepared = state['prepared']
+        shard_map = state['shard_map']
+        _fingerprints = state['fingerprints']
+        _query_stats = state['query_stats']
+        _query_stats_lock = state['query_stats_lock']
+        DatabaseUnavailable = state['unavailable']
+        read_cache = state['read_cache']
+        verify_token = state['verify_token']
+# End of the shared state block
 
 def verify_token(token: str) -> Optional[Dict[str, Any]]:
     '''Verify JWT token and return payload'''
+    started = perf_counter()
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         return payload
     except:
         return None
+    finally:
+        record_phase('auth', started)
+
+def token_claim(payload: Dict[str, Any], name: str) -> Optional[Any]:
+    '''Identifier claim from a verified token, or None if missing or from another claims version'''
+    if payload.get('cv') != TOKEN_CLAIMS_VERSION:
+        return None
+    return payload.get(name)
+
+def refresh_token(payload: Dict[str, Any], **claims: Any) -> str:
+    '''Re-sign the caller's token with extra identifier claims, keeping its expiry'''
+    if payload.get('cv') != TOKEN_CLAIMS_VERSION:
+        payload = {key: value for key, value in payload.items() if key not in TOKEN_CLAIM_NAMES}
+    return jwt.encode({**payload, **claims, 'cv': TOKEN_CLAIMS_VERSION}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+def luhn_check_digit(digits: str) -> str:
+    '''Compute Luhn check digit for a string of digits'''
+    total = 0
+    for i, ch in enumerate(reversed(digits)):
+        d = int(ch)
+        if i % 2 == 0:
+            d *= 2
+            if d > 9:
+                d -= 9
+        total += d
+    return str((10 - total % 10) % 10)
 
 def generate_card_number() -> str:
-    '''Generate random virtual card number'''
-    # Generate 16-digit card number (not real, just for display)
-    return ''.join([str(secrets.randbelow(10)) for _ in range(16)])
+    '''Generate random Luhn-valid virtual card number'''
+    # Only needed when the card number pool is empty
+    import secrets
+    
+    # BIN prefix + random account digits + check digit = 16 digits (not real, just for display)
+    body = CARD_BIN + str(secrets.randbelow(10 ** (15 - len(CARD_BIN)))).zfill(15 - len(CARD_BIN))
+    return body + luhn_check_digit(body)
+
+def format_card(card: Dict[str, Any]) -> Dict[str, Any]:
+    '''Convert card row to response dict with masked number'''
+    card_dict = dict(card)
+    card_dict['created_at'] = card_dict['created_at'].isoformat()
+    card_dict['balance'] = float(card_dict['balance'])
+    
+    # Mask card number for security (show only last 4 digits)
+    card_dict['card_number_masked'] = '**** **** **** ' + card_dict['card_number'][-4:]
+    return card_dict
 
 def get_or_create_card(user_id: int) -> Dict[str, Any]:
     '''Get existing card or create new one for user'''
-    conn = get_db_connection()
+    conn = get_db_connection(user_id)
     cur = conn.cursor()
     
-    # Check if card exists
-    cur.execute(
-        "SELECT id, card_number, balance, status, created_at FROM virtual_cards WHERE user_id = %s",
-        (user_id,)
-    )
+    # Hot path: the card already exists
+    execute_prepared(cur, 'card_by_user', (user_id,))
     card = cur.fetchone()
     
-    if card:
-        cur.close()
-        conn.close()
-        
-        card_dict = dict(card)
-        card_dict['created_at'] = card_dict['created_at'].isoformat()
-        
-        # Mask card number for security (show only last 4 digits)
-        card_dict['card_number_masked'] = '**** **** **** ' + card_dict['card_number'][-4:]
+    if not card:
+        for _ in range(CARD_ISSUE_ATTEMPTS):
+            # Existing card (if issued concurrently), or a new one with a number claimed from the pool
+            cur.execute(
+                """WITH existing AS (
+                       SELECT id, card_number, balance, status, created_at
+                       FROM virtual_cards WHERE user_id = %(user_id)s
+                   ), claimed AS (
+                       DELETE FROM card_number_pool
+                       WHERE card_number = (
+                           SELECT card_number FROM card_number_pool
+                           WHERE NOT EXISTS (SELECT 1 FROM existing)
+                           LIMIT 1
+                           FOR UPDATE SKIP LOCKED
+                       )
+                       RETURNING card_number
+                   ), inserted AS (
+                       INSERT INTO virtual_cards (user_id, card_number, balance, status, created_at)
+                       SELECT %(user_id)s, card_number, 0, 'active', NOW() FROM claimed
+                       ON CONFLICT (user_id) DO NOTHING
+                       RETURNING id, card_number, balance, status, created_at
+                   )
+                   SELECT * FROM existing
+                   UNION ALL
+                   SELECT * FROM inserted""",
+                {'user_id': user_id}
+            )
+            card = cur.fetchone()
+            if card:
+                break
         
-        return {
-            'success': True,
-            'card': card_dict
-        }
+            # Pool is empty or a concurrent request issued the card first:
+            # roll back so a claimed number goes back to the pool, then try a local number
+            conn.rollback()
+            cur.execute(
+                """INSERT INTO virtual_cards (user_id, card_number, balance, status, created_at) 
+                   VALUES (%s, %s, 0, 'active', NOW()) 
+                   ON CONFLICT DO NOTHING
+                   RETURNING id, card_number, balance, status, created_at""",
+                (user_id, generate_card_number())
+            )
+            card = cur.fetchone()
+            if card:
+                break
+            conn.rollback()
     
-    # Create new card
-    card_number = generate_card_number()
-    
-    cur.execute(
-        """INSERT INTO virtual_cards (user_id, card_number, balance, status, created_at) 
-           VALUES (%s, %s, 0, 'active', NOW()) 
-           RETURNING id, card_number, balance, status, created_at""",
-        (user_id, card_number)
-    )
+    if not card:
+        cur.close()
+        release_db_connection(conn)
+        raise Exception('Не удалось выпустить виртуальную карту')
     
-    new_card = cur.fetchone()
     conn.commit()
     cur.close()
-    conn.close()
-    
-    card_dict = dict(new_card)
-    card_dict['created_at'] = card_dict['created_at'].isoformat()
-    card_dict['card_number_masked'] = '**** **** **** ' + card_number[-4:]
+    release_db_connection(conn)
     
     return {
         'success': True,
-        'card': card_dict
+        'card': format_card(card)
     }
 
-def create_sbp_transfer(user_id: int, phone: str, amount: float, comment: str) -> Dict[str, Any]:
-    '''Create SBP transfer from virtual card'''
-    conn = get_db_connection()
-    cur = conn.cursor()
+def create_sbp_transfer(user_id: int, phone: str, amount: float, comment: str,
+                        card_id: Optional[int] = None) -> Dict[str, Any]:
+    '''Create SBP transfer from virtual card as a ledger debit; card_id is the token's card claim, if any'''
+    if amount <= 0:
+        return {'error': 'Некорректная сумма перевода', 'code': 'INVALID_AMOUNT'}
+    if phone_key(phone) is None:
+        # Checked before reserving: the per-phone limit needs a real number to key on
+        return {'error': 'Некорректный номер телефона', 'code': 'INVALID_PHONE'}
     
-    # Get user's card
-    cur.execute(
-        "SELECT id, balance FROM virtual_cards WHERE user_id = %s AND status = 'active'",
-        (user_id,)
-    )
-    card = cur.fetchone()
+    # Resolved before the debit: the velocity record after commit needs the same shard
+    shard = shard_map.shard_for(user_id)
+    if card_id is None:
+        # Token issued before the card claim: the limit is counted per card id
+        card_id = lookup_card_id(shard, user_id)
+        if card_id is None:
+            return {'error': 'Виртуальная карта не найдена', 'code': 'CARD_NOT_FOUND'}
+    sbp_velocity.start()
+    reservation, exceeded = sbp_velocity.reserve(card_id, phone, amount)
+    if exceeded:
+        return {'error': VELOCITY_LIMIT_BODY, 'code': 'VELOCITY_LIMIT', 'limit': exceeded[0],
+                'retry_after': math.ceil(exceeded[1])}
     
-    if not card:
-        cur.close()
-        conn.close()
-        return {'error': 'Виртуальная карта не найдена', 'code': 'CARD_NOT_FOUND'}
-    
-    # Check balance
-    if card['balance'] < amount:
-        cur.close()
-        conn.close()
-        return {'error': 'Недостаточно средств на карте', 'code': 'INSUFFICIENT_FUNDS'}
-    
-    # Create transaction
-    cur.execute(
-        """INSERT INTO card_transactions 
-           (card_id, type, amount, phone, comment, status, created_at) 
-           VALUES (%s, 'sbp_transfer', %s, %s, %s, 'completed', NOW()) 
-           RETURNING id, created_at""",
-        (card['id'], amount, phone, comment)
-    )
-    
-    transaction = cur.fetchone()
+    try:
+        transaction = debit_sbp_transfer(shard, user_id, phone, amount, comment)
+    except Exception:
+        sbp_velocity.release(reservation)
+        raise
     
-    # Update card balance
-    new_balance = card['balance'] - amount
-    cur.execute(
-        "UPDATE virtual_cards SET balance = %s WHERE id = %s",
-        (new_balance, card['id'])
-    )
+    if 'error' in transaction:
+        sbp_velocity.release(reservation)
+        return transaction
     
-    conn.commit()
-    cur.close()
-    conn.close()
+    try:
+        sbp_velocity.confirm(reservation, shard, transaction['id'])
+    except Exception as e:
+        # The transfer is committed; the ledger sync counts it if this failed
+        print(json.dumps({'event': 'velocity_confirm_failed', 'error': str(e)}))
+    read_cache.invalidate([(user_id, 'card')])
     
     return {
         'success': True,
@@ -139,41 +1365,138 @@ def create_sbp_transfer(user_id: int, phone: str, amount: float, comment: str) -
             'id': transaction['id'],
             'amount': amount,
             'phone': phone,
-            'new_balance': new_balance,
+            'new_balance': float(transaction['new_balance']),
             'created_at': transaction['created_at'].isoformat()
         }
     }
 
-def get_card_transactions(user_id: int, limit: int = 50) -> Dict[str, Any]:
-    '''Get transaction history for user's card'''
-    conn = get_db_connection()
+def lookup_card_id(shard: int, user_id: int) -> Optional[int]:
+    conn = get_shard_connection(shard)
+    cur = conn.cursor()
+    execute_prepared(cur, 'card_id_by_user', (user_id,))
+    card = cur.fetchone()
+    cur.close()
+    release_db_connection(conn)
+    return card['id'] if card else None
+
+def debit_sbp_transfer(shard: int, user_id: int, phone: str, amount: float, comment: str) -> Dict[str, Any]:
+    '''Debit the card, append the ledger entry and its outbox event in one transaction'''
+    conn = get_shard_connection(shard)
     cur = conn.cursor()
     
-    # Get card
     cur.execute(
-        "SELECT id FROM virtual_cards WHERE user_id = %s",
-        (user_id,)
+        """WITH debited AS (
+               UPDATE virtual_cards SET balance = balance - %(amount)s
+               WHERE user_id = %(user_id)s AND status = 'active' AND balance >= %(amount)s
+               RETURNING id, balance
+           ), entry AS (
+               INSERT INTO card_transactions 
+               (card_id, type, amount, signed_amount, phone, comment, status, created_at) 
+               SELECT id, 'sbp_transfer', %(amount)s, -%(amount)s, %(phone)s, %(comment)s, 'completed', NOW()
+               FROM debited
+               RETURNING id, card_id, created_at
+           ), event AS (
+               INSERT INTO outbox_events (event_type, user_id, payload)
+               SELECT 'card.sbp_transfer', %(user_id)s,
+                      jsonb_build_object('transaction_id', id, 'card_id', card_id,
+                                         'amount', %(amount)s, 'phone', %(phone)s)
+               FROM entry
+           )
+           SELECT id, created_at, (SELECT balance FROM debited) AS new_balance
+           FROM entry""",
+        {'user_id': user_id, 'amount': amount, 'phone': phone, 'comment': comment}
     )
-    card = cur.fetchone()
     
-    if not card:
+    transaction = cur.fetchone()
+    
+    if not transaction:
+        conn.rollback()
+        cur.execute(
+            "SELECT id FROM virtual_cards WHERE user_id = %s AND status = 'active'",
+            (user_id,)
+        )
+        card = cur.fetchone()
         cur.close()
-        conn.close()
-        return {'error': 'Виртуальная карта не найдена', 'code': 'CARD_NOT_FOUND'}
+        release_db_connection(conn)
+        
+        if not card:
+            return {'error': 'Виртуальная карта не найдена', 'code': 'CARD_NOT_FOUND'}
+        return {'error': 'Недостаточно средств на карте', 'code': 'INSUFFICIENT_FUNDS'}
+    
+    conn.commit()
+    cur.close()
+    release_db_connection(conn)
+    return transaction
+
+def get_card_balance_at(user_id: int, as_of: datetime) -> Dict[str, Any]:
+    '''Get card balance as of a moment: last snapshot plus ledger entries after it'''
+    conn = get_db_connection(user_id)
+    cur = conn.cursor()
     
-    # Get transactions
     cur.execute(
-        """SELECT id, type, amount, phone, comment, status, created_at 
-           FROM card_transactions 
-           WHERE card_id = %s 
-           ORDER BY created_at DESC 
-           LIMIT %s""",
-        (card['id'], limit)
+        """WITH card AS (
+               SELECT id FROM virtual_cards WHERE user_id = %(user_id)s
+           ), snapshot AS (
+               SELECT s.ledger_position, s.balance
+               FROM card_balance_snapshots s, card
+               WHERE s.card_id = card.id AND s.taken_at <= %(as_of)s
+               ORDER BY s.ledger_position DESC
+               LIMIT 1
+           )
+           SELECT card.id,
+                  COALESCE((SELECT balance FROM snapshot), 0) + COALESCE((
+                      SELECT SUM(t.signed_amount)
+                      FROM card_transactions t
+                      WHERE t.card_id = card.id
+                        AND t.id > COALESCE((SELECT ledger_position FROM snapshot), 0)
+                        AND t.created_at <= %(as_of)s
+                        AND t.status = 'completed'
+                  ), 0) AS balance
+           FROM card""",
+        {'user_id': user_id, 'as_of': as_of}
     )
     
+    card = cur.fetchone()
+    cur.close()
+    release_db_connection(conn)
+    
+    if not card:
+        return {'error': 'Виртуальная карта не найдена', 'code': 'CARD_NOT_FOUND'}
+    
+    return {
+        'success': True,
+        'balance': float(card['balance']),
+        'as_of': as_of.isoformat()
+    }
+
+def history_start(months: int) -> datetime:
+    '''First day of the month that is months before the current one'''
+    now = datetime.now()
+    month_index = now.year * 12 + now.month - 1 - months
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+def get_card_transactions(user_id: int, limit: int = 50, card_id: Optional[int] = None) -> Dict[str, Any]:
+    '''Get transaction history for user's card; card_id from the token skips the card lookup'''
+    conn = get_db_connection(user_id)
+    cur = conn.cursor()
+    
+    # Get card
+    if card_id is None:
+        execute_prepared(cur, 'card_id_by_user', (user_id,))
+        card = cur.fetchone()
+        
+        if not card:
+            cur.close()
+            release_db_connection(conn)
+            return {'error': 'Виртуальная карта не найдена', 'code': 'CARD_NOT_FOUND'}
+        card_id = card['id']
+    
+    # Get transactions; the created_at bound prunes old monthly partitions
+    execute_prepared(cur, 'card_transactions_page', (card_id, history_start(TRANSACTION_HISTORY_MONTHS), limit))
+    
     transactions = cur.fetchall()
     cur.close()
-    conn.close()
+    release_db_connection(conn)
     
     # Convert to list
     trans_list = []
@@ -187,26 +1510,14 @@ def get_card_transactions(user_id: int, limit: int = 50) -> Dict[str, Any]:
         'transactions': trans_list
     }
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+def handle_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     
     # Handle CORS
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return CORS_PREFLIGHT_RESPONSE
     
-    headers = {
-        'Content-Type': 'application/json',
-        'Access-Control-Allow-Origin': '*'
-    }
+    headers = JSON_HEADERS
     
     # Verify authentication
     auth_token = event.get('headers', {}).get('X-Auth-Token') or event.get('headers', {}).get('x-auth-token')
@@ -215,7 +1526,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 401,
             'headers': headers,
-            'body': json.dumps({'error': 'Требуется авторизация'})
+            'body': AUTH_REQUIRED_BODY
         }
     
     payload = verify_token(auth_token)
@@ -223,7 +1534,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 401,
             'headers': headers,
-            'body': json.dumps({'error': 'Недействительный токен'})
+            'body': INVALID_TOKEN_BODY
         }
     
     user_id = payload['user_id']
@@ -234,29 +1545,59 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             # Get transactions
             if params.get('transactions') == 'true':
-                result = get_card_transactions(user_id)
+                result = get_card_transactions(user_id, card_id=token_claim(payload, 'cid'))
+                
+                if 'error' in result:
+                    return {
+                        'statusCode': 404,
+                        'headers': headers,
+                        'body': encode_json(result)
+                    }
+                
+                return {
+                    'statusCode': 200,
+                    'headers': headers,
+                    'body': encode_json(result)
+                }
+            
+            # Get balance as of a moment from the ledger
+            elif params.get('balance_at'):
+                try:
+                    as_of = datetime.fromisoformat(params['balance_at'])
+                except ValueError:
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': encode_json({'error': 'Некорректная дата', 'code': 'INVALID_BALANCE_AT'})
+                    }
+                
+                result = get_card_balance_at(user_id, as_of)
                 
                 if 'error' in result:
                     return {
                         'statusCode': 404,
                         'headers': headers,
-                        'body': json.dumps(result)
+                        'body': encode_json(result)
                     }
                 
                 return {
                     'statusCode': 200,
                     'headers': headers,
-                    'body': json.dumps(result)
+                    'body': encode_json(result)
                 }
             
             # Get card info
             else:
-                result = get_or_create_card(user_id)
+                result = read_cache.get(user_id, 'card', lambda: get_or_create_card(user_id))
+                
+                # Hand out a token carrying the card id so later requests skip the lookup
+                if token_claim(payload, 'cid') != result['card']['id']:
+                    result['token'] = refresh_token(payload, cid=result['card']['id'])
                 
                 return {
                     'statusCode': 200,
                     'headers': headers,
-                    'body': json.dumps(result)
+                    'body': encode_json(result)
                 }
         
         elif method == 'POST':
@@ -268,39 +1609,151 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     user_id=user_id,
                     phone=body.get('phone', ''),
                     amount=float(body.get('amount', 0)),
-                    comment=body.get('comment', '')
+                    comment=body.get('comment', ''),
+                    card_id=token_claim(payload, 'cid')
                 )
                 
+                if result.get('code') == 'VELOCITY_LIMIT':
+                    return {
+                        'statusCode': 429,
+                        'headers': {**headers, 'Retry-After': str(result['retry_after'])},
+                        'body': encode_json(result)
+                    }
+                
                 if 'error' in result:
                     return {
                         'statusCode': 400,
                         'headers': headers,
-                        'body': json.dumps(result)
+                        'body': encode_json(result)
                     }
                 
                 return {
                     'statusCode': 200,
                     'headers': headers,
-                    'body': json.dumps(result)
+                    'body': encode_json(result)
                 }
             
             else:
                 return {
                     'statusCode': 400,
                     'headers': headers,
-                    'body': json.dumps({'error': 'Неизвестное действие'})
+                    'body': encode_json({'error': 'Неизвестное действие'})
                 }
         
         else:
             return {
                 'statusCode': 405,
                 'headers': headers,
-                'body': json.dumps({'error': 'Метод не поддерживается'})
+                'body': encode_json({'error': 'Метод не поддерживается'})
             }
     
+    except DatabaseUnavailable as e:
+        return db_unavailable_response(e.retry_after)
+    
+    except psycopg2.OperationalError:
+        return db_unavailable_response(1)
+    
     except Exception as e:
         return {
             'statusCode': 500,
             'headers': headers,
-            'body': json.dumps({'error': str(e)})
+            'body': encode_json({'error': str(e)})
+        }
+
+def request_action(event: Dict[str, Any]) -> str:
+    '''Action name used for latency histograms'''
+    if event.get('httpMethod') == 'GET':
+        params = event.get('queryStringParameters') or {}
+        if params.get('transactions') == 'true':
+            return 'transactions'
+        if params.get('balance_at'):
+            return 'balance_at'
+        return 'card'
+    try:
+        return str(json.loads(event.get('body') or '{}').get('action'))
+    except (ValueError, AttributeError):
+        return 'unknown'
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    if event.get('httpMethod') == 'OPTIONS':
+        return CORS_PREFLIGHT_RESPONSE
+    
+    params = event.get('queryStringParameters') or {}
+    if params.get('admin'):
+        return admin_action(event, params)
+    
+    started = perf_counter()
+    action = request_action(event)
+    _timing_local.phases = {}
+    _timing_local.request_id = getattr(context, 'request_id', None)
+    _timing_local.action = action
+    try:
+        response = handle_request(event, context)
+    finally:
+        release_probes()
+        phases = _timing_local.phases
+        _timing_local.phases = None
+    total = perf_counter() - started
+    
+    observe_latency(action, total)
+    
+    timings = [
+        f'{name};dur={value[0] * 1000:.3f}' + (f';desc="{value[1]} calls"' if value[1] > 1 else '')
+        for name, value in phases.items()
+    ]
+    timings.append(f'total;dur={total * 1000:.3f}')
+    print(json.dumps({
+        'event': 'request',
+        'request_id': getattr(context, 'request_id', None),
+        'action': action,
+        'status': response.get('statusCode'),
+        'total_ms': round(total * 1000, 3),
+        'phases_ms': {name: round(value[0] * 1000, 3) for name, value in phases.items()}
+    }))
+    
+    return {
+        **response,
+        'headers': {**response.get('headers', {}), 'Server-Timing': ', '.join(timings), 'Timing-Allow-Origin': '*'}
+    }
+# End of the shared handler block
+
+def admin_action(event: Dict[str, Any], params: Dict[str, Any]) -> Dict[str, Any]:
+    '''Instance metrics for requests with a valid X-Admin-Token: ?admin=metrics, ?admin=queries&top=N or ?admin=cache'''
+    headers = event.get('headers') or {}
+    token = headers.get('X-Admin-Token') or headers.get('x-admin-token') or ''
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        return {
+            'statusCode': 403,
+            'headers': JSON_HEADERS,
+            'body': json.dumps({'error': 'Доступ запрещен'})
         }
+    
+    if params['admin'] == 'metrics':
+        result = {'success': True, 'latency': latency_report(), 'velocity': sbp_velocity.report()}
+    elif params['admin'] == 'queries':
+        try:
+            top = int(params.get('top') or QUERY_REPORT_TOP)
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'headers': JSON_HEADERS,
+                'body': json.dumps({'error': 'Некорректный параметр top'})
+            }
+        result = {'success': True, 'queries': query_report(max(1, min(top, QUERY_REPORT_MAX_TOP)))}
+    elif params['admin'] == 'cache':
+        result = {'success': True, 'cache': read_cache.report()}
+    else:
+        return {
+            'statusCode': 400,
+            'headers': JSON_HEADERS,
+            'body': json.dumps({'error': 'Неизвестное действие'})
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': JSON_HEADERS,
+        'body': json.dumps(result)
+    }
+
+if DB_PREWARM:
+    prewarm()
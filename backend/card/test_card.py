@@ -0,0 +1,220 @@
+'''
+Unit tests for the card function: python -m pytest backend/card
+The database is replaced by scripted fake connections; tests.json covers the deployed HTTP contract.
+'''
+
+import json
+import random
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+def luhn_valid(number: str) -> bool:
+    total = 0
+    for i, ch in enumerate(reversed(number)):
+        d = int(ch)
+        if i % 2 == 1:
+            d *= 2
+            if d > 9:
+                d -= 9
+        total += d
+    return total % 10 == 0
+
+@pytest.fixture
+def card(load_function):
+    return load_function('card')
+
+def test_luhn_check_digit_matches_known_numbers(card):
+    assert card.luhn_check_digit('7992739871') == '3'
+    assert card.luhn_check_digit('453201511283036') == '6'
+
+def test_generated_card_numbers_are_luhn_valid(card):
+    for _ in range(200):
+        number = card.generate_card_number()
+        
+        assert len(number) == 16 and number.isdigit()
+        assert number.startswith(card.CARD_BIN)
+        assert luhn_valid(number)
+
+def get_event(params):
+    return {'httpMethod': 'GET', 'headers': {'X-Auth-Token': 'token'}, 'queryStringParameters': params}
+
+def test_balance_at_parses_the_moment(card, monkeypatch):
+    monkeypatch.setattr(card, 'verify_token', lambda token: {'user_id': 1})
+    seen = []
+    monkeypatch.setattr(card, 'get_card_balance_at',
+                        lambda user_id, as_of: seen.append(as_of) or {'success': True, 'balance': 0.0})
+    
+    response = card.handle_request(get_event({'balance_at': '2026-01-01T12:30:00'}), None)
+    
+    assert response['statusCode'] == 200
+    assert seen[0].isoformat() == '2026-01-01T12:30:00'
+
+def test_malformed_balance_at_is_a_400(card, monkeypatch):
+    monkeypatch.setattr(card, 'verify_token', lambda token: {'user_id': 1})
+    monkeypatch.setattr(card, 'get_db_connection', lambda user_id=None: pytest.fail('database touched'))
+    
+    response = card.handle_request(get_event({'balance_at': 'yesterday'}), None)
+    
+    assert response['statusCode'] == 400
+    assert '"INVALID_BALANCE_AT"' in response['body']
+
+@pytest.fixture
+def velocity(card, monkeypatch):
+    '''A fresh limiter without the background ledger sync'''
+    limiter = card.VelocityLimiter()
+    monkeypatch.setattr(limiter, 'start', lambda: None)
+    monkeypatch.setattr(card, 'sbp_velocity', limiter)
+    return limiter
+
+def transfer_event(phone, amount):
+    return {'httpMethod': 'POST', 'headers': {'X-Auth-Token': 'token'},
+            'body': json.dumps({'action': 'sbp_transfer', 'phone': phone, 'amount': amount, 'comment': ''})}
+
+def test_sliding_window_forgets_slots_that_leave_the_window(card):
+    window = card.SlidingWindow(width=5, slots=12)
+    window.add(1000.0, 1, 100.0)
+    window.add(1030.0, 2, 50.0)
+    window.add(1010.0, 1, 10.0)
+    
+    assert window.totals(1040.0) == (4, 160.0)
+    assert window.totals(1061.0) == (3, 60.0)
+    assert window.totals(1100.0) == (0, 0.0)
+
+def test_reservations_count_against_the_limit_until_released(card, velocity):
+    reservations = [velocity.reserve(1, f'+7900000000{i}', 100)[0] for i in range(3)]
+    
+    reservation, exceeded = velocity.reserve(1, '+79000000009', 100)
+    assert reservation is None and exceeded[0] == 'card:minute'
+    assert 0 < exceeded[1] <= card.VELOCITY_WINDOWS[0][1]
+    
+    velocity.release(reservations[0])
+    assert velocity.reserve(1, '+79000000009', 100)[0] is not None
+
+def test_concurrent_reservations_cannot_overshoot(card, velocity):
+    barrier = threading.Barrier(8)
+    results = []
+    
+    def attempt(i):
+        barrier.wait()
+        results.append(velocity.reserve(7, f'+7911000000{i}', 100)[0])
+    
+    threads = [threading.Thread(target=attempt, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert sum(r is not None for r in results) == card.VELOCITY_LIMITS['card']['minute'][0]
+
+def test_confirm_after_the_sync_counted_the_row_does_not_double_count(card, velocity):
+    reservation, _ = velocity.reserve(1, '+79000000001', 100)
+    velocity.seen[(0, 55)] = time.time()
+    
+    velocity.confirm(reservation, 0, 55)
+    
+    assert velocity.counters['card:1'].windows[0].totals(time.time()) == (0, 0.0)
+
+def test_failed_transfers_release_their_reservation(card, velocity, monkeypatch):
+    monkeypatch.setattr(card, 'debit_sbp_transfer', lambda *args: {'error': 'Недостаточно средств на карте',
+                                                                   'code': 'INSUFFICIENT_FUNDS'})
+    for _ in range(5):
+        assert card.create_sbp_transfer(1, '+79000000001', 100, '', card_id=1)['code'] == 'INSUFFICIENT_FUNDS'
+    
+    def broken(*args):
+        raise card.psycopg2.OperationalError('server closed the connection')
+    
+    monkeypatch.setattr(card, 'debit_sbp_transfer', broken)
+    with pytest.raises(card.psycopg2.OperationalError):
+        card.create_sbp_transfer(1, '+79000000001', 100, '', card_id=1)
+    
+    assert velocity.counters['card:1'].windows[0].totals(time.time()) == (0, 0.0)
+
+def test_committed_transfer_survives_a_failing_velocity_confirm(card, velocity, monkeypatch):
+    monkeypatch.setattr(card, 'debit_sbp_transfer', lambda *args: {
+        'id': 55, 'created_at': datetime(2026, 1, 1), 'new_balance': Decimal('900.00')})
+    
+    def broken(*args):
+        raise RuntimeError('counter store broken')
+    
+    monkeypatch.setattr(velocity, 'confirm', broken)
+    
+    result = card.create_sbp_transfer(1, '+79000000001', 100, '', card_id=1)
+    
+    assert result['success'] and result['transaction']['new_balance'] == 900.0
+
+def test_transfer_without_a_phone_number_is_rejected_before_reserving(card, velocity, monkeypatch):
+    monkeypatch.setattr(card, 'verify_token', lambda token: {'user_id': 1})
+    monkeypatch.setattr(card, 'debit_sbp_transfer', lambda *args: pytest.fail('debited'))
+    
+    responses = [card.handle_request(transfer_event(phone, 100), None) for phone in ('', '  ', '+7 (900)', None)]
+    
+    assert [r['statusCode'] for r in responses] == [400] * 4
+    assert all(json.loads(r['body'])['code'] == 'INVALID_PHONE' for r in responses)
+    assert not velocity.counters
+
+def test_ledger_rows_without_a_phone_count_only_against_the_card(card, velocity):
+    velocity._add(1, '', time.time(), 1, 100)
+    
+    assert list(velocity.counters) == ['card:1']
+    assert card.phone_key('8 (900) 000-00-01') == card.phone_key('+79000000001') == 'phone:9000000001'
+
+def test_fourth_transfer_in_a_minute_is_a_429(card, velocity, monkeypatch):
+    monkeypatch.setattr(card, 'verify_token', lambda token: {'user_id': 1, 'cid': 5, 'cv': card.TOKEN_CLAIMS_VERSION})
+    monkeypatch.setattr(card, 'debit_sbp_transfer', lambda *args: {
+        'id': random.randrange(10 ** 9), 'created_at': datetime(2026, 1, 1), 'new_balance': Decimal('900.00')})
+    
+    statuses = [card.handle_request(transfer_event(f'+7900000000{i}', 100), None)['statusCode'] for i in range(4)]
+    
+    assert statuses == [200, 200, 200, 429]
+    assert 'card:5' in velocity.counters
+
+def test_token_without_card_claim_counts_the_card_it_looks_up(card, velocity, monkeypatch):
+    lookups = []
+    monkeypatch.setattr(card, 'lookup_card_id', lambda shard, user_id: lookups.append(user_id) or 5)
+    monkeypatch.setattr(card, 'debit_sbp_transfer', lambda *args: {
+        'id': 55, 'created_at': datetime(2026, 1, 1), 'new_balance': Decimal('900.00')})
+    
+    assert card.create_sbp_transfer(1, '+79000000001', 100, '')['success']
+    
+    assert lookups == [1] and 'card:5' in velocity.counters
+    monkeypatch.setattr(card, 'lookup_card_id', lambda shard, user_id: None)
+    assert card.create_sbp_transfer(2, '+79000000001', 100, '')['code'] == 'CARD_NOT_FOUND'
+
+def test_rebuild_adds_the_ledger_oldest_first_and_skips_reserved_rows(card, velocity, monkeypatch, fake_connection):
+    rows = [{'id': 1, 'card_id': 7, 'phone': '+79000000001', 'amount': 100.0, 'age': -7200.0},
+            {'id': 2, 'card_id': 8, 'phone': '+79000000002', 'amount': 50.0, 'age': -20.0},
+            {'id': 3, 'card_id': 7, 'phone': '+79000000002', 'amount': 25.0, 'age': -10.0}]
+    conn = fake_connection([rows])
+    monkeypatch.setattr(card, 'get_shard_connection', lambda shard: conn)
+    monkeypatch.setattr(card, 'release_db_connection', lambda conn: None)
+    # This instance already counted transaction 3 when it reserved it
+    velocity.seen[(0, 3)] = time.time()
+    
+    velocity.rebuild()
+    
+    assert 'ORDER BY created_at' in conn.cur.queries[0] and 'JOIN' not in conn.cur.queries[0]
+    assert list(velocity.counters) == ['card:7', 'phone:9000000001', 'card:8', 'phone:9000000002']
+    assert velocity.counters['card:7'].windows[2].totals(time.time()) == (1, 100.0)
+    assert set(velocity.seen) == {(0, 2), (0, 3)}
+
+def test_second_card_read_is_a_cache_hit(card, monkeypatch, listening):
+    listening(card)
+    monkeypatch.setattr(card, 'CACHE_STALE_SAMPLE_RATE', 0.0)
+    monkeypatch.setattr(card, 'verify_token', lambda token: {'user_id': 1, 'cid': 5})
+    row = {'id': 5, 'card_number': '2200701234567890', 'balance': Decimal('1250.50'), 'status': 'active',
+           'created_at': datetime(2026, 1, 2, 3, 4, 5)}
+    loads = []
+    monkeypatch.setattr(card, 'get_or_create_card',
+                        lambda user_id: loads.append(user_id) or {'success': True, 'card': card.format_card(row)})
+    
+    first = card.handle_request(get_event(None), None)
+    second = card.handle_request(get_event(None), None)
+    
+    assert first['statusCode'] == second['statusCode'] == 200
+    assert second['body'] == first['body']
+    assert json.loads(first['body'])['card']['balance'] == 1250.5
+    assert loads == [1]
@@ -0,0 +1,101 @@
+'''
+Fixtures shared by the backend function tests: python -m pytest backend
+Functions are imported from their index.py with a test database URL; the
+database itself is replaced by scripted fake connections.
+'''
+
+import importlib.util
+import os
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class FakeCursor:
+    '''Cursor returning scripted rows per execute; an exception in the script is raised instead'''
+    
+    def __init__(self, script):
+        self.script = list(script)
+        self.queries = []
+        self.rows = []
+    
+    def execute(self, query, vars=None):
+        self.queries.append(query)
+        outcome = self.script.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        self.rows = outcome
+    
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+    
+    def fetchall(self):
+        return self.rows
+    
+    def __iter__(self):
+        return iter(self.rows)
+    
+    def close(self):
+        pass
+
+class FakeConnection:
+    closed = False
+    
+    def __init__(self, script):
+        self.cur = FakeCursor(script)
+        self.commits = 0
+        self.rollbacks = 0
+    
+    def cursor(self, name=None):
+        return self.cur
+    
+    def commit(self):
+        self.commits += 1
+    
+    def rollback(self):
+        self.rollbacks += 1
+    
+    def get_backend_pid(self):
+        return 4242
+
+@pytest.fixture
+def load_function(monkeypatch):
+    '''Import backend/<name>/index.py under its own module name against a single test database'''
+    monkeypatch.setenv('DATABASE_URL', 'postgresql://test/test')
+    monkeypatch.delenv('DATABASE_SHARDS', raising=False)
+    monkeypatch.delenv('DB_PREWARM', raising=False)
+    
+    def load(name):
+        spec = importlib.util.spec_from_file_location(f'{name}_index_under_test',
+                                                      os.path.join(BACKEND_DIR, name, 'index.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module._timing_local.phases = None
+        return module
+    
+    return load
+
+@pytest.fixture
+def fake_connection():
+    '''FakeConnection(script): a connection whose executes return the scripted rows in order'''
+    return FakeConnection
+
+@pytest.fixture
+def use_connection(monkeypatch):
+    '''Route a function's get_db_connection to a new scripted FakeConnection and return it'''
+    def use(module, script):
+        conn = FakeConnection(script)
+        monkeypatch.setattr(module, 'get_db_connection', lambda user_id=None: conn)
+        monkeypatch.setattr(module, 'release_db_connection', lambda conn: None)
+        return conn
+    
+    return use
+
+@pytest.fixture
+def listening():
+    '''Mark a function's read cache as listening on every shard without starting the LISTEN threads'''
+    def listen(module):
+        module.read_cache.listener.shards = 1
+        module.read_cache.listener.listening.add(0)
+    
+    return listen
@@ -0,0 +1,28 @@
+'''
+Unit tests for the loans function: python -m pytest backend/loans
+The database is replaced by scripted fake connections; tests.json covers the deployed HTTP contract.
+'''
+
+import pytest
+
+@pytest.fixture
+def loans(load_function):
+    return load_function('loans')
+
+def test_change_notification_drops_the_cached_stats(loans, monkeypatch, listening):
+    listening(loans)
+    monkeypatch.setattr(loans, 'CACHE_STALE_SAMPLE_RATE', 0.0)
+    loads = []
+    
+    def load():
+        loads.append(1)
+        return {'success': True, 'stats': {'active_loans': len(loads)}}
+    
+    assert loans.read_cache.get(3, 'loan_stats', load)['stats']['active_loans'] == 1
+    assert loans.read_cache.get(3, 'loan_stats', load)['stats']['active_loans'] == 1
+    
+    # Another instance approved a loan for user 3; a card change of user 3 leaves the stats alone
+    loans.read_cache.listener.dispatch('{"user_id": 3, "resource": "card"}')
+    assert loans.read_cache.get(3, 'loan_stats', load)['stats']['active_loans'] == 1
+    loans.read_cache.listener.dispatch('{"user_id": 3, "resource": "loans"}')
+    assert loans.read_cache.get(3, 'loan_stats', load)['stats']['active_loans'] == 2
@@ -7,71 +7,1017 @@ Returns: HTTP response dict with referral data or error
 
 import json
 import os
-from typing import Dict, Any, Optional
+import re
+import threading
+import time
+import math
+import random
+import hmac
+from collections import OrderedDict
+from datetime import datetime
+from time import perf_counter
+from typing import Dict, Any, Optional, Tuple, List, Callable
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 import jwt
 
 JWT_SECRET = os.environ.get('JWT_SECRET', 'labubu-finance-secret-key-2024')
 JWT_ALGORITHM = 'HS256'
+# Must match backend/auth/index.py: tokens of another claims version fall back to the database
+TOKEN_CLAIMS_VERSION = 1
 
-def get_db_connection():
-    '''Get database connection using DATABASE_URL'''
+# Responses that do not depend on the request, built once per instance
+CORS_PREFLIGHT_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': ''
+}
+JSON_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*'
+}
+AUTH_REQUIRED_BODY = json.dumps({'error': 'Требуется авторизация'})
+INVALID_TOKEN_BODY = json.dumps({'error': 'Недействительный токен'})
+
+# Referral list and bonus history are served in keyset pages, newest first
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+# Cursor of the first page: after every (created_at, id)
+FIRST_PAGE_CURSOR = (datetime.max, 2 ** 31 - 1)
+
+# Open the database connection at import time instead of on the first request
+DB_PREWARM = os.environ.get('DB_PREWARM') == '1'
+
+# Per-request phase timings: Server-Timing header, log line and per-action histograms.
+# This and every other block closed by an '# End of the shared ... block' line
+# is identical in auth, card, loans and referrals; edit all four (scripts/test_shared_blocks.py).
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_timing_local = threading.local()
+_latency_histograms: Dict[str, List[float]] = {}
+_histograms_lock = threading.Lock()
+
+def record_phase(name: str, started: float) -> None:
+    '''Add the time since started to a phase of the current request'''
+    phases = getattr(_timing_local, 'phases', None)
+    if phases is not None:
+        entry = phases.get(name)
+        if entry is None:
+            phases[name] = [perf_counter() - started, 1]
+        else:
+            entry[0] += perf_counter() - started
+            entry[1] += 1
+
+def observe_latency(action: str, seconds: float) -> None:
+    '''Count a request in its action's latency histogram'''
+    ms = seconds * 1000
+    index = len(LATENCY_BUCKETS_MS)
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if ms <= bound:
+            index = i
+            break
+    with _histograms_lock:
+        histogram = _latency_histograms.get(action)
+        if histogram is None:
+            # bucket counts, then +Inf bucket, request count and total ms
+            histogram = _latency_histograms[action] = [0] * (len(LATENCY_BUCKETS_MS) + 3)
+        histogram[index] += 1
+        histogram[-2] += 1
+        histogram[-1] += ms
+
+def latency_report() -> Dict[str, Any]:
+    '''Histograms with approximate percentiles (bucket upper bounds) per action'''
+    bounds = [str(b) for b in LATENCY_BUCKETS_MS] + ['+Inf']
+    report = {}
+    with _histograms_lock:
+        snapshot = {action: list(h) for action, h in _latency_histograms.items()}
+    for action, histogram in snapshot.items():
+        count = histogram[-2]
+        percentiles = {}
+        for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            seen = 0
+            for bound, bucket in zip(bounds, histogram):
+                seen += bucket
+                if seen >= q * count:
+                    percentiles[name] = bound
+                    break
+        report[action] = {
+            'count': count,
+            'mean_ms': round(histogram[-1] / count, 3),
+            'buckets_ms': dict(zip(bounds, histogram[:len(bounds)])),
+            **percentiles
+        }
+    return report
+
+def encode_json(data: Any) -> str:
+    '''Serialize response body, timed as the encode phase'''
+    started = perf_counter()
+    body = json.dumps(data)
+    record_phase('encode', started)
+    return body
+
+# SQL fingerprints: per normalized statement call count, total/max latency and rows
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+FINGERPRINT_CACHE_SIZE = 1000
+QUERY_REPORT_TOP = 20  # fingerprints in ?admin=queries by default
+QUERY_REPORT_MAX_TOP = 200
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s|\$\d+")
+_SQL_IN_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_fingerprints: Dict[str, str] = {}
+_query_stats: Dict[str, List[float]] = {}
+_query_stats_lock = threading.Lock()
+
+def fingerprint_sql(query: str) -> str:
+    '''Normalize a statement: literals and placeholders become ?, whitespace is collapsed'''
+    fingerprint = _fingerprints.get(query)
+    if fingerprint is None:
+        fingerprint = _SQL_IN_LISTS.sub('(?)', _SQL_LITERALS.sub('?', ' '.join(query.split())))
+        if len(_fingerprints) >= FINGERPRINT_CACHE_SIZE:
+            _fingerprints.clear()
+        _fingerprints[query] = fingerprint
+    return fingerprint
+
+def redact_params(vars: Any) -> Any:
+    '''Replace parameter values with their types for logging'''
+    if vars is None:
+        return None
+    if isinstance(vars, dict):
+        return {key: type(value).__name__ for key, value in vars.items()}
+    return [type(value).__name__ for value in vars]
+
+def query_report(top: int) -> List[Dict[str, Any]]:
+    '''Fingerprints of this instance ordered by total time'''
+    with _query_stats_lock:
+        snapshot = [(fingerprint, list(stats)) for fingerprint, stats in _query_stats.items()]
+    snapshot.sort(key=lambda item: -item[1][1])
+    return [{
+        'fingerprint': fingerprint,
+        'calls': int(stats[0]),
+        'total_ms': round(stats[1] * 1000, 3),
+        'mean_ms': round(stats[1] * 1000 / stats[0], 3),
+        'max_ms': round(stats[2] * 1000, 3),
+        'rows': int(stats[3])
+    } for fingerprint, stats in snapshot[:top]]
+
+class InstrumentedCursor(RealDictCursor):
+    '''
+    RealDictCursor that adds every execute to the db phase of the current
+    request, aggregates it under its SQL fingerprint and logs slow statements
+    '''
+    
+    def execute(self, query, vars=None):
+        started = perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except psycopg2.OperationalError:
+            # Lost connections and statement timeouts both count against the database
+            self.connection.breaker.failure()
+            raise
+        except psycopg2.Error:
+            # Constraint, data and syntax errors are answers: the database is up
+            self.connection.breaker.success()
+            raise
+        else:
+            self.connection.breaker.success()
+            return result
+        finally:
+            elapsed = perf_counter() - started
+            record_phase('db', started)
+            fingerprint = fingerprint_sql(query)
+            rows = max(self.rowcount, 0)
+            with _query_stats_lock:
+                stats = _query_stats.get(fingerprint)
+                if stats is None:
+                    _query_stats[fingerprint] = [1, elapsed, elapsed, rows]
+                else:
+                    stats[0] += 1
+                    stats[1] += elapsed
+                    stats[3] += rows
+                    if elapsed > stats[2]:
+                        stats[2] = elapsed
+            if elapsed * 1000 >= SLOW_QUERY_MS:
+                print(json.dumps({
+                    'event': 'slow_query',
+                    'request_id': getattr(_timing_local, 'request_id', None),
+                    'fingerprint': fingerprint,
+                    'ms': round(elapsed * 1000, 3),
+                    'rows': rows,
+                    'params': redact_params(vars)
+                }))
+# End of the shared instrumentation block
+
+# Slower actions of this function; the rest run under DEFAULT_STATEMENT_TIMEOUT_MS
+STATEMENT_TIMEOUTS_MS = {'stats': 2000, 'list': 5000, 'bonuses': 5000}
+
+# Fail fast while the database is slow or down instead of piling requests up
+DB_CONNECT_TIMEOUT_SECONDS = int(os.environ.get('DB_CONNECT_TIMEOUT_SECONDS', '2'))
+DEFAULT_STATEMENT_TIMEOUT_MS = 3000
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN_SECONDS = 10
+# A probe that reports nothing within its connect and statement timeouts is presumed lost
+BREAKER_PROBE_TIMEOUT_SECONDS = DB_CONNECT_TIMEOUT_SECONDS + max(DEFAULT_STATEMENT_TIMEOUT_MS, *STATEMENT_TIMEOUTS_MS.values()) / 1000
+DB_UNAVAILABLE_BODY = json.dumps({'error': 'Сервис временно недоступен, попробуйте позже', 'code': 'DB_UNAVAILABLE'})
+
+class DatabaseUnavailable(Exception):
+    '''Raised instead of connecting while the circuit breaker is open'''
+    
+    def __init__(self, retry_after: float):
+        super().__init__('Database unavailable')
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    '''
+    Closed: requests pass, consecutive failures are counted.
+    Open: requests are rejected until the cooldown ends.
+    Half-open: a single probe request passes; its outcome closes or reopens the breaker.
+    A probe that ends without an outcome frees the slot (release_probe), and
+    one still silent after probe_timeout is replaced by the next request.
+    '''
+    
+    def __init__(self, threshold: int, cooldown: float, probe_timeout: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_owner: Optional[int] = None
+        self.probe_started = 0.0
+        self.lock = threading.Lock()
+    
+    def check(self) -> None:
+        '''Raise DatabaseUnavailable unless a request may use the database now'''
+        if self.state == 'closed':
+            return
+        with self.lock:
+            now = time.monotonic()
+            if self.state == 'open':
+                remaining = self.opened_at + self.cooldown - now
+                if remaining > 0:
+                    raise DatabaseUnavailable(remaining)
+            elif self.probe_owner == threading.get_ident():
+                # The probe opening another connection to the same database
+                return
+            elif now - self.probe_started < self.probe_timeout:
+                # A probe is already in flight
+                raise DatabaseUnavailable(self.probe_started + self.probe_timeout - now)
+            self.state = 'half-open'
+            self.probe_owner = threading.get_ident()
+            self.probe_started = now
+    
+    def success(self) -> None:
+        if self.state == 'closed' and not self.failures:
+            return
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.probe_owner = None
+    
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.probe_owner = None
+    
+    def release_probe(self) -> None:
+        '''End of a request: a probe it held without an outcome lets the next request probe at once'''
+        if self.probe_owner != threading.get_ident():
+            return
+        with self.lock:
+            if self.state == 'half-open' and self.probe_owner == threading.get_ident():
+                self.state = 'open'
+                self.opened_at = time.monotonic() - self.cooldown
+                self.probe_owner = None
+
+def db_unavailable_response(retry_after: float) -> Dict[str, Any]:
+    return {
+        'statusCode': 503,
+        'headers': {**JSON_HEADERS, 'Retry-After': str(max(1, math.ceil(retry_after)))},
+        'body': DB_UNAVAILABLE_BODY
+    }
+
+# User-id sharding: DATABASE_SHARDS is a JSON list of shard DSNs; unset means a
+# single database at DATABASE_URL. Users are routed by bucket (user_id % SHARD_BUCKETS)
+# through the shard_buckets map, and emails, referral codes and user ids are
+# allocated in the directory database (DATABASE_DIRECTORY_URL, default the first shard)
+DATABASE_SHARDS: List[str] = json.loads(os.environ.get('DATABASE_SHARDS') or '[]')
+SHARD_BUCKETS = 1024
+SHARD_MAP_TTL_SECONDS = 30
+
+def shard_urls() -> List[str]:
+    '''DSN of every shard; just DATABASE_URL when sharding is off'''
+    if DATABASE_SHARDS:
+        return DATABASE_SHARDS
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
         raise Exception('DATABASE_URL not found in environment')
-    return psycopg2.connect(database_url, cursor_factory=RealDictCursor)
+    return [database_url]
+
+def directory_url() -> str:
+    return os.environ.get('DATABASE_DIRECTORY_URL') or shard_urls()[0]
+
+class ShardMap:
+    '''
+    Bucket to shard routing, loaded from the directory's shard_buckets and
+    cached for SHARD_MAP_TTL_SECONDS. Buckets without a row live on shard 0;
+    buckets being moved by scripts/shard_rebalance.py are frozen and their
+    users get 503 until the move switches them to the new shard.
+    '''
+    
+    def __init__(self):
+        self.buckets: Optional[List[Optional[int]]] = None
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+    
+    def shard_for(self, user_id: int) -> int:
+        if not DATABASE_SHARDS:
+            return 0
+        if self.buckets is None or time.monotonic() - self.loaded_at > SHARD_MAP_TTL_SECONDS:
+            with self.lock:
+                if self.buckets is None or time.monotonic() - self.loaded_at > SHARD_MAP_TTL_SECONDS:
+                    self.buckets = self.load()
+                    self.loaded_at = time.monotonic()
+        shard = self.buckets[user_id % SHARD_BUCKETS]
+        if shard is None:
+            raise DatabaseUnavailable(SHARD_MAP_TTL_SECONDS)
+        return shard
+    
+    def load(self) -> List[Optional[int]]:
+        buckets: List[Optional[int]] = [0] * SHARD_BUCKETS
+        conn = get_directory_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT bucket, shard, moving FROM shard_buckets")
+        for row in cur.fetchall():
+            buckets[row['bucket']] = None if row['moving'] else row['shard']
+        cur.close()
+        release_db_connection(conn)
+        return buckets
+
+shard_map = ShardMap()
+
+class BreakerConnection(psycopg2.extensions.connection):
+    '''Connection carrying the circuit breaker of the database it points at'''
+    breaker: CircuitBreaker
+
+# Connections are per thread, so prewarm() at import time only warms the
+# importing thread. Every other thread warms lazily: its first connection to a
+# database prepares the hot statements as it opens. The gateway runs prewarm()
+# in each worker thread as it starts.
+_db_local = threading.local()
+db_breakers: Dict[str, CircuitBreaker] = {}
+
+def connect_pooled(database_url: str):
+    '''Get this instance's pooled connection to database_url, reconnecting if it was closed'''
+    started = perf_counter()
+    breaker = db_breakers.get(database_url)
+    if breaker is None:
+        breaker = db_breakers.setdefault(database_url, CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN_SECONDS,
+                                                                      BREAKER_PROBE_TIMEOUT_SECONDS))
+    breaker.check()
+    timeout_ms = STATEMENT_TIMEOUTS_MS.get(getattr(_timing_local, 'action', None), DEFAULT_STATEMENT_TIMEOUT_MS)
+    
+    conns = getattr(_db_local, 'conns', None)
+    if conns is None:
+        conns = _db_local.conns = {}
+        _db_local.statement_timeouts = {}
+    conn = conns.get(database_url)
+    if conn is None or conn.closed:
+        if conn is not None:
+            _prepared.pop(id(conn), None)
+        try:
+            conn = psycopg2.connect(
+                database_url,
+                connection_factory=BreakerConnection,
+                cursor_factory=InstrumentedCursor,
+                connect_timeout=DB_CONNECT_TIMEOUT_SECONDS,
+                options=f'-c statement_timeout={timeout_ms}'
+            )
+        except psycopg2.OperationalError:
+            breaker.failure()
+            raise
+        conn.breaker = breaker
+        conns[database_url] = conn
+        _db_local.statement_timeouts[database_url] = timeout_ms
+        prepare_statements(conn)
+    elif conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+    
+    # Only pay for a SET when the action's timeout differs from the session's
+    if _db_local.statement_timeouts[database_url] != timeout_ms:
+        cur = conn.cursor()
+        cur.execute("SET statement_timeout = %s", (timeout_ms,))
+        cur.close()
+        conn.commit()
+        _db_local.statement_timeouts[database_url] = timeout_ms
+    
+    record_phase('db-acquire', started)
+    return conn
+
+def get_db_connection(user_id: Optional[int] = None):
+    '''Get the pooled connection to the shard owning user_id, or to the directory when user_id is None'''
+    if user_id is None:
+        return get_directory_connection()
+    return connect_pooled(shard_urls()[shard_map.shard_for(user_id)])
+
+def get_shard_connection(shard: int):
+    return connect_pooled(shard_urls()[shard])
+
+def get_directory_connection():
+    return connect_pooled(directory_url())
+
+def release_probes() -> None:
+    '''Free the probe slots this thread holds; runs after every request'''
+    for breaker in list(db_breakers.values()):
+        breaker.release_probe()
+
+def release_db_connection(conn) -> None:
+    '''Return connection to the pool, discarding any unfinished transaction'''
+    if not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+# End of the shared connection pool block
+
+# Hot read-only statements, prepared once per pooled connection and executed by name
+PREPARED_STATEMENTS = {
+    'user_referral_code': "SELECT referral_code FROM users WHERE id = $1",
+    'referral_count': "SELECT COUNT(*) as count FROM users WHERE referred_by = $1",
+    'referral_bonus_total': "SELECT COALESCE(SUM(amount), 0) as total FROM referral_bonuses WHERE user_id = $1",
+    'referral_bonus_available': "SELECT COALESCE(SUM(amount), 0) as available FROM referral_bonuses WHERE user_id = $1 AND status = 'available'",
+    'referral_list': """SELECT u.id, u.name, u.email, u.created_at,
+           COALESCE(
+           (SELECT SUM(l.amount) FROM loans l WHERE l.user_id = u.id AND l.status = 'repaid'),
+           0
+           ) as total_loans
+           FROM users u
+           WHERE u.referred_by = $1 AND (u.created_at, u.id) < ($2, $3)
+           ORDER BY u.created_at DESC, u.id DESC
+           LIMIT $4""",
+    'bonus_history': """SELECT rb.id, rb.amount, rb.status, rb.source, rb.created_at, rb.referred_user_id,
+           u.name as referral_name, u.email as referral_email
+           FROM referral_bonuses rb
+           LEFT JOIN users u ON rb.referred_user_id = u.id
+           WHERE rb.user_id = $1 AND (rb.created_at, rb.id) < ($2, $3)
+           ORDER BY rb.created_at DESC, rb.id DESC
+           LIMIT $4"""
+}
+
+# Names prepared on each pooled connection, by id(conn), with the server pid they were prepared in
+_prepared: Dict[int, Tuple[int, set]] = {}
+
+def prepared_names(conn) -> set:
+    '''Names already prepared on this connection, reset when the server session changed'''
+    pid = conn.get_backend_pid()
+    entry = _prepared.get(id(conn))
+    if entry is None or entry[0] != pid:
+        entry = (pid, set())
+        _prepared[id(conn)] = entry
+    return entry[1]
+
+def execute_prepared(cur, name: str, params: tuple = ()) -> None:
+    '''Execute a statement from PREPARED_STATEMENTS by name, preparing it on first use per connection'''
+    conn = cur.connection
+    for attempt in range(2):
+        prepared = prepared_names(conn)
+        try:
+            if name not in prepared:
+                cur.execute(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}')
+                prepared.add(name)
+            cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+            return
+        except psycopg2.Error as e:
+            # Registered statements are read-only, so rolling back loses nothing
+            if attempt or e.pgcode not in ('26000', '42P05'):
+                raise
+            conn.rollback()
+            if e.pgcode == '26000':
+                # Statement is gone: the server session was recycled
+                prepared.clear()
+            else:
+                # Already prepared on this session by an earlier owner of the connection
+                prepared.add(name)
+
+def prepare_statements(conn) -> None:
+    '''Prepare the hot statements missing on a connection in one round trip; execute_prepared retries any that fail'''
+    prepared = prepared_names(conn)
+    missing = [name for name in PREPARED_STATEMENTS if name not in prepared]
+    if not missing:
+        return
+    cur = conn.cursor()
+    try:
+        cur.execute('; '.join(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}' for name in missing))
+        conn.commit()
+        prepared.update(missing)
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(json.dumps({'event': 'prepare_failed', 'error': str(e)}))
+    finally:
+        cur.close()
+# End of the shared prepared statements block
+
+def prewarm() -> None:
+    '''Open this thread's pooled shard connections, prepare hot statements and start the read cache listener before the first invocation'''
+    try:
+        for shard in range(len(shard_urls())):
+            conn = get_shard_connection(shard)
+            release_db_connection(conn)
+        read_cache.start()
+    except Exception as e:
+        print(json.dumps({'event': 'prewarm_failed', 'error': str(e)}))
+
+SHARD_FANOUT_WORKERS = 8
+_fanout_pool = None
+
+def fan_out(query_shard: Callable[[int], Any]) -> List[Any]:
+    '''Run query_shard(shard) on every shard in parallel and return the results in shard order'''
+    shards = range(len(shard_urls()))
+    if len(shards) == 1:
+        return [query_shard(0)]
+    
+    global _fanout_pool
+    if _fanout_pool is None:
+        # Only sharded deployments pay for the executor import
+        from concurrent.futures import ThreadPoolExecutor
+        _fanout_pool = ThreadPoolExecutor(max_workers=SHARD_FANOUT_WORKERS, thread_name_prefix='fanout')
+    
+    # Worker threads use the request's statement timeout on their own pooled connections
+    action = getattr(_timing_local, 'action', None)
+    def run(shard: int) -> Any:
+        _timing_local.action = action
+        return query_shard(shard)
+    
+    started = perf_counter()
+    try:
+        return list(_fanout_pool.map(run, shards))
+    finally:
+        record_phase('fanout', started)
+
+# Read-through cache for per-user reads that rarely change, keyed by (user_id, resource).
+# Shared block: identical in auth, card, loans and referrals so the gateway can
+# share one instance; edit all four (scripts/test_shared_blocks.py compares them).
+# CACHE_STORE: 'local' (this process), 'sqlite' (a file shared by the function
+# processes of one host) or 'off'. Either way every process drops entries on the
+# NOTIFY user_changes sent by the write triggers (V0008, V0013), so a write made
+# by any function or instance reaches every cache.
+CACHE_STORE = os.environ.get('CACHE_STORE', 'local')
+CACHE_SQLITE_PATH = os.environ.get('CACHE_SQLITE_PATH', '/tmp/labubu-read-cache.sqlite3')
+CACHE_TTL_SECONDS = {'profile': 300, 'card': 30, 'loan_stats': 60, 'referral_stats': 60}
+CACHE_MAX_ENTRIES = 10000  # entries kept before LRU eviction
+CACHE_TOMBSTONE_SECONDS = 60  # invalidations remembered so loads started before them are not stored
+CACHE_STALE_SAMPLE_RATE = float(os.environ.get('CACHE_STALE_SAMPLE_RATE', '0.01'))  # hits re-read to measure staleness
+CACHE_COUNTERS = ('hits', 'misses', 'coalesced', 'bypassed', 'sampled', 'stale', 'invalidations')
+CACHE_NOTIFY_CHANNEL = 'user_changes'
+# Resource in a change notification -> cached resources it makes stale (profiles are never updated)
+CACHE_NOTIFY_RESOURCES = {'card': ('card',), 'loans': ('loan_stats',), 'referrals': ('referral_stats',)}
+CACHE_LISTEN_RETRY_SECONDS = 5
+
+class LocalCacheStore:
+    '''In-process LRU of JSON-encoded values with expiry and invalidation tombstones'''
+    
+    def __init__(self):
+        self.entries: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+        self.invalidated: Dict[str, float] = {}
+        self.cleared_at = 0.0
+        self.lock = threading.Lock()
+    
+    def get(self, key: str, now: float) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+    
+    def set(self, key: str, value: str, loaded_from: float, expires_at: float) -> None:
+        '''Store value unless the key was invalidated after the load that produced it started'''
+        with self.lock:
+            if max(self.invalidated.get(key, 0), self.cleared_at) >= loaded_from:
+                return
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            if len(self.entries) > CACHE_MAX_ENTRIES:
+                self.entries.popitem(last=False)
+    
+    def invalidate(self, keys: List[str], now: float) -> None:
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+                self.invalidated[key] = now
+            if len(self.invalidated) > CACHE_MAX_ENTRIES:
+                expire_before = now - CACHE_TOMBSTONE_SECONDS
+                for key in [k for k, at in self.invalidated.items() if at < expire_before]:
+                    del self.invalidated[key]
+    
+    def clear(self, now: float) -> None:
+        '''Drop every entry and refuse loads started before now'''
+        with self.lock:
+            self.entries.clear()
+            self.cleared_at = now
+
+class SqliteCacheStore:
+    '''Cache table in a SQLite file, shared by the function processes of one host'''
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        self.cleared_at = 0.0
+    
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Only paid for when this store is selected
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS read_cache (
+                       key TEXT PRIMARY KEY,
+                       value TEXT,
+                       expires_at REAL NOT NULL,
+                       invalidated_at REAL NOT NULL DEFAULT 0,
+                       used_at REAL NOT NULL
+                   )"""
+            )
+            self.local.conn = conn
+        return conn
+    
+    def get(self, key: str, now: float) -> Optional[str]:
+        conn = self.connection()
+        row = conn.execute(
+            "SELECT value, used_at FROM read_cache WHERE key = ? AND value IS NOT NULL AND expires_at > ?",
+            (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        # Recency for LRU eviction, written at most once a second per key
+        if now - row[1] > 1:
+            conn.execute("UPDATE read_cache SET used_at = ? WHERE key = ?", (now, key))
+        return row[0]
+    
+    def set(self, key: str, value: str, loaded_from: float, expires_at: float) -> None:
+        if self.cleared_at >= loaded_from:
+            return
+        conn = self.connection()
+        conn.execute(
+            """INSERT INTO read_cache (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT (key) DO UPDATE
+               SET value = excluded.value, expires_at = excluded.expires_at, used_at = excluded.used_at
+               WHERE read_cache.invalidated_at < ?""",
+            (key, value, expires_at, loaded_from, loaded_from)
+        )
+        self.writes += 1
+        if self.writes % 100 == 0:
+            self.evict(conn, loaded_from)
+    
+    def invalidate(self, keys: List[str], now: float) -> None:
+        self.connection().executemany(
+            """INSERT INTO read_cache (key, value, expires_at, invalidated_at, used_at) VALUES (?, NULL, 0, ?, ?)
+               ON CONFLICT (key) DO UPDATE SET value = NULL, expires_at = 0, invalidated_at = excluded.invalidated_at""",
+            [(key, now, now) for key in keys]
+        )
+    
+    def clear(self, now: float) -> None:
+        '''Drop every entry but keep the tombstones other processes rely on'''
+        self.cleared_at = now
+        self.connection().execute("UPDATE read_cache SET value = NULL, expires_at = 0")
+    
+    def evict(self, conn, now: float) -> None:
+        '''Drop expired entries and old tombstones, then the least recently used beyond CACHE_MAX_ENTRIES'''
+        conn.execute(
+            "DELETE FROM read_cache WHERE expires_at <= ? AND invalidated_at < ?",
+            (now, now - CACHE_TOMBSTONE_SECONDS)
+        )
+        conn.execute(
+            """DELETE FROM read_cache WHERE key IN (
+                   SELECT key FROM read_cache ORDER BY used_at
+                   LIMIT MAX((SELECT COUNT(*) FROM read_cache) - ?, 0)
+               )""",
+            (CACHE_MAX_ENTRIES,)
+        )
+
+class CacheFlight:
+    '''One in-progress load that concurrent misses for the same key wait on'''
+    __slots__ = ('done', 'value', 'error')
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+class CacheInvalidationListener:
+    '''
+    One LISTEN connection per shard for the change notifications the write
+    triggers send, dropping the changed users' entries whichever function or
+    instance made the write. Notifications sent while a connection is down
+    are lost, so the cache serves only while every shard is listened to and
+    is cleared each time a connection comes back.
+    '''
+    
+    def __init__(self, cache: 'ReadThroughCache'):
+        self.cache = cache
+        self.shards: Optional[int] = None
+        self.listening: set = set()
+        self.lock = threading.Lock()
+    
+    def start(self) -> None:
+        '''Start one listener thread per shard once per process'''
+        if self.shards is not None:
+            return
+        with self.lock:
+            if self.shards is not None:
+                return
+            urls = shard_urls()
+            for shard, url in enumerate(urls):
+                threading.Thread(target=self.run, args=(shard, url), name=f'cache-listen-{shard}', daemon=True).start()
+            self.shards = len(urls)
+    
+    def live(self) -> bool:
+        return self.shards is not None and len(self.listening) == self.shards
+    
+    def run(self, shard: int, url: str) -> None:
+        # Only paid for when the cache is on
+        import select
+        while True:
+            conn = None
+            try:
+                # Keepalives make a silently dropped connection fail instead of waiting forever
+                conn = psycopg2.connect(url, keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+                conn.autocommit = True
+                conn.cursor().execute('LISTEN ' + CACHE_NOTIFY_CHANNEL)
+                self.cache.clear()
+                with self.lock:
+                    self.listening.add(shard)
+                while True:
+                    if select.select([conn], [], [], 60)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            self.dispatch(conn.notifies.pop(0).payload)
+            except (psycopg2.Error, OSError) as e:
+                print(json.dumps({'event': 'cache_listen_failed', 'shard': shard, 'error': str(e).strip()}))
+            finally:
+                with self.lock:
+                    self.listening.discard(shard)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+            time.sleep(CACHE_LISTEN_RETRY_SECONDS)
+    
+    def dispatch(self, payload: str) -> None:
+        try:
+            change = json.loads(payload)
+            user_id, resources = int(change['user_id']), CACHE_NOTIFY_RESOURCES.get(change['resource'], ())
+        except (ValueError, KeyError, TypeError):
+            return
+        self.cache.invalidate([(user_id, resource) for resource in resources])
+
+class ReadThroughCache:
+    '''
+    Serves per-user reads from a cache store and loads misses from the
+    database. Concurrent misses for one key share a single load, error
+    results are never stored, and a sample of hits is re-read to count stale
+    answers. Writes invalidate the keys they change, directly in the writing
+    process and through the listener everywhere else; loads that started
+    before an invalidation are not stored.
+    '''
+    
+    def __init__(self, store):
+        self.store = store
+        self.listener = CacheInvalidationListener(self)
+        self.inflight: Dict[str, CacheFlight] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self.lock = threading.Lock()
+    
+    def start(self) -> None:
+        if self.store is not None:
+            self.listener.start()
+    
+    def count(self, resource: str, counter: str, n: int = 1) -> None:
+        with self.lock:
+            stats = self.stats.get(resource)
+            if stats is None:
+                stats = self.stats[resource] = dict.fromkeys(CACHE_COUNTERS, 0)
+            stats[counter] += n
+    
+    def get(self, user_id: int, resource: str, load: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        if self.store is None:
+            return load()
+        
+        self.listener.start()
+        if not self.listener.live():
+            # Invalidations could be missed: read through without storing
+            self.count(resource, 'bypassed')
+            return load()
+        
+        key = f'{user_id}:{resource}'
+        started = perf_counter()
+        try:
+            cached = self.store.get(key, time.time())
+        except Exception as e:
+            print(json.dumps({'event': 'cache_store_failed', 'error': str(e)}))
+            cached = None
+        record_phase('cache', started)
+        
+        if cached is None:
+            self.count(resource, 'misses')
+            return self.load(key, resource, load)
+        
+        if random.random() >= CACHE_STALE_SAMPLE_RATE:
+            self.count(resource, 'hits')
+            return json.loads(cached)
+        
+        # Sampled hit: answer from the database and record whether the cache was behind
+        fresh = self.load(key, resource, load)
+        self.count(resource, 'sampled')
+        if json.dumps(fresh) != cached:
+            self.count(resource, 'stale')
+        return fresh
+    
+    def load(self, key: str, resource: str, load: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = CacheFlight()
+        
+        if not leader:
+            self.count(resource, 'coalesced')
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return json.loads(flight.value)
+        
+        loaded_from = time.time()
+        try:
+            result = load()
+            flight.value = json.dumps(result)
+            if 'error' not in result:
+                try:
+                    self.store.set(key, flight.value, loaded_from, loaded_from + CACHE_TTL_SECONDS[resource])
+                except Exception as e:
+                    print(json.dumps({'event': 'cache_store_failed', 'error': str(e)}))
+            return result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.done.set()
+    
+    def invalidate(self, keys: List[Tuple[int, str]]) -> None:
+        '''Drop (user_id, resource) entries after a write that changed them'''
+        if self.store is None or not keys:
+            return
+        try:
+            self.store.invalidate([f'{user_id}:{resource}' for user_id, resource in keys], time.time())
+        except Exception as e:
+            # Entries still expire after their TTL
+            print(json.dumps({'event': 'cache_invalidate_failed', 'error': str(e)}))
+        for _, resource in keys:
+            self.count(resource, 'invalidations')
+    
+    def clear(self) -> None:
+        try:
+            self.store.clear(time.time())
+        except Exception as e:
+            print(json.dumps({'event': 'cache_invalidate_failed', 'error': str(e)}))
+    
+    def report(self) -> Dict[str, Any]:
+        '''Per-resource counters with hit ratio and the stale share of sampled hits'''
+        with self.lock:
+            resources = {resource: dict(stats) for resource, stats in self.stats.items()}
+        for stats in resources.values():
+            lookups = stats['hits'] + stats['misses'] + stats['sampled']
+            stats['hit_ratio'] = round((stats['hits'] + stats['sampled']) / lookups, 4) if lookups else None
+            stats['stale_ratio'] = round(stats['stale'] / stats['sampled'], 4) if stats['sampled'] else None
+        return {'store': CACHE_STORE, 'live': self.listener.live(), 'resources': resources}
+
+read_cache = ReadThroughCache(
+    SqliteCacheStore(CACHE_SQLITE_PATH) if CACHE_STORE == 'sqlite'
+    else LocalCacheStore() if CACHE_STORE == 'local'
+    else None
+)
+# End of the shared read cache block
+
+# Pool, registries and read cache handed between the functions that
+# scripts/gateway.py hosts in one process. Shared block: identical in auth,
+# card, loans and referrals; edit all four (scripts/test_shared_blocks.py).
+_shared_state_lock = threading.Lock()
+
+def shared_state() -> Dict[str, Any]:
+    '''This instance's request-timing local, pool, breakers, registries, read cache and token check'''
+    return {
+        'timing_local': _timing_local,
+        'db_local': _db_local,
+        'db_breakers': db_breakers,
+        'prepared': _prepared,
+        'shard_map': shard_map,
+        'fingerprints': _fingerprints,
+        'query_stats': _query_stats,
+        'query_stats_lock': _query_stats_lock,
+        'unavailable': DatabaseUnavailable,
+        'read_cache': read_cache,
+        'verify_token': verify_token
+    }
+
+def use_shared_state(state: Dict[str, Any]) -> None:
+    '''
+    Switch this instance to another function's shared_state() in one step,
+    before it serves anything: an instance that already connected, ran a
+    statement or started its cache listener refuses, since requests in
+    flight would mix its own state with the shared one. Shared breakers and
+    shard map raise the other function's DatabaseUnavailable, so the
+    handler catches that class from then on.
+    '''
+    global _timing_local, _db_local, db_breakers, _prepared, shard_map, _fingerprints, _query_stats, \
+        _query_stats_lock, DatabaseUnavailable, read_cache, verify_token
+    with _shared_state_lock:
+        if db_breakers or _fingerprints or read_cache.listener.shards is not None:
+            raise RuntimeError('shared state must be set before the first request')
+        _timing_local = state['timing_local']
+        _db_local = state['db_local']
+        db_breakers = state['db_breakers']
+        _prepared = state['prepared']
+        shard_map = state['shard_map']
+        _fingerprints = state['fingerprints']
+        _query_stats = state['query_stats']
+        _query_stats_lock = state['query_stats_lock']
+        DatabaseUnavailable = state['unavailable']
+        read_cache = state['read_cache']
+        verify_token = state['verify_token']
+# End of the shared state block
 
 def verify_token(token: str) -> Optional[Dict[str, Any]]:
     '''Verify JWT token and return payload'''
+    started = perf_counter()
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         return payload
     except:
         return None
+    finally:
+        record_phase('auth', started)
+
+def token_claim(payload: Dict[str, Any], name: str) -> Optional[Any]:
+    '''Identifier claim from a verified token, or None if missing or from another claims version'''
+    if payload.get('cv') != TOKEN_CLAIMS_VERSION:
+        return None
+    return payload.get(name)
 
-def get_referral_stats(user_id: int) -> Dict[str, Any]:
-    '''Get referral statistics for user'''
-    conn = get_db_connection()
+def get_referral_stats(user_id: int, referral_code: Optional[str] = None) -> Dict[str, Any]:
+    '''Get referral statistics for user; referral_code from the token skips the user lookup'''
+    conn = get_db_connection(user_id)
     cur = conn.cursor()
     
     # Get user's referral code
-    cur.execute(
-        "SELECT referral_code FROM users WHERE id = %s",
-        (user_id,)
-    )
-    user = cur.fetchone()
-    
-    if not user:
-        cur.close()
-        conn.close()
-        return {'error': 'Пользователь не найден', 'code': 'USER_NOT_FOUND'}
-    
-    referral_code = user['referral_code']
+    if referral_code is None:
+        execute_prepared(cur, 'user_referral_code', (user_id,))
+        user = cur.fetchone()
+        
+        if not user:
+            cur.close()
+            release_db_connection(conn)
+            return {'error': 'Пользователь не найден', 'code': 'USER_NOT_FOUND'}
+        
+        referral_code = user['referral_code']
     
-    # Count referrals
-    cur.execute(
-        "SELECT COUNT(*) as count FROM users WHERE referred_by = %s",
-        (user_id,)
-    )
-    referral_count = cur.fetchone()['count']
+    # Count referrals; sharded, referred users live anywhere but all sit in the directory
+    if DATABASE_SHARDS:
+        directory = get_directory_connection()
+        directory_cur = directory.cursor()
+        directory_cur.execute("SELECT COUNT(*) as count FROM user_directory WHERE referred_by = %s", (user_id,))
+        referral_count = directory_cur.fetchone()['count']
+        directory_cur.close()
+        release_db_connection(directory)
+    else:
+        execute_prepared(cur, 'referral_count', (user_id,))
+        referral_count = cur.fetchone()['count']
     
     # Get total bonus earned
-    cur.execute(
-        "SELECT COALESCE(SUM(amount), 0) as total FROM referral_bonuses WHERE user_id = %s",
-        (user_id,)
-    )
+    execute_prepared(cur, 'referral_bonus_total', (user_id,))
     total_bonus = cur.fetchone()['total']
     
     # Get available bonus
-    cur.execute(
-        "SELECT COALESCE(SUM(amount), 0) as available FROM referral_bonuses WHERE user_id = %s AND status = 'available'",
-        (user_id,)
-    )
+    execute_prepared(cur, 'referral_bonus_available', (user_id,))
     available_bonus = cur.fetchone()['available']
     
     cur.close()
-    conn.close()
+    release_db_connection(conn)
     
     return {
         'success': True,
@@ -83,26 +1029,43 @@ def get_referral_stats(user_id: int) -> Dict[str, Any]:
         }
     }
 
-def get_referral_list(user_id: int) -> Dict[str, Any]:
-    '''Get list of users referred by this user'''
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute(
-        """SELECT u.id, u.name, u.email, u.created_at,
-           COALESCE(
-               (SELECT SUM(l.amount) FROM loans l WHERE l.user_id = u.id AND l.status = 'repaid'),
-               0
-           ) as total_loans
-           FROM users u
-           WHERE u.referred_by = %s
-           ORDER BY u.created_at DESC""",
-        (user_id,)
-    )
+def parse_cursor(value: Optional[str]) -> Tuple[datetime, int]:
+    '''Decode a page cursor "<created_at>,<id>"; raises ValueError on a malformed one'''
+    if not value:
+        return FIRST_PAGE_CURSOR
+    created_at, row_id = value.rsplit(',', 1)
+    return datetime.fromisoformat(created_at), int(row_id)
+
+def parse_page_size(value: Optional[str]) -> int:
+    '''Page size from the query string, clamped to MAX_PAGE_SIZE; raises ValueError on a non-number'''
+    if not value:
+        return PAGE_SIZE
+    return max(1, min(int(value), MAX_PAGE_SIZE))
+
+def next_cursor(rows: List[Dict[str, Any]], limit: int) -> Optional[str]:
+    '''Cursor of the page after rows, or None when this was the last page'''
+    if len(rows) < limit:
+        return None
+    return f"{rows[-1]['created_at'].isoformat()},{rows[-1]['id']}"
+
+def get_referral_list(user_id: int, cursor: Tuple[datetime, int] = FIRST_PAGE_CURSOR,
+                      limit: int = PAGE_SIZE) -> Dict[str, Any]:
+    '''Get a page of users referred by this user, merged newest first across shards'''
+    def query_shard(shard: int) -> List[Dict[str, Any]]:
+        conn = get_shard_connection(shard)
+        cur = conn.cursor()
+        execute_prepared(cur, 'referral_list', (user_id, cursor[0], cursor[1], limit))
+        rows = cur.fetchall()
+        cur.close()
+        release_db_connection(conn)
+        return rows
     
-    referrals = cur.fetchall()
-    cur.close()
-    conn.close()
+    # Every shard returns its own first page after the cursor; the merged page is the newest of those
+    results = fan_out(query_shard)
+    referrals = results[0] if len(results) == 1 else sorted(
+        (ref for rows in results for ref in rows), key=lambda ref: (ref['created_at'], ref['id']), reverse=True
+    )[:limit]
+    cursor_after = next_cursor(referrals, limit)
     
     # Convert to list of dicts
     referrals_list = []
@@ -113,60 +1076,65 @@ def get_referral_list(user_id: int) -> Dict[str, Any]:
     
     return {
         'success': True,
-        'referrals': referrals_list
+        'referrals': referrals_list,
+        'next_cursor': cursor_after
     }
 
-def get_bonus_history(user_id: int) -> Dict[str, Any]:
-    '''Get bonus history for user'''
-    conn = get_db_connection()
+def lookup_users(user_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    '''Names and emails of users on any shard, keyed by id'''
+    def query_shard(shard: int) -> List[Dict[str, Any]]:
+        conn = get_shard_connection(shard)
+        cur = conn.cursor()
+        cur.execute("SELECT id, name, email FROM users WHERE id = ANY(%s)", (user_ids,))
+        rows = cur.fetchall()
+        cur.close()
+        release_db_connection(conn)
+        return rows
+    
+    return {row['id']: row for rows in fan_out(query_shard) for row in rows}
+
+def get_bonus_history(user_id: int, cursor: Tuple[datetime, int] = FIRST_PAGE_CURSOR,
+                      limit: int = PAGE_SIZE) -> Dict[str, Any]:
+    '''Get a page of bonus history for user, newest first'''
+    conn = get_db_connection(user_id)
     cur = conn.cursor()
     
-    cur.execute(
-        """SELECT rb.id, rb.amount, rb.status, rb.source, rb.created_at,
-           u.name as referral_name, u.email as referral_email
-           FROM referral_bonuses rb
-           LEFT JOIN users u ON rb.referred_user_id = u.id
-           WHERE rb.user_id = %s
-           ORDER BY rb.created_at DESC""",
-        (user_id,)
-    )
+    execute_prepared(cur, 'bonus_history', (user_id, cursor[0], cursor[1], limit))
     
     bonuses = cur.fetchall()
     cur.close()
-    conn.close()
+    release_db_connection(conn)
+    cursor_after = next_cursor(bonuses, limit)
+    
+    # The join only sees referred users on this shard; look the rest up on theirs
+    missing = {b['referred_user_id'] for b in bonuses if b['referred_user_id'] and b['referral_name'] is None}
+    referred_users = lookup_users(list(missing)) if DATABASE_SHARDS and missing else {}
     
     # Convert to list of dicts
     bonuses_list = []
     for bonus in bonuses:
         bonus_dict = dict(bonus)
+        referred = referred_users.get(bonus_dict.pop('referred_user_id'))
+        if referred:
+            bonus_dict['referral_name'] = referred['name']
+            bonus_dict['referral_email'] = referred['email']
         bonus_dict['created_at'] = bonus_dict['created_at'].isoformat()
         bonuses_list.append(bonus_dict)
     
     return {
         'success': True,
-        'bonuses': bonuses_list
+        'bonuses': bonuses_list,
+        'next_cursor': cursor_after
     }
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+def handle_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     
     # Handle CORS
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return CORS_PREFLIGHT_RESPONSE
     
-    headers = {
-        'Content-Type': 'application/json',
-        'Access-Control-Allow-Origin': '*'
-    }
+    headers = JSON_HEADERS
     
     # Verify authentication
     auth_token = event.get('headers', {}).get('X-Auth-Token') or event.get('headers', {}).get('x-auth-token')
@@ -175,7 +1143,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 401,
             'headers': headers,
-            'body': json.dumps({'error': 'Требуется авторизация'})
+            'body': AUTH_REQUIRED_BODY
         }
     
     payload = verify_token(auth_token)
@@ -183,7 +1151,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 401,
             'headers': headers,
-            'body': json.dumps({'error': 'Недействительный токен'})
+            'body': INVALID_TOKEN_BODY
         }
     
     user_id = payload['user_id']
@@ -194,68 +1162,172 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             # Get referral stats
             if params.get('stats') == 'true':
-                result = get_referral_stats(user_id)
+                result = read_cache.get(user_id, 'referral_stats',
+                                        lambda: get_referral_stats(user_id, referral_code=token_claim(payload, 'rc')))
                 
                 if 'error' in result:
                     return {
                         'statusCode': 404,
                         'headers': headers,
-                        'body': json.dumps(result)
+                        'body': encode_json(result)
                     }
                 
                 return {
                     'statusCode': 200,
                     'headers': headers,
-                    'body': json.dumps(result)
+                    'body': encode_json(result)
                 }
             
-            # Get referral list
-            elif params.get('list') == 'true':
-                result = get_referral_list(user_id)
+            # Get referral list or bonus history, one page per request
+            elif params.get('list') == 'true' or params.get('bonuses') == 'true':
+                try:
+                    cursor = parse_cursor(params.get('cursor'))
+                    limit = parse_page_size(params.get('limit'))
+                except ValueError:
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': encode_json({'error': 'Некорректные параметры страницы', 'code': 'INVALID_PAGE'})
+                    }
                 
-                return {
-                    'statusCode': 200,
-                    'headers': headers,
-                    'body': json.dumps(result)
-                }
-            
-            # Get bonus history
-            elif params.get('bonuses') == 'true':
-                result = get_bonus_history(user_id)
+                if params.get('list') == 'true':
+                    result = get_referral_list(user_id, cursor, limit)
+                else:
+                    result = get_bonus_history(user_id, cursor, limit)
                 
                 return {
                     'statusCode': 200,
                     'headers': headers,
-                    'body': json.dumps(result)
+                    'body': encode_json(result)
                 }
             
             # Default: get stats
             else:
-                result = get_referral_stats(user_id)
+                result = read_cache.get(user_id, 'referral_stats',
+                                        lambda: get_referral_stats(user_id, referral_code=token_claim(payload, 'rc')))
                 
                 if 'error' in result:
                     return {
                         'statusCode': 404,
                         'headers': headers,
-                        'body': json.dumps(result)
+                        'body': encode_json(result)
                     }
                 
                 return {
                     'statusCode': 200,
                     'headers': headers,
-                    'body': json.dumps(result)
+                    'body': encode_json(result)
                 }
         
         else:
             return {
                 'statusCode': 405,
                 'headers': headers,
-                'body': json.dumps({'error': 'Метод не поддерживается'})
+                'body': encode_json({'error': 'Метод не поддерживается'})
             }
     
+    except DatabaseUnavailable as e:
+        return db_unavailable_response(e.retry_after)
+    
+    except psycopg2.OperationalError:
+        return db_unavailable_response(1)
+    
     except Exception as e:
         return {
             'statusCode': 500,
             'headers': headers,
-            'body': json.dumps({'error': str(e)})
+            'body': encode_json({'error': str(e)})
         }
+
+def request_action(event: Dict[str, Any]) -> str:
+    '''Action name used for latency histograms'''
+    params = event.get('queryStringParameters') or {}
+    if params.get('list') == 'true':
+        return 'list'
+    if params.get('bonuses') == 'true':
+        return 'bonuses'
+    return 'stats'
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    if event.get('httpMethod') == 'OPTIONS':
+        return CORS_PREFLIGHT_RESPONSE
+    
+    params = event.get('queryStringParameters') or {}
+    if params.get('admin'):
+        return admin_action(event, params)
+    
+    started = perf_counter()
+    action = request_action(event)
+    _timing_local.phases = {}
+    _timing_local.request_id = getattr(context, 'request_id', None)
+    _timing_local.action = action
+    try:
+        response = handle_request(event, context)
+    finally:
+        release_probes()
+        phases = _timing_local.phases
+        _timing_local.phases = None
+    total = perf_counter() - started
+    
+    observe_latency(action, total)
+    
+    timings = [
+        f'{name};dur={value[0] * 1000:.3f}' + (f';desc="{value[1]} calls"' if value[1] > 1 else '')
+        for name, value in phases.items()
+    ]
+    timings.append(f'total;dur={total * 1000:.3f}')
+    print(json.dumps({
+        'event': 'request',
+        'request_id': getattr(context, 'request_id', None),
+        'action': action,
+        'status': response.get('statusCode'),
+        'total_ms': round(total * 1000, 3),
+        'phases_ms': {name: round(value[0] * 1000, 3) for name, value in phases.items()}
+    }))
+    
+    return {
+        **response,
+        'headers': {**response.get('headers', {}), 'Server-Timing': ', '.join(timings), 'Timing-Allow-Origin': '*'}
+    }
+# End of the shared handler block
+
+def admin_action(event: Dict[str, Any], params: Dict[str, Any]) -> Dict[str, Any]:
+    '''Instance metrics for requests with a valid X-Admin-Token: ?admin=metrics, ?admin=queries&top=N or ?admin=cache'''
+    headers = event.get('headers') or {}
+    token = headers.get('X-Admin-Token') or headers.get('x-admin-token') or ''
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        return {
+            'statusCode': 403,
+            'headers': JSON_HEADERS,
+            'body': json.dumps({'error': 'Доступ запрещен'})
+        }
+    
+    if params['admin'] == 'metrics':
+        result = {'success': True, 'latency': latency_report()}
+    elif params['admin'] == 'queries':
+        try:
+            top = int(params.get('top') or QUERY_REPORT_TOP)
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'headers': JSON_HEADERS,
+                'body': json.dumps({'error': 'Некорректный параметр top'})
+            }
+        result = {'success': True, 'queries': query_report(max(1, min(top, QUERY_REPORT_MAX_TOP)))}
+    elif params['admin'] == 'cache':
+        result = {'success': True, 'cache': read_cache.report()}
+    else:
+        return {
+            'statusCode': 400,
+            'headers': JSON_HEADERS,
+            'body': json.dumps({'error': 'Неизвестное действие'})
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': JSON_HEADERS,
+        'body': json.dumps(result)
+    }
+
+if DB_PREWARM:
+    prewarm()
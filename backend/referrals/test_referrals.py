@@ -0,0 +1,52 @@
+'''
+Unit tests for the referrals function: python -m pytest backend/referrals
+The database is replaced by scripted fake connections; tests.json covers the deployed HTTP contract.
+'''
+
+from datetime import datetime
+
+import pytest
+
+@pytest.fixture
+def referrals(load_function):
+    return load_function('referrals')
+
+def get_event(params):
+    return {'httpMethod': 'GET', 'headers': {'X-Auth-Token': 'token'}, 'queryStringParameters': params}
+
+def referral(row_id, day):
+    return {'id': row_id, 'name': f'User {row_id}', 'email': f'user{row_id}@example.com',
+            'created_at': datetime(2026, 1, day), 'total_loans': 0}
+
+def test_page_parameters(referrals):
+    assert referrals.parse_cursor(None) == referrals.FIRST_PAGE_CURSOR
+    assert referrals.parse_cursor('2026-01-02T00:00:00,17') == (datetime(2026, 1, 2), 17)
+    assert referrals.parse_page_size(None) == referrals.PAGE_SIZE
+    assert referrals.parse_page_size('100000') == referrals.MAX_PAGE_SIZE
+    with pytest.raises(ValueError):
+        referrals.parse_cursor('yesterday')
+    with pytest.raises(ValueError):
+        referrals.parse_page_size('all')
+
+def test_referral_pages_merge_shards_newest_first(referrals, monkeypatch):
+    shards = [[referral(5, 9), referral(3, 4)], [referral(8, 7), referral(4, 6)]]
+    monkeypatch.setattr(referrals, 'fan_out', lambda query_shard: shards)
+    
+    result = referrals.get_referral_list(1, limit=2)
+    
+    assert [ref['id'] for ref in result['referrals']] == [5, 8]
+    assert result['next_cursor'] == '2026-01-07T00:00:00,8'
+
+def test_last_page_has_no_cursor(referrals, monkeypatch):
+    monkeypatch.setattr(referrals, 'fan_out', lambda query_shard: [[referral(5, 9)]])
+    
+    assert referrals.get_referral_list(1, limit=2)['next_cursor'] is None
+
+def test_malformed_cursor_is_a_400(referrals, monkeypatch):
+    monkeypatch.setattr(referrals, 'verify_token', lambda token: {'user_id': 1})
+    monkeypatch.setattr(referrals, 'get_referral_list', lambda *args: pytest.fail('database touched'))
+    
+    response = referrals.handle_request(get_event({'list': 'true', 'cursor': 'yesterday'}), None)
+    
+    assert response['statusCode'] == 400
+    assert '"INVALID_PAGE"' in response['body']
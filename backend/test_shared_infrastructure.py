@@ -0,0 +1,176 @@
+'''
+Unit tests for the infrastructure every backend function carries (admin endpoint,
+circuit breaker, read cache store, prepared statements): python -m pytest backend
+Each test runs against every function, so a copy that drifts fails on its own.
+'''
+
+import threading
+
+import psycopg2
+import pytest
+
+@pytest.fixture(params=('auth', 'card', 'loans', 'referrals'))
+def function(request, load_function, monkeypatch):
+    module = load_function(request.param)
+    monkeypatch.setattr(module, 'ADMIN_TOKEN', 'secret')
+    return module
+
+def admin_event(params, token='secret'):
+    return {'httpMethod': 'GET', 'headers': {'X-Admin-Token': token}, 'queryStringParameters': params}
+
+def test_admin_queries_validates_and_clamps_top(function, monkeypatch):
+    tops = []
+    monkeypatch.setattr(function, 'query_report', lambda top: tops.append(top) or [])
+    
+    assert function.handler(admin_event({'admin': 'queries', 'top': 'ten'}), None)['statusCode'] == 400
+    assert function.handler(admin_event({'admin': 'queries', 'top': '100000'}), None)['statusCode'] == 200
+    assert function.handler(admin_event({'admin': 'queries'}), None)['statusCode'] == 200
+    assert tops == [function.QUERY_REPORT_MAX_TOP, function.QUERY_REPORT_TOP]
+
+def test_admin_requires_the_admin_token(function):
+    assert function.handler(admin_event({'admin': 'metrics'}, token='guess'), None)['statusCode'] == 403
+
+def check_elsewhere(breaker):
+    '''Outcome of breaker.check() for a request on another thread'''
+    outcome = []
+    
+    def check():
+        try:
+            breaker.check()
+            outcome.append(None)
+        except Exception as e:
+            outcome.append(e)
+    
+    thread = threading.Thread(target=check)
+    thread.start()
+    thread.join()
+    return outcome[0]
+
+@pytest.fixture
+def clock(function, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(function.time, 'monotonic', lambda: now[0])
+    return now
+
+def test_circuit_breaker_opens_probes_and_closes(function, clock):
+    breaker = function.CircuitBreaker(threshold=2, cooldown=10, probe_timeout=5)
+    
+    breaker.failure()
+    breaker.check()
+    breaker.failure()
+    with pytest.raises(function.DatabaseUnavailable) as rejected:
+        breaker.check()
+    assert rejected.value.retry_after == 10
+    
+    # After the cooldown one probe passes; others wait for its outcome
+    clock[0] += 10
+    breaker.check()
+    breaker.check()
+    assert isinstance(check_elsewhere(breaker), function.DatabaseUnavailable)
+    breaker.success()
+    breaker.check()
+    assert breaker.state == 'closed' and breaker.failures == 0
+
+def test_failed_probe_reopens_the_breaker(function, clock):
+    breaker = function.CircuitBreaker(threshold=5, cooldown=10, probe_timeout=5)
+    breaker.state, breaker.opened_at = 'open', 90.0
+    
+    breaker.check()
+    breaker.failure()
+    
+    assert breaker.state == 'open' and breaker.opened_at == 100.0
+
+def test_probe_without_outcome_frees_the_slot_at_request_end(function, clock):
+    breaker = function.CircuitBreaker(threshold=5, cooldown=10, probe_timeout=5)
+    breaker.state, breaker.opened_at = 'open', 90.0
+    
+    # Admitted, but the request never ran a query
+    breaker.check()
+    breaker.release_probe()
+    
+    assert check_elsewhere(breaker) is None
+    assert breaker.state == 'half-open'
+
+def test_silent_probe_is_replaced_after_its_deadline(function, clock):
+    breaker = function.CircuitBreaker(threshold=5, cooldown=10, probe_timeout=5)
+    breaker.state, breaker.opened_at = 'open', 90.0
+    breaker.check()
+    
+    clock[0] += 4
+    assert isinstance(check_elsewhere(breaker), function.DatabaseUnavailable)
+    clock[0] += 1
+    assert check_elsewhere(breaker) is None
+
+def test_handler_releases_a_probe_the_request_left_open(function, monkeypatch):
+    breaker = function.db_breakers['postgresql://test/test'] = function.CircuitBreaker(5, 10, 5)
+    breaker.state, breaker.opened_at = 'open', 0.0
+    
+    def admitted_without_query(event, context):
+        breaker.check()
+        raise ValueError('handler bug')
+    
+    monkeypatch.setattr(function, 'handle_request', admitted_without_query)
+    with pytest.raises(ValueError):
+        function.handler({'httpMethod': 'GET', 'headers': {}}, None)
+    
+    assert check_elsewhere(breaker) is None
+
+def test_unreachable_database_sheds_requests_with_503(function, monkeypatch):
+    monkeypatch.setattr(function, 'verify_token', lambda token: {'user_id': 1})
+    # Cached reads go through to the database without starting the LISTEN threads
+    function.read_cache.listener.shards = 1
+    attempts = []
+    
+    def refuse(*args, **kwargs):
+        attempts.append(args)
+        raise psycopg2.OperationalError('connection refused')
+    
+    monkeypatch.setattr(function.psycopg2, 'connect', refuse)
+    event = {'httpMethod': 'GET', 'headers': {'X-Auth-Token': 'token'}, 'queryStringParameters': {}}
+    
+    responses = [function.handle_request(event, None) for _ in range(function.BREAKER_FAILURE_THRESHOLD + 1)]
+    
+    assert [r['statusCode'] for r in responses] == [503] * (function.BREAKER_FAILURE_THRESHOLD + 1)
+    assert len(attempts) == function.BREAKER_FAILURE_THRESHOLD
+    assert int(responses[-1]['headers']['Retry-After']) == function.BREAKER_COOLDOWN_SECONDS
+
+def test_cache_reads_through_until_every_shard_is_listened_to(function):
+    function.read_cache.listener.shards = 2
+    function.read_cache.listener.listening.add(0)
+    loads = []
+    
+    for _ in range(2):
+        function.read_cache.get(3, 'profile', lambda: loads.append(1) or {'success': True})
+    
+    assert len(loads) == 2
+    assert function.read_cache.report()['resources']['profile']['bypassed'] == 2
+    assert function.read_cache.store.entries == {}
+
+def test_reconnect_refuses_loads_started_before_it(function):
+    store = function.LocalCacheStore()
+    store.set('3:loan_stats', '{}', 100.0, 200.0)
+    
+    store.clear(150.0)
+    store.set('3:loan_stats', '{}', 140.0, 240.0)
+    
+    assert store.get('3:loan_stats', 160.0) is None
+    store.set('3:loan_stats', '{}', 160.0, 260.0)
+    assert store.get('3:loan_stats', 170.0) == '{}'
+
+def test_new_connection_prepares_hot_statements_in_one_round_trip(function, fake_connection):
+    conn = fake_connection([[]])
+    
+    function.prepare_statements(conn)
+    function.prepare_statements(conn)
+    
+    assert len(conn.cur.queries) == 1
+    assert conn.cur.queries[0].count('PREPARE ') == len(function.PREPARED_STATEMENTS)
+    assert function.prepared_names(conn) == set(function.PREPARED_STATEMENTS)
+
+def test_failed_prepare_leaves_statements_to_execute_prepared(function, fake_connection):
+    conn = fake_connection([psycopg2.OperationalError('server closed the connection')])
+    
+    function.prepare_statements(conn)
+    
+    assert conn.rollbacks == 1
+    assert function.prepared_names(conn) == set()
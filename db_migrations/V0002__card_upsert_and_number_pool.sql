@@ -0,0 +1,37 @@
+-- The old select-then-insert issuance could race and give a user two cards.
+-- Keep each user's oldest card, move the other cards' transactions and
+-- balance onto it and delete them, so the unique index below can be built
+CREATE TEMP TABLE duplicate_cards AS
+SELECT id, keep_id, COALESCE(balance, 0) AS balance
+FROM (
+    SELECT id, balance, FIRST_VALUE(id) OVER (PARTITION BY user_id ORDER BY created_at, id) AS keep_id
+    FROM virtual_cards
+) ranked
+WHERE id <> keep_id;
+
+UPDATE card_transactions t
+SET card_id = d.keep_id
+FROM duplicate_cards d
+WHERE t.card_id = d.id;
+
+UPDATE virtual_cards c
+SET balance = COALESCE(c.balance, 0) + moved.balance
+FROM (SELECT keep_id, SUM(balance) AS balance FROM duplicate_cards GROUP BY keep_id) moved
+WHERE c.id = moved.keep_id;
+
+DELETE FROM virtual_cards v
+USING duplicate_cards d
+WHERE v.id = d.id;
+
+DROP TABLE duplicate_cards;
+
+-- One virtual card per user, so card issuance can rely on ON CONFLICT (user_id)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_virtual_cards_user_id_unique ON virtual_cards(user_id);
+DROP INDEX IF EXISTS idx_virtual_cards_user_id;
+
+-- Pool of pre-generated Luhn-valid card numbers, claimed with SKIP LOCKED on issuance
+-- and refilled in the background by scripts/refill_card_number_pool.py
+CREATE TABLE IF NOT EXISTS card_number_pool (
+    card_number VARCHAR(16) PRIMARY KEY,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,10 @@
+-- Shared fixed-window counters for auth rate limiting across function instances.
+-- UNLOGGED: counters are disposable and must not add WAL traffic on login bursts.
+CREATE UNLOGGED TABLE IF NOT EXISTS auth_rate_limits (
+    key VARCHAR(320) NOT NULL,
+    window_start BIGINT NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (key, window_start)
+);
+
+CREATE INDEX IF NOT EXISTS idx_auth_rate_limits_window_start ON auth_rate_limits(window_start);
@@ -0,0 +1,48 @@
+-- Signed ledger amounts: debits negative, credits positive
+ALTER TABLE card_transactions ADD COLUMN IF NOT EXISTS signed_amount DECIMAL(12, 2);
+
+UPDATE card_transactions
+SET signed_amount = CASE WHEN type = 'sbp_transfer' THEN -amount ELSE amount END
+WHERE signed_amount IS NULL;
+
+-- Opening entries so that the ledger sums to the current card balances. They
+-- are dated when the card was issued, so balance_at before the migration
+-- still includes them
+INSERT INTO card_transactions (card_id, type, amount, signed_amount, comment, status, created_at)
+SELECT c.id, 'opening_balance', ABS(c.balance - COALESCE(t.total, 0)), c.balance - COALESCE(t.total, 0),
+       'Opening ledger balance', 'completed', c.created_at
+FROM virtual_cards c
+LEFT JOIN (
+    SELECT card_id, SUM(signed_amount) AS total
+    FROM card_transactions
+    WHERE status = 'completed'
+    GROUP BY card_id
+) t ON t.card_id = c.id
+WHERE c.balance <> COALESCE(t.total, 0);
+
+ALTER TABLE card_transactions ALTER COLUMN signed_amount SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_card_transactions_card_id_id ON card_transactions(card_id, id);
+
+-- Ledger entries are never modified; corrections are new entries
+CREATE OR REPLACE FUNCTION card_transactions_append_only() RETURNS trigger AS $$
+BEGIN
+    RAISE EXCEPTION 'card_transactions is append-only';
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_card_transactions_append_only ON card_transactions;
+CREATE TRIGGER trg_card_transactions_append_only
+    BEFORE UPDATE OR DELETE ON card_transactions
+    FOR EACH ROW EXECUTE FUNCTION card_transactions_append_only();
+
+-- Periodic per-card balances: balance of all completed entries with id <= ledger_position
+CREATE TABLE IF NOT EXISTS card_balance_snapshots (
+    id SERIAL PRIMARY KEY,
+    card_id INTEGER NOT NULL REFERENCES virtual_cards(id),
+    ledger_position INTEGER NOT NULL,
+    balance DECIMAL(12, 2) NOT NULL,
+    taken_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_card_balance_snapshots_card_position ON card_balance_snapshots(card_id, ledger_position DESC);
@@ -0,0 +1,63 @@
+-- Monthly range partitioning of card_transactions on created_at
+
+ALTER TABLE card_transactions RENAME TO card_transactions_unpartitioned;
+ALTER TABLE card_transactions_unpartitioned RENAME CONSTRAINT card_transactions_pkey TO card_transactions_unpartitioned_pkey;
+DROP INDEX IF EXISTS idx_card_transactions_card_id;
+DROP INDEX IF EXISTS idx_card_transactions_card_id_id;
+
+CREATE TABLE card_transactions (
+    id INTEGER NOT NULL DEFAULT nextval('card_transactions_id_seq'),
+    card_id INTEGER NOT NULL REFERENCES virtual_cards(id),
+    type VARCHAR(50) NOT NULL,
+    amount DECIMAL(10, 2) NOT NULL,
+    phone VARCHAR(20),
+    comment TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    signed_amount DECIMAL(12, 2) NOT NULL,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE card_transactions_id_seq OWNED BY card_transactions.id;
+
+-- Creates monthly partitions from from_month up to months_ahead months after the current one.
+-- Called by scripts/card_transactions_partitions.py ensure (daily cron).
+CREATE OR REPLACE FUNCTION create_card_transaction_partitions(from_month DATE, months_ahead INTEGER) RETURNS INTEGER AS $$
+DECLARE
+    month_start DATE := date_trunc('month', from_month)::date;
+    last_month DATE := (date_trunc('month', NOW()) + make_interval(months => months_ahead))::date;
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    WHILE month_start <= last_month LOOP
+        partition_name := 'card_transactions_' || to_char(month_start, 'YYYY_MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF card_transactions FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, (month_start + INTERVAL '1 month')::date
+            );
+            created := created + 1;
+        END IF;
+        month_start := (month_start + INTERVAL '1 month')::date;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_card_transaction_partitions(
+    COALESCE((SELECT MIN(created_at) FROM card_transactions_unpartitioned), NOW())::date,
+    3
+);
+
+INSERT INTO card_transactions (id, card_id, type, amount, phone, comment, status, created_at, signed_amount)
+SELECT id, card_id, type, amount, phone, comment, status, created_at, signed_amount
+FROM card_transactions_unpartitioned;
+
+DROP TABLE card_transactions_unpartitioned;
+
+CREATE INDEX IF NOT EXISTS idx_card_transactions_card_id_created_at ON card_transactions(card_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_card_transactions_card_id_id ON card_transactions(card_id, id);
+
+CREATE TRIGGER trg_card_transactions_append_only
+    BEFORE UPDATE OR DELETE ON card_transactions
+    FOR EACH ROW EXECUTE FUNCTION card_transactions_append_only();
@@ -0,0 +1,18 @@
+-- Indexes for the handler queries; verified by scripts/explain_check.py
+
+-- loans: list newest first, list/stats by status; amount included for the active sum
+CREATE INDEX IF NOT EXISTS idx_loans_user_id_created_at ON loans(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_loans_user_id_status_created_at ON loans(user_id, status, created_at DESC) INCLUDE (amount);
+DROP INDEX IF EXISTS idx_loans_user_id;
+
+-- users: referral count and referral list newest first
+CREATE INDEX IF NOT EXISTS idx_users_referred_by_created_at ON users(referred_by, created_at DESC) WHERE referred_by IS NOT NULL;
+
+-- referral_bonuses: total/available sums index-only, bonus history newest first
+CREATE INDEX IF NOT EXISTS idx_referral_bonuses_user_id_status ON referral_bonuses(user_id, status) INCLUDE (amount);
+CREATE INDEX IF NOT EXISTS idx_referral_bonuses_user_id_created_at ON referral_bonuses(user_id, created_at DESC);
+DROP INDEX IF EXISTS idx_referral_bonuses_user_id;
+
+-- email and referral_code are already indexed by their UNIQUE constraints
+DROP INDEX IF EXISTS idx_users_email;
+DROP INDEX IF EXISTS idx_users_referral_code;
@@ -0,0 +1,39 @@
+-- Transactional outbox: handlers append events in the same transaction as the
+-- state change; scripts/outbox_worker.py dispatches them to consumers.
+
+-- txid records the writing transaction. Consumers read in (txid, id) order and
+-- only below the oldest running transaction, so an event committed late can
+-- never fall behind an offset that has already moved past it.
+CREATE TABLE IF NOT EXISTS outbox_events (
+    id BIGSERIAL PRIMARY KEY,
+    txid BIGINT NOT NULL DEFAULT txid_current(),
+    event_type VARCHAR(50) NOT NULL,
+    user_id INTEGER NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_outbox_events_txid_id ON outbox_events(txid, id);
+
+-- One row per consumer; the worker locks it FOR UPDATE SKIP LOCKED to claim a batch
+CREATE TABLE IF NOT EXISTS outbox_consumer_offsets (
+    consumer VARCHAR(100) PRIMARY KEY,
+    last_txid BIGINT NOT NULL DEFAULT 0,
+    last_event_id BIGINT NOT NULL DEFAULT 0,
+    processed BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Wake listening workers once per writing statement; the payload is empty because
+-- workers always re-read from their offsets
+CREATE OR REPLACE FUNCTION outbox_events_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('outbox_events', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS outbox_events_notify ON outbox_events;
+CREATE TRIGGER outbox_events_notify
+    AFTER INSERT ON outbox_events
+    FOR EACH STATEMENT EXECUTE FUNCTION outbox_events_notify();
@@ -0,0 +1,40 @@
+-- Per-user change notifications for scripts/event_stream.py.
+-- Payload is {"user_id": N, "resource": "..."}; identical notifications in one
+-- transaction are merged by Postgres, so a transfer (card update + ledger entry)
+-- sends a single "card" event.
+CREATE OR REPLACE FUNCTION notify_user_change() RETURNS trigger AS $$
+DECLARE
+    owner_id INTEGER;
+BEGIN
+    IF TG_TABLE_NAME = 'card_transactions' THEN
+        SELECT user_id INTO owner_id FROM virtual_cards WHERE id = NEW.card_id;
+    ELSE
+        owner_id := NEW.user_id;
+    END IF;
+
+    IF owner_id IS NOT NULL THEN
+        PERFORM pg_notify('user_changes', json_build_object('user_id', owner_id, 'resource', TG_ARGV[0])::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS virtual_cards_notify_change ON virtual_cards;
+CREATE TRIGGER virtual_cards_notify_change
+    AFTER INSERT OR UPDATE ON virtual_cards
+    FOR EACH ROW EXECUTE FUNCTION notify_user_change('card');
+
+DROP TRIGGER IF EXISTS card_transactions_notify_change ON card_transactions;
+CREATE TRIGGER card_transactions_notify_change
+    AFTER INSERT ON card_transactions
+    FOR EACH ROW EXECUTE FUNCTION notify_user_change('card');
+
+DROP TRIGGER IF EXISTS loans_notify_change ON loans;
+CREATE TRIGGER loans_notify_change
+    AFTER INSERT OR UPDATE ON loans
+    FOR EACH ROW EXECUTE FUNCTION notify_user_change('loans');
+
+DROP TRIGGER IF EXISTS referral_bonuses_notify_change ON referral_bonuses;
+CREATE TRIGGER referral_bonuses_notify_change
+    AFTER INSERT OR UPDATE ON referral_bonuses
+    FOR EACH ROW EXECUTE FUNCTION notify_user_change('referrals');
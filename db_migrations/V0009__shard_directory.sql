@@ -0,0 +1,40 @@
+-- User-id sharding. Every database gets the same schema; the directory tables
+-- are only used on the directory database (DATABASE_DIRECTORY_URL, default the
+-- first shard) and are maintained by scripts/shard_rebalance.py.
+
+-- Global identity: ids, emails and referral codes are unique across shards
+CREATE TABLE IF NOT EXISTS user_directory (
+    user_id SERIAL PRIMARY KEY,
+    email VARCHAR(255) NOT NULL UNIQUE,
+    referral_code VARCHAR(20) NOT NULL UNIQUE,
+    referred_by INTEGER,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_directory_referred_by ON user_directory(referred_by) WHERE referred_by IS NOT NULL;
+
+-- user_id % 1024 -> shard index; buckets without a row live on shard 0.
+-- moving = TRUE freezes the bucket while its rows are copied.
+CREATE TABLE IF NOT EXISTS shard_buckets (
+    bucket INTEGER PRIMARY KEY,
+    shard INTEGER NOT NULL,
+    moving BOOLEAN NOT NULL DEFAULT FALSE,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Progress of bucket moves, so an interrupted rebalance resumes where it stopped
+CREATE TABLE IF NOT EXISTS shard_moves (
+    bucket INTEGER PRIMARY KEY,
+    source INTEGER NOT NULL,
+    target INTEGER NOT NULL,
+    phase VARCHAR(20) NOT NULL,
+    phase_started_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- A referrer and the users they referred may live on different shards
+ALTER TABLE users DROP CONSTRAINT IF EXISTS users_referred_by_fkey;
+ALTER TABLE referral_bonuses DROP CONSTRAINT IF EXISTS referral_bonuses_referred_user_id_fkey;
+
+-- One registration bonus per referred user, so bonus accrual can be retried safely
+CREATE UNIQUE INDEX IF NOT EXISTS idx_referral_bonuses_registration
+    ON referral_bonuses(referred_user_id) WHERE source = 'registration';
@@ -0,0 +1,16 @@
+-- Daily portfolio risk cube written by scripts/loan_risk_report.py.
+-- One row per (term, amount band, aging bucket); roll up with SUM for any slice.
+CREATE TABLE IF NOT EXISTS loan_risk_reports (
+    report_date DATE NOT NULL,
+    term_days INTEGER NOT NULL,
+    amount_band VARCHAR(20) NOT NULL,
+    aging_bucket VARCHAR(20) NOT NULL,
+    loans BIGINT NOT NULL,
+    outstanding_amount DECIMAL(16, 2) NOT NULL,
+    matured_loans BIGINT NOT NULL,
+    expected_amount DECIMAL(16, 2) NOT NULL,
+    paid_amount DECIMAL(16, 2) NOT NULL,
+    defaulted_loans BIGINT NOT NULL,
+    generated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (report_date, term_days, amount_band, aging_bucket)
+);
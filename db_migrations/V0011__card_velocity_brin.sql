@@ -0,0 +1,6 @@
+-- Velocity counters in the card function rebuild from the last day of SBP
+-- transfers and then re-read the newest seconds of the ledger every few
+-- seconds. Rows are appended in created_at order, so a BRIN index turns both
+-- into a scan of the few most recent block ranges at almost no write cost.
+CREATE INDEX IF NOT EXISTS idx_card_transactions_created_at_brin
+    ON card_transactions USING brin (created_at) WITH (pages_per_range = 32);
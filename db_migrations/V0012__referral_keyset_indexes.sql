@@ -0,0 +1,8 @@
+-- Referral list and bonus history are paged by (created_at, id) newest first;
+-- the id tiebreak in the index keeps every page a single index range scan
+
+CREATE INDEX IF NOT EXISTS idx_users_referred_by_created_at_id ON users(referred_by, created_at DESC, id DESC) WHERE referred_by IS NOT NULL;
+DROP INDEX IF EXISTS idx_users_referred_by_created_at;
+
+CREATE INDEX IF NOT EXISTS idx_referral_bonuses_user_id_created_at_id ON referral_bonuses(user_id, created_at DESC, id DESC);
+DROP INDEX IF EXISTS idx_referral_bonuses_user_id_created_at;
@@ -0,0 +1,26 @@
+-- A registration with a referral code changes the referrer's referral stats:
+-- notify the referrer's "referrals" so dashboards and the functions' read
+-- caches pick it up, like the other triggers from V0008.
+CREATE OR REPLACE FUNCTION notify_user_change() RETURNS trigger AS $$
+DECLARE
+    owner_id INTEGER;
+BEGIN
+    IF TG_TABLE_NAME = 'card_transactions' THEN
+        SELECT user_id INTO owner_id FROM virtual_cards WHERE id = NEW.card_id;
+    ELSIF TG_TABLE_NAME = 'users' THEN
+        owner_id := NEW.referred_by;
+    ELSE
+        owner_id := NEW.user_id;
+    END IF;
+
+    IF owner_id IS NOT NULL THEN
+        PERFORM pg_notify('user_changes', json_build_object('user_id', owner_id, 'resource', TG_ARGV[0])::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_notify_referrer ON users;
+CREATE TRIGGER users_notify_referrer
+    AFTER INSERT ON users
+    FOR EACH ROW EXECUTE FUNCTION notify_user_change('referrals');
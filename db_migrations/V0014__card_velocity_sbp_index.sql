@@ -0,0 +1,9 @@
+-- Velocity counters in the card function rebuild from the last day of
+-- completed SBP transfers, oldest first, and re-read the newest seconds every
+-- few seconds. Counters are kept per card id, so both reads need only columns
+-- of the ledger: this partial index holds just those rows with what the
+-- limiter reads, making each an index-only scan in created_at order with no
+-- sort, no join and no heap pages beyond those not yet vacuumed.
+CREATE INDEX IF NOT EXISTS idx_card_transactions_sbp_created_at
+    ON card_transactions (created_at) INCLUDE (id, card_id, phone, amount)
+    WHERE type = 'sbp_transfer' AND status = 'completed';
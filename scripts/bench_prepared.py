@@ -0,0 +1,117 @@
+'''
+Business: Benchmark of server-side prepared statements on the dashboard queries
+Args: --iterations - executions per statement and mode, --users - sample users to rotate through,
+      --database-url - seeded database (see scripts/datagen.py)
+Returns: exit code 0; prints per-statement mean/p50 latency ad hoc vs prepared as JSON
+
+Ad hoc mode sends the SQL text every time (parse + plan per call, as the
+handlers did before); prepared mode uses PREPARE once and EXECUTE by name,
+exactly like execute_prepared in the handlers:
+    DATABASE_URL=... python scripts/bench_prepared.py --iterations 2000
+'''
+
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Callable
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import function_host
+
+# Statements a dashboard load runs, with parameters built from a sample user row
+DASHBOARD: Dict[str, Dict[str, Callable[[Dict[str, Any]], tuple]]] = {
+    'card': {
+        'card_by_user': lambda u: (u['user_id'],),
+        'card_id_by_user': lambda u: (u['user_id'],),
+        'card_transactions_page': lambda u: (u['card_id'], datetime(2000, 1, 1), 50)
+    },
+    'loans': {
+        'loans_by_user': lambda u: (u['user_id'],),
+        'loan_stats_active': lambda u: (u['user_id'],),
+        'loan_stats_total': lambda u: (u['user_id'],),
+        'loan_stats_repaid': lambda u: (u['user_id'],)
+    },
+    'referrals': {
+        'user_referral_code': lambda u: (u['user_id'],),
+        'referral_count': lambda u: (u['user_id'],),
+        'referral_bonus_total': lambda u: (u['user_id'],),
+        'referral_bonus_available': lambda u: (u['user_id'],)
+    }
+}
+
+def to_adhoc(sql: str) -> str:
+    '''Turn $n placeholders back into psycopg2 %s placeholders (statements use them in order)'''
+    return re.sub(r'\$\d+', '%s', sql)
+
+def timed(cur, sql: str, params: tuple) -> float:
+    started = time.perf_counter()
+    cur.execute(sql, params)
+    cur.fetchall()
+    return (time.perf_counter() - started) * 1e6
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Prepared vs ad hoc statement benchmark')
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    args = parser.parse_args()
+    
+    os.environ.setdefault('DATABASE_URL', args.database_url)
+    conn = psycopg2.connect(args.database_url, cursor_factory=RealDictCursor)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT c.user_id, c.id AS card_id FROM virtual_cards c ORDER BY c.user_id LIMIT %s",
+        (args.users,)
+    )
+    users: List[Dict[str, Any]] = cur.fetchall()
+    
+    results: Dict[str, Any] = {}
+    totals = {'adhoc_us': 0.0, 'prepared_us': 0.0}
+    for function, statements in DASHBOARD.items():
+        registry = function_host.load_function(function).PREPARED_STATEMENTS
+        for name, make_params in statements.items():
+            sql = registry[name]
+            cur.execute(f'PREPARE {name} AS {sql}')
+            execute = f'EXECUTE {name} ({", ".join(["%s"] * sql.count("$"))})'
+            
+            samples = {'adhoc': [], 'prepared': []}
+            for i in range(args.iterations):
+                params = make_params(users[i % len(users)])
+                # Interleave the two modes so cache warmth and noise affect both equally
+                samples['adhoc'].append(timed(cur, to_adhoc(sql), params))
+                samples['prepared'].append(timed(cur, execute, params))
+            cur.execute(f'DEALLOCATE {name}')
+            
+            adhoc_mean = statistics.fmean(samples['adhoc'])
+            prepared_mean = statistics.fmean(samples['prepared'])
+            totals['adhoc_us'] += adhoc_mean
+            totals['prepared_us'] += prepared_mean
+            results[f'{function}.{name}'] = {
+                'adhoc_mean_us': round(adhoc_mean, 1),
+                'prepared_mean_us': round(prepared_mean, 1),
+                'adhoc_p50_us': round(statistics.median(samples['adhoc']), 1),
+                'prepared_p50_us': round(statistics.median(samples['prepared']), 1),
+                'saving_pct': round(100 * (1 - prepared_mean / adhoc_mean), 1)
+            }
+    
+    cur.close()
+    conn.close()
+    
+    results['dashboard_total'] = {
+        'adhoc_us': round(totals['adhoc_us'], 1),
+        'prepared_us': round(totals['prepared_us'], 1),
+        'saving_pct': round(100 * (1 - totals['prepared_us'] / totals['adhoc_us']), 1)
+    }
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+'''
+Business: Maintenance of monthly card_transactions partitions
+Args: ensure  [--months-ahead N] - create partitions for the coming months (run daily)
+      archive --older-than-months N --out DIR [--keep] - stream old partitions to
+              gzip-compressed NDJSON, record them in DIR/manifest.json, then detach them
+Returns: exit code 0 on success; prints a JSON summary
+
+    DATABASE_URL=... python scripts/card_transactions_partitions.py ensure --months-ahead 3
+    DATABASE_URL=... python scripts/card_transactions_partitions.py archive --older-than-months 12 --out /var/archive
+With DATABASE_SHARDS set, every shard is maintained in turn and each shard's
+archive goes to its own DIR/shard-<N> with its own manifest.
+'''
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+from datetime import date, datetime
+from typing import Dict, Any, List, Callable
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from sharding import shard_urls, is_sharded
+
+PARTITION_NAME = re.compile(r'^card_transactions_(\d{4})_(\d{2})$')
+
+def month_shift(month: date, months: int) -> date:
+    '''First day of the month shifted by a number of months'''
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def monthly_tables(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''Tables named like monthly partitions with their range, oldest first'''
+    partitions = []
+    for row in rows:
+        match = PARTITION_NAME.match(row['name'])
+        if match:
+            start = date(int(match.group(1)), int(match.group(2)), 1)
+            partitions.append({'name': row['name'], 'from': start, 'to': month_shift(start, 1)})
+    return sorted(partitions, key=lambda p: p['from'])
+
+def list_partitions(cur) -> List[Dict[str, Any]]:
+    '''Attached monthly partitions with their range, oldest first'''
+    cur.execute(
+        """SELECT c.relname AS name
+           FROM pg_inherits i
+           JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = 'card_transactions'::regclass"""
+    )
+    return monthly_tables(cur.fetchall())
+
+def list_detached(cur) -> List[Dict[str, Any]]:
+    '''Monthly partition tables that are no longer attached to card_transactions'''
+    cur.execute(
+        """SELECT c.relname AS name
+           FROM pg_class c
+           WHERE c.relkind = 'r' AND pg_table_is_visible(c.oid)
+             AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = c.oid)"""
+    )
+    return monthly_tables(cur.fetchall())
+
+def ensure(conn, months_ahead: int) -> Dict[str, Any]:
+    '''Create missing partitions up to months_ahead months from now'''
+    cur = conn.cursor()
+    cur.execute("SELECT create_card_transaction_partitions(NOW()::date, %s) AS created", (months_ahead,))
+    created = cur.fetchone()['created']
+    conn.commit()
+    cur.close()
+    return {'created': created}
+
+def check_snapshots(cur, partition: str) -> int:
+    '''Count cards whose balance still depends on entries in the partition'''
+    cur.execute(
+        f"""SELECT COUNT(*) AS uncovered
+            FROM (SELECT card_id, MAX(id) AS position FROM {partition} GROUP BY card_id) p
+            WHERE NOT EXISTS (
+                SELECT 1 FROM card_balance_snapshots s
+                WHERE s.card_id = p.card_id AND s.ledger_position >= p.position
+            )"""
+    )
+    return cur.fetchone()['uncovered']
+
+def archive_partition(conn, partition: Dict[str, Any], out_dir: str, keep: bool, attached: bool,
+                      record: Callable[[Dict[str, Any]], None]) -> Dict[str, Any]:
+    '''
+    Stream one partition to a compressed NDJSON file and record it, then
+    detach (and drop) it in the same transaction: a failed dump leaves the
+    partition attached for the next run
+    '''
+    name = partition['name']
+    cur = conn.cursor()
+    # No row can be added or changed between the dump and the detach
+    cur.execute(f"LOCK TABLE {name} IN SHARE MODE")
+    
+    path = os.path.join(out_dir, f'{name}.ndjson.gz')
+    rows = 0
+    stream = conn.cursor(name=f'archive_{name}')
+    stream.itersize = 10000
+    stream.execute(f"SELECT * FROM {name} ORDER BY id")
+    with gzip.open(path, 'wt', encoding='utf-8') as out:
+        for row in stream:
+            out.write(json.dumps(row, default=str, ensure_ascii=False))
+            out.write('\n')
+            rows += 1
+        out.flush()
+    stream.close()
+    
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+        digest = hashlib.sha256(f.read()).hexdigest()
+    
+    entry = {
+        'partition': name,
+        'from': partition['from'].isoformat(),
+        'to': partition['to'].isoformat(),
+        'rows': rows,
+        'file': os.path.basename(path),
+        'sha256': digest,
+        'archived_at': datetime.utcnow().isoformat(),
+        'dropped': not keep
+    }
+    # Recorded before the commit: if the commit fails the partition is still
+    # there and the next run archives it again, replacing this entry
+    record(entry)
+    
+    if attached:
+        cur.execute(f"ALTER TABLE card_transactions DETACH PARTITION {name}")
+    if not keep:
+        cur.execute(f"DROP TABLE {name}")
+    conn.commit()
+    cur.close()
+    return entry
+
+def archive(conn, older_than_months: int, out_dir: str, keep: bool) -> Dict[str, Any]:
+    '''Archive every partition that ends before the cutoff month'''
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, 'manifest.json')
+    manifest: List[Dict[str, Any]] = []
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    
+    def record(entry: Dict[str, Any]) -> None:
+        manifest[:] = [e for e in manifest if e['partition'] != entry['partition']] + [entry]
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+    
+    cutoff = month_shift(date.today().replace(day=1), -older_than_months)
+    cur = conn.cursor()
+    archived = []
+    
+    # Detached by an interrupted run of an earlier version of this job, which
+    # detached before dumping: their rows are in no table a rerun would read.
+    # Kept tables (--keep) are in the manifest already
+    recorded = {e['partition'] for e in manifest}
+    orphaned = [p for p in list_detached(cur) if p['name'] not in recorded]
+    conn.commit()
+    for partition in orphaned:
+        archived.append(archive_partition(conn, partition, out_dir, keep, False, record))
+    
+    for partition in list_partitions(cur):
+        if partition['to'] > cutoff:
+            continue
+        
+        # Ledger balances are computed from the last snapshot onwards, so every
+        # card must have a snapshot past this partition before its rows go cold
+        uncovered = check_snapshots(cur, partition['name'])
+        conn.commit()
+        if uncovered:
+            print(f"{partition['name']}: {uncovered} cards have no snapshot past this partition, "
+                  f"run scripts/reconcile_card_ledger.py --snapshot first", file=sys.stderr)
+            break
+        
+        archived.append(archive_partition(conn, partition, out_dir, keep, True, record))
+    
+    cur.close()
+    return {'archived': archived}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Maintain card_transactions partitions')
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    ensure_parser = commands.add_parser('ensure')
+    ensure_parser.add_argument('--months-ahead', type=int, default=3)
+    
+    archive_parser = commands.add_parser('archive')
+    archive_parser.add_argument('--older-than-months', type=int, required=True)
+    archive_parser.add_argument('--out', required=True)
+    archive_parser.add_argument('--keep', action='store_true', help='keep detached tables instead of dropping them')
+    
+    args = parser.parse_args()
+    
+    results = []
+    for shard, url in enumerate(shard_urls()):
+        conn = psycopg2.connect(url, cursor_factory=RealDictCursor)
+        try:
+            if args.command == 'ensure':
+                result = ensure(conn, args.months_ahead)
+            else:
+                out_dir = os.path.join(args.out, f'shard-{shard}') if is_sharded() else args.out
+                result = archive(conn, args.older_than_months, out_dir, args.keep)
+        finally:
+            conn.close()
+        results.append({'shard': shard, **result} if is_sharded() else result)
+    
+    print(json.dumps({'shards': results} if is_sharded() else results[0], ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+'''
+Business: Synthetic production-scale dataset - users, loans, cards, card transactions, referral bonuses
+Args: --users - number of users, --workers - parallel loader processes, --seed - RNG seed,
+      --chunk-size - users per chunk, --start/--days - time span of generated activity,
+      --truncate - wipe the tables first
+Returns: exit code 0; prints per-table row counts and elapsed time
+
+Each chunk of users is generated from its own Random(seed, chunk) and loaded
+with COPY in its own transaction, so the data does not depend on the number
+of workers. Users, cards and their columns are fully deterministic; ids of
+loans, transactions and bonuses follow load order.
+Loading uses session_replication_role = replica to skip FK triggers between
+parallel chunks, which needs a superuser - use a local benchmark database:
+    DATABASE_URL=... python scripts/datagen.py --users 1000000 --workers 8 --truncate
+'''
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from typing import Dict, Any, List, Optional
+
+import psycopg2
+
+PASSWORD_HASH = hashlib.sha256(b'password').hexdigest()
+
+# Referral tree: a few huge affiliates take a large share of all referrals
+AFFILIATES = 10
+AFFILIATE_SHARE = 0.35
+REFERRED_SHARE = 0.30
+
+LOAN_STATUSES = ['pending', 'approved', 'active', 'repaid', 'rejected', 'overdue']
+LOAN_STATUS_WEIGHTS = [10, 5, 20, 50, 10, 5]
+LOAN_PURPOSES = ['Личные нужды', 'Ремонт', 'Путешествие', 'Техника', 'Образование', 'Лечение']
+MAX_LOANS_PER_USER = 40
+
+CARD_SHARE = 0.7
+MAX_TRANSACTIONS_PER_CARD = 20000
+
+COPY_FLUSH_ROWS = 50000
+
+TABLE_COLUMNS = {
+    'users': 'id, email, password_hash, phone, name, referral_code, referred_by, created_at',
+    'loans': ('user_id, amount, term_days, interest_rate, interest_amount, total_repayment, paid_amount, '
+              'purpose, status, created_at, due_date, approved_at, disbursed_at, repaid_at'),
+    'virtual_cards': 'id, user_id, card_number, balance, status, created_at',
+    'card_transactions': 'card_id, type, amount, signed_amount, phone, comment, status, created_at',
+    'referral_bonuses': 'user_id, referred_user_id, amount, source, status, created_at'
+}
+
+class CopyBuffer:
+    '''Accumulates rows in COPY text format and flushes them in batches'''
+    
+    def __init__(self, cur, table: str):
+        self.cur = cur
+        self.table = table
+        self.buffer = io.StringIO()
+        self.pending = 0
+        self.total = 0
+    
+    def add(self, *values: Any) -> None:
+        self.buffer.write('\t'.join('\\N' if v is None else str(v) for v in values))
+        self.buffer.write('\n')
+        self.pending += 1
+        if self.pending >= COPY_FLUSH_ROWS:
+            self.flush()
+    
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        self.buffer.seek(0)
+        self.cur.copy_expert(f'COPY {self.table} ({TABLE_COLUMNS[self.table]}) FROM STDIN', self.buffer)
+        self.total += self.pending
+        self.buffer = io.StringIO()
+        self.pending = 0
+
+def luhn_card_number(user_id: int) -> str:
+    '''Deterministic Luhn-valid card number derived from the user id'''
+    body = '220071' + str(user_id).zfill(9)
+    total = 0
+    for i, ch in enumerate(reversed(body)):
+        d = int(ch)
+        if i % 2 == 0:
+            d = d * 2 - 9 if d > 4 else d * 2
+        total += d
+    return body + str((10 - total % 10) % 10)
+
+def pick_referrer(rng: random.Random, user_id: int, affiliate_weights: List[float]) -> Optional[int]:
+    if user_id <= AFFILIATES or rng.random() >= REFERRED_SHARE:
+        return None
+    if rng.random() < AFFILIATE_SHARE:
+        return rng.choices(range(1, AFFILIATES + 1), affiliate_weights)[0]
+    return rng.randrange(1, user_id)
+
+def generate_loans(rng: random.Random, loans: CopyBuffer, user_id: int, since: datetime, end: datetime) -> None:
+    # Heavy tail: most users have 0-2 loans, a few have dozens
+    count = min(int(rng.paretovariate(1.3)) - 1, MAX_LOANS_PER_USER)
+    for _ in range(count):
+        amount = rng.randrange(1000, 100001, 500)
+        term_days = rng.choice([7, 14, 21, 30, 45, 60, 90])
+        interest = round(amount * 0.003 * term_days, 2)
+        total = amount + interest
+        created_at = since + (end - since) * rng.random()
+        due_date = created_at + timedelta(days=term_days)
+        status = rng.choices(LOAN_STATUSES, LOAN_STATUS_WEIGHTS)[0]
+        
+        approved_at = disbursed_at = repaid_at = None
+        paid = 0.0
+        if status in ('approved', 'active', 'repaid', 'overdue'):
+            approved_at = created_at + timedelta(minutes=rng.randrange(5, 600))
+        if status in ('active', 'repaid', 'overdue'):
+            disbursed_at = approved_at + timedelta(minutes=rng.randrange(1, 120))
+            paid = round(total * rng.random() * (0.5 if status == 'overdue' else 1.0), 2)
+        if status == 'repaid':
+            repaid_at = due_date - timedelta(days=rng.randrange(0, term_days))
+            paid = total
+        
+        loans.add(user_id, amount, term_days, '0.0030', interest, total, paid, rng.choice(LOAN_PURPOSES), status,
+                  created_at, due_date, approved_at, disbursed_at, repaid_at)
+
+def generate_card(rng: random.Random, cards: CopyBuffer, transactions: CopyBuffer, user_id: int,
+                  since: datetime, end: datetime) -> None:
+    # Heavy tail: mean of a few dozen transactions, some cards with thousands
+    count = min(int(rng.paretovariate(1.1) * 3) - 3, MAX_TRANSACTIONS_PER_CARD)
+    created_at = since + timedelta(minutes=rng.randrange(0, 60))
+    step = (end - created_at) / (count + 1)
+    balance = 0.0
+    moment = created_at
+    for _ in range(count):
+        moment += step * (2 * rng.random())
+        if moment > end:
+            moment = end
+        amount = round(rng.uniform(100, 20000), 2)
+        if balance < amount or rng.random() < 0.3:
+            kind, signed = rng.choice(['deposit', 'loan_disbursement']), amount
+            phone = None
+        else:
+            kind, signed = 'sbp_transfer', -amount
+            phone = '+7900' + str(rng.randrange(10 ** 7)).zfill(7)
+        balance = round(balance + signed, 2)
+        transactions.add(user_id, kind, amount, signed, phone, None, 'completed', moment)
+    cards.add(user_id, user_id, luhn_card_number(user_id), balance, 'active', created_at)
+
+def load_chunk(task: Dict[str, Any]) -> Dict[str, int]:
+    '''Generate and COPY one chunk of users with all their dependent rows'''
+    rng = random.Random(f"{task['seed']}:{task['chunk']}")
+    affiliate_weights = [1.0 / k for k in range(1, AFFILIATES + 1)]
+    start, days, total_users = task['start'], task['days'], task['total_users']
+    end = start + timedelta(days=days)
+    
+    conn = psycopg2.connect(task['database_url'])
+    cur = conn.cursor()
+    cur.execute("SET session_replication_role = replica")
+    buffers = {table: CopyBuffer(cur, table) for table in TABLE_COLUMNS}
+    
+    for user_id in range(task['first_id'], task['last_id'] + 1):
+        created_at = start + timedelta(days=days * (user_id - 1) / total_users, seconds=rng.randrange(3600))
+        referrer = pick_referrer(rng, user_id, affiliate_weights)
+        buffers['users'].add(user_id, f'user{user_id}@example.com', PASSWORD_HASH,
+                             '+7999' + str(user_id % 10 ** 7).zfill(7), f'User {user_id}',
+                             f'R{user_id:x}', referrer, created_at)
+        
+        if referrer:
+            buffers['referral_bonuses'].add(referrer, user_id, 500, 'registration',
+                                            rng.choice(['available', 'available', 'withdrawn']), created_at)
+        
+        generate_loans(rng, buffers['loans'], user_id, created_at, end)
+        if rng.random() < CARD_SHARE:
+            generate_card(rng, buffers['virtual_cards'], buffers['card_transactions'], user_id, created_at, end)
+    
+    for buffer in buffers.values():
+        buffer.flush()
+    conn.commit()
+    cur.close()
+    conn.close()
+    return {table: buffer.total for table, buffer in buffers.items()}
+
+def prepare(database_url: str, start: datetime, truncate: bool) -> None:
+    conn = psycopg2.connect(database_url)
+    cur = conn.cursor()
+    if truncate:
+        cur.execute("""TRUNCATE users, loans, virtual_cards, card_transactions, referral_bonuses,
+                       card_balance_snapshots, card_number_pool RESTART IDENTITY CASCADE""")
+    cur.execute("SELECT create_card_transaction_partitions(%s::date, 3)", (start,))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def finish(database_url: str) -> None:
+    '''Move sequences past the loaded ids and refresh planner statistics'''
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    cur = conn.cursor()
+    for table in ('users', 'loans', 'virtual_cards', 'card_transactions', 'referral_bonuses'):
+        cur.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)")
+        cur.execute(f"ANALYZE {table}")
+    cur.close()
+    conn.close()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Generate a synthetic production-scale dataset')
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--start', default='2024-01-01')
+    parser.add_argument('--days', type=int, default=720)
+    parser.add_argument('--truncate', action='store_true')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    args = parser.parse_args()
+    
+    started = time.time()
+    start = datetime.fromisoformat(args.start)
+    prepare(args.database_url, start, args.truncate)
+    
+    tasks = [{
+        'database_url': args.database_url,
+        'seed': args.seed,
+        'chunk': chunk,
+        'first_id': first_id,
+        'last_id': min(first_id + args.chunk_size - 1, args.users),
+        'total_users': args.users,
+        'start': start,
+        'days': args.days
+    } for chunk, first_id in enumerate(range(1, args.users + 1, args.chunk_size))]
+    
+    totals = {table: 0 for table in TABLE_COLUMNS}
+    with Pool(args.workers) as pool:
+        for counts in pool.imap_unordered(load_chunk, tasks):
+            for table, count in counts.items():
+                totals[table] += count
+    
+    finish(args.database_url)
+    totals['elapsed_seconds'] = round(time.time() - started, 1)
+    print(json.dumps(totals, indent=2))
+
+if __name__ == '__main__':
+    main()
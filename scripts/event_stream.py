@@ -0,0 +1,276 @@
+'''
+Business: Real-time dashboard updates - Server-Sent Events stream of per-user change events
+Args: --port - port to listen on, --host - interface to bind, --heartbeat - seconds between keep-alive comments
+Returns: runs until interrupted; GET /events?token=<jwt> streams "change" events for the token's user
+
+Cloud functions answer one request and exit, so the stream runs as its own
+long-lived process next to them. Triggers from V0008/V0013 send NOTIFY user_changes
+with {"user_id", "resource"}; a single LISTEN connection fans each one out to
+that user's open streams in-process. Clients refetch only the changed
+resource ("card", "loans" or "referrals") instead of polling:
+    DATABASE_URL=... JWT_SECRET=... python scripts/event_stream.py --port 8010
+Point the frontend at it with VITE_EVENTS_URL=http://host:8010; without it the
+dashboard refetches only after the user's own actions.
+
+EventSource cannot set headers, so the token comes in the query string. A
+stream closes when its token expires; the browser reconnects with a new one.
+After the LISTEN connection drops, every stream gets a "resync" event because
+notifications sent meanwhile are lost. With DATABASE_SHARDS set, the hub
+keeps one LISTEN connection per shard.
+'''
+
+import argparse
+import json
+import os
+import select
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Optional, Set
+from urllib.parse import urlsplit, parse_qsl
+
+import jwt
+import psycopg2
+
+from sharding import shard_urls
+
+# Must match the functions
+JWT_SECRET = os.environ.get('JWT_SECRET', 'labubu-finance-secret-key-2024')
+JWT_ALGORITHM = 'HS256'
+
+NOTIFY_CHANNEL = 'user_changes'
+MAX_STREAMS_PER_USER = 10
+RECONNECT_DELAY_SECONDS = (1, 2, 5, 10)
+LISTEN_IDLE_CHECK_SECONDS = 60  # an idle LISTEN connection is probed after this long
+# TCP keepalives: a peer that vanished without closing the connection fails within ~1 min
+LISTEN_KEEPALIVES = {'keepalives': 1, 'keepalives_idle': 30, 'keepalives_interval': 10, 'keepalives_count': 3}
+CLIENT_RETRY_MS = 3000
+
+class Subscriber:
+    '''One open stream: pending resources coalesce until the stream writes them'''
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._pending: Set[str] = set()
+        self._cond = threading.Condition()
+
+    def push(self, resource: str) -> None:
+        with self._cond:
+            self._pending.add(resource)
+            self._cond.notify()
+
+    def wait(self, timeout: float) -> Set[str]:
+        '''Block until something changed or timeout; returns and clears pending resources'''
+        with self._cond:
+            if not self._pending:
+                self._cond.wait(timeout)
+            pending, self._pending = self._pending, set()
+            return pending
+
+class ChangeHub:
+    '''Shared LISTEN connection (one per shard) fanning notifications out to subscribers'''
+
+    def __init__(self):
+        self._subscribers: Dict[int, Set[Subscriber]] = {}
+        self._lock = threading.Lock()
+        self.notifications = 0
+        self.reconnects = 0
+
+    def subscribe(self, user_id: int) -> Optional[Subscriber]:
+        with self._lock:
+            streams = self._subscribers.setdefault(user_id, set())
+            if len(streams) >= MAX_STREAMS_PER_USER:
+                return None
+            subscriber = Subscriber(user_id)
+            streams.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            streams = self._subscribers.get(subscriber.user_id)
+            if streams is None:
+                return
+            streams.discard(subscriber)
+            if not streams:
+                del self._subscribers[subscriber.user_id]
+
+    def stream_count(self) -> int:
+        with self._lock:
+            return sum(len(streams) for streams in self._subscribers.values())
+
+    def dispatch(self, payload: str) -> None:
+        try:
+            change = json.loads(payload)
+            user_id, resource = int(change['user_id']), str(change['resource'])
+        except (ValueError, KeyError, TypeError):
+            return
+
+        self.notifications += 1
+        with self._lock:
+            streams = list(self._subscribers.get(user_id, ()))
+        for subscriber in streams:
+            subscriber.push(resource)
+
+    def broadcast(self, resource: str) -> None:
+        with self._lock:
+            streams = [s for group in self._subscribers.values() for s in group]
+        for subscriber in streams:
+            subscriber.push(resource)
+
+    def run(self, dsn: str) -> None:
+        '''Listen on one database forever, reconnecting with backoff'''
+        attempt = 0
+        connected_before = False
+        while True:
+            try:
+                conn = psycopg2.connect(dsn, **LISTEN_KEEPALIVES)
+            except psycopg2.OperationalError as e:
+                delay = RECONNECT_DELAY_SECONDS[min(attempt, len(RECONNECT_DELAY_SECONDS) - 1)]
+                print(json.dumps({'listen': 'connect_failed', 'error': str(e).strip(), 'retry_in': delay}))
+                attempt += 1
+                time.sleep(delay)
+                continue
+
+            conn.autocommit = True
+            conn.cursor().execute(f'LISTEN {NOTIFY_CHANNEL}')
+            if connected_before:
+                # Changes committed while disconnected were never delivered
+                self.reconnects += 1
+                self.broadcast('resync')
+            connected_before = True
+            attempt = 0
+
+            try:
+                while True:
+                    if select.select([conn], [], [], LISTEN_IDLE_CHECK_SECONDS)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            self.dispatch(conn.notifies.pop(0).payload)
+                    else:
+                        # Quiet for a while: make sure the server is still there,
+                        # a failed round trip reconnects
+                        conn.cursor().execute('SELECT 1')
+            except (psycopg2.Error, OSError) as e:
+                print(json.dumps({'listen': 'lost', 'error': str(e).strip()}))
+            finally:
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+            attempt += 1
+
+def verify_token(token: str) -> Optional[Dict[str, Any]]:
+    '''Verify JWT token and return payload'''
+    try:
+        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+
+def make_request_handler(hub: ChangeHub, heartbeat: float):
+    '''HTTP request handler class serving /events and /health'''
+
+    class EventStreamHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_OPTIONS(self) -> None:
+            self.send_response(200)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
+            self.send_header('Access-Control-Max-Age', '86400')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_GET(self) -> None:
+            parts = urlsplit(self.path)
+            if parts.path == '/health':
+                self._send_json(200, {'streams': hub.stream_count(), 'notifications': hub.notifications,
+                                      'reconnects': hub.reconnects})
+                return
+            if parts.path != '/events':
+                self._send_json(404, {'error': 'Not found'})
+                return
+
+            payload = verify_token(dict(parse_qsl(parts.query)).get('token', ''))
+            if not payload:
+                self._send_json(401, {'error': 'Недействительный токен'})
+                return
+
+            subscriber = hub.subscribe(int(payload['user_id']))
+            if subscriber is None:
+                self._send_json(429, {'error': 'Слишком много открытых соединений'})
+                return
+
+            try:
+                self._stream(subscriber, payload.get('exp'))
+            except (BrokenPipeError, ConnectionResetError, TimeoutError):
+                pass
+            finally:
+                hub.unsubscribe(subscriber)
+                self.close_connection = True
+
+        def _stream(self, subscriber: Subscriber, expires_at: Optional[int]) -> None:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'keep-alive')
+            self.send_header('X-Accel-Buffering', 'no')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self._write(f'retry: {CLIENT_RETRY_MS}\nevent: ready\ndata: {{}}\n\n')
+
+            while expires_at is None or time.time() < expires_at:
+                changed = subscriber.wait(heartbeat)
+                if not changed:
+                    self._write(': heartbeat\n\n')
+                    continue
+                for resource in sorted(changed):
+                    event = 'resync' if resource == 'resync' else 'change'
+                    self._write(f'event: {event}\ndata: {json.dumps({"resource": resource})}\n\n')
+
+            self._write('event: token_expired\ndata: {}\n\n')
+
+        def _write(self, chunk: str) -> None:
+            self.wfile.write(chunk.encode('utf-8'))
+            self.wfile.flush()
+
+        def _send_json(self, status: int, body: Dict[str, Any]) -> None:
+            payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    return EventStreamHandler
+
+def serve(host: str, port: int, heartbeat: float) -> ThreadingHTTPServer:
+    '''Start the shared listeners and create the stream server (not started)'''
+    hub = ChangeHub()
+    for index, dsn in enumerate(shard_urls()):
+        threading.Thread(target=hub.run, args=(dsn,), name=f'listen-{index}', daemon=True).start()
+    server = ThreadingHTTPServer((host, port), make_request_handler(hub, heartbeat))
+    server.daemon_threads = True
+    return server
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Stream per-user change events over SSE')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8010)
+    parser.add_argument('--heartbeat', type=float, default=15)
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.heartbeat)
+    print(f'Streaming change events on http://{args.host}:{args.port}/events?token=...')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+'''
+Business: Query plan regression check for every SQL statement in the backend handlers
+Args: --budgets - JSON file with per-statement buffer budgets (default: explain_budgets.json),
+      --database-url - a large seeded database (see scripts/datagen.py)
+Returns: exit code 1 if any statement seq-scans a large table, sorts on the fly,
+         exceeds its buffer budget, or has no sample parameters registered below
+
+SQL is extracted from backend/*/index.py with ast, so the check always runs
+the statements that are deployed. Each statement is identified by
+"<function>:<qualified python function>:<ordinal>", or by
+"<function>:PREPARED_STATEMENTS.<name>" for prepared statements (checked with
+their generic plan), and runs under EXPLAIN (ANALYZE, BUFFERS) inside a
+transaction that is rolled back.
+    DATABASE_URL=... python scripts/explain_check.py
+'''
+
+import argparse
+import ast
+import json
+import os
+import sys
+import uuid
+from datetime import datetime
+from typing import Dict, Any, List, Callable, Tuple
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BACKEND_DIR = os.path.join(ROOT_DIR, 'backend')
+DEFAULT_BUDGETS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'explain_budgets.json')
+
+SQL_PREFIXES = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+# Tables small enough (or LIMIT 1 claims) where a sequential scan is expected
+SEQ_SCAN_ALLOWED = {'card_number_pool', 'shard_buckets'}
+SEQ_SCAN_MIN_ROWS = 1000
+
+# Classes whose SQL runs against the local SQLite read cache, not Postgres
+NON_POSTGRES_CLASSES = {'SqliteCacheStore'}
+DEFAULT_BUFFER_BUDGET = 1000
+
+# Sample parameters per statement, built from the worst-case rows of the dataset
+PARAMS: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+    'auth:PostgresCounterStore.add:0': lambda s: (['email:explain@example.com'], [0], [1]),
+    'auth:PostgresCounterStore.add:1': lambda s: (0,),
+    'auth:register_user:0': lambda s: {'email': s['new_email'], 'password_hash': 'x' * 64, 'phone': '+79990000000',
+                                       'name': 'Explain', 'user_referral_code': s['new_code'],
+                                       'referral_code': s['referral_code']},
+    'auth:register_user_sharded:0': lambda s: {'user_id': 2 ** 31 - 1, 'email': s['new_email'], 'password_hash': 'x' * 64,
+                                               'phone': '+79990000000', 'name': 'Explain', 'user_referral_code': s['new_code'],
+                                               'referred_by': s['user_id']},
+    'auth:register_user_sharded:1': lambda s: {'email': s['new_email'], 'user_referral_code': s['new_code'],
+                                               'referral_code': s['referral_code']},
+    'auth:register_user_sharded:2': lambda s: (0,),
+    'auth:lookup_user_id:0': lambda s: (s['email'],),
+    'auth:ShardMap.load:0': lambda s: (),
+    'auth:PREPARED_STATEMENTS.user_login': lambda s: (s['email'], s['password_hash']),
+    'auth:PREPARED_STATEMENTS.user_profile': lambda s: (s['user_id'],),
+    
+    'card:ShardMap.load:0': lambda s: (),
+    'card:PREPARED_STATEMENTS.card_by_user': lambda s: (s['card_user_id'],),
+    'card:get_or_create_card:0': lambda s: {'user_id': s['card_user_id']},
+    'card:get_or_create_card:1': lambda s: (s['card_user_id'], '2200700000000000'),
+    'card:debit_sbp_transfer:0': lambda s: {'user_id': s['card_user_id'], 'amount': 1, 'phone': '+79000000000', 'comment': ''},
+    'card:debit_sbp_transfer:1': lambda s: (s['card_user_id'],),
+    'card:VelocityLimiter.rebuild:0': lambda s: (),
+    'card:VelocityLimiter.sync_shard:0': lambda s: (32,),
+    'card:get_card_balance_at:0': lambda s: {'user_id': s['card_user_id'], 'as_of': s['now']},
+    'card:PREPARED_STATEMENTS.card_id_by_user': lambda s: (s['card_user_id'],),
+    'card:PREPARED_STATEMENTS.card_transactions_page': lambda s: (s['card_id'], s['history_start'], 50),
+    
+    'loans:ShardMap.load:0': lambda s: (),
+    'loans:create_loan_application:0': lambda s: {'user_id': s['loans_user_id'], 'amount': 10000, 'term_days': 30,
+                                                  'rate': 0.003, 'interest': 900, 'total': 10900,
+                                                  'purpose': 'Explain', 'due_date': s['now']},
+    'loans:PREPARED_STATEMENTS.loans_by_user_status': lambda s: (s['loans_user_id'], 'active'),
+    'loans:PREPARED_STATEMENTS.loans_by_user': lambda s: (s['loans_user_id'],),
+    'loans:PREPARED_STATEMENTS.loan_by_id': lambda s: (s['loan_id'], s['loans_user_id']),
+    'loans:PREPARED_STATEMENTS.loan_stats_active': lambda s: (s['loans_user_id'],),
+    'loans:PREPARED_STATEMENTS.loan_stats_total': lambda s: (s['loans_user_id'],),
+    'loans:PREPARED_STATEMENTS.loan_stats_repaid': lambda s: (s['loans_user_id'],),
+    
+    'referrals:ShardMap.load:0': lambda s: (),
+    'referrals:get_referral_stats:0': lambda s: (s['referrer_id'],),
+    'referrals:lookup_users:0': lambda s: ([s['referrer_id'], s['user_id']],),
+    'referrals:PREPARED_STATEMENTS.user_referral_code': lambda s: (s['referrer_id'],),
+    'referrals:PREPARED_STATEMENTS.referral_count': lambda s: (s['referrer_id'],),
+    'referrals:PREPARED_STATEMENTS.referral_bonus_total': lambda s: (s['referrer_id'],),
+    'referrals:PREPARED_STATEMENTS.referral_bonus_available': lambda s: (s['referrer_id'],),
+    'referrals:PREPARED_STATEMENTS.referral_list': lambda s: (s['referrer_id'], s['now'], 2 ** 31 - 1, 50),
+    'referrals:PREPARED_STATEMENTS.bonus_history': lambda s: (s['referrer_id'], s['now'], 2 ** 31 - 1, 50),
+}
+
+def is_sql(value: Any) -> bool:
+    return isinstance(value, str) and value.lstrip().upper().startswith(SQL_PREFIXES)
+
+def extract_statements() -> Dict[str, str]:
+    '''Collect SQL string literals from every handler, keyed by function:qualname:ordinal'''
+    statements: Dict[str, str] = {}
+    for name in sorted(os.listdir(BACKEND_DIR)):
+        path = os.path.join(BACKEND_DIR, name, 'index.py')
+        if not os.path.isfile(path):
+            continue
+        with open(path, encoding='utf-8') as f:
+            tree = ast.parse(f.read())
+        
+        def visit(node: ast.AST, prefix: str) -> None:
+            for child in ast.iter_child_nodes(node):
+                if isinstance(child, ast.ClassDef):
+                    if child.name not in NON_POSTGRES_CLASSES:
+                        visit(child, prefix + child.name + '.')
+                elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    literals = [n.value for n in ast.walk(child) if isinstance(n, ast.Constant) and is_sql(n.value)]
+                    for ordinal, sql in enumerate(literals):
+                        statements[f'{name}:{prefix}{child.name}:{ordinal}'] = sql
+        
+        visit(tree, '')
+        
+        # Named statements registered for server-side PREPARE
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and isinstance(node.value, ast.Dict) \
+                    and any(isinstance(t, ast.Name) and t.id == 'PREPARED_STATEMENTS' for t in node.targets):
+                for key, value in zip(node.value.keys, node.value.values):
+                    statements[f'{name}:PREPARED_STATEMENTS.{key.value}'] = value.value
+    return statements
+
+def sample_rows(cur) -> Dict[str, Any]:
+    '''Pick the heaviest users for each area so the plans are checked at their worst'''
+    sample: Dict[str, Any] = {'now': datetime.now(), 'new_email': f'explain-{uuid.uuid4().hex}@example.com',
+                              'new_code': uuid.uuid4().hex[:12]}
+    
+    cur.execute("SELECT id, email, password_hash, referral_code FROM users ORDER BY id LIMIT 1")
+    user = cur.fetchone()
+    sample.update({'user_id': user['id'], 'email': user['email'], 'password_hash': user['password_hash'],
+                   'referral_code': user['referral_code']})
+    
+    cur.execute("SELECT referred_by FROM users WHERE referred_by IS NOT NULL GROUP BY referred_by ORDER BY COUNT(*) DESC LIMIT 1")
+    sample['referrer_id'] = (cur.fetchone() or {'referred_by': user['id']})['referred_by']
+    
+    cur.execute("SELECT user_id, MAX(id) AS loan_id FROM loans GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1")
+    row = cur.fetchone() or {'user_id': user['id'], 'loan_id': 0}
+    sample['loans_user_id'], sample['loan_id'] = row['user_id'], row['loan_id']
+    
+    cur.execute("""SELECT c.id, c.user_id FROM virtual_cards c
+                   JOIN (SELECT card_id FROM card_transactions GROUP BY card_id ORDER BY COUNT(*) DESC LIMIT 1) t
+                   ON t.card_id = c.id""")
+    row = cur.fetchone() or {'id': 0, 'user_id': user['id']}
+    sample['card_id'], sample['card_user_id'] = row['id'], row['user_id']
+    
+    now = sample['now']
+    month_index = now.year * 12 + now.month - 1 - 12
+    sample['history_start'] = datetime(month_index // 12, month_index % 12 + 1, 1)
+    return sample
+
+def walk(plan: Dict[str, Any]):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from walk(child)
+
+def check_plan(plan: Dict[str, Any], budget: int) -> List[str]:
+    '''Problems found in one EXPLAIN (FORMAT JSON) plan'''
+    problems = []
+    for node in walk(plan):
+        node_type = node['Node Type']
+        if node_type == 'Seq Scan' and node.get('Relation Name') not in SEQ_SCAN_ALLOWED \
+                and node.get('_relation_rows', 0) >= SEQ_SCAN_MIN_ROWS:
+            problems.append(f"seq scan on {node.get('Relation Name')}")
+        if node_type in ('Sort', 'Incremental Sort'):
+            problems.append(f"{node_type.lower()} on {', '.join(node.get('Sort Key', []))}")
+    
+    buffers = plan.get('Shared Hit Blocks', 0) + plan.get('Shared Read Blocks', 0)
+    if buffers > budget:
+        problems.append(f'{buffers} buffers > budget {budget}')
+    return problems
+
+def annotate_relation_sizes(cur, plan: Dict[str, Any], cache: Dict[str, float]) -> None:
+    for node in walk(plan):
+        relation = node.get('Relation Name')
+        if relation:
+            if relation not in cache:
+                cur.execute("SELECT reltuples FROM pg_class WHERE relname = %s", (relation,))
+                row = cur.fetchone()
+                cache[relation] = row['reltuples'] if row else 0
+            node['_relation_rows'] = cache[relation]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Check query plans of all handler statements')
+    parser.add_argument('--budgets', default=DEFAULT_BUDGETS)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    args = parser.parse_args()
+    
+    budgets: Dict[str, int] = {}
+    if os.path.exists(args.budgets):
+        with open(args.budgets, encoding='utf-8') as f:
+            budgets = json.load(f)
+    
+    conn = psycopg2.connect(args.database_url, cursor_factory=RealDictCursor)
+    cur = conn.cursor()
+    sample = sample_rows(cur)
+    conn.rollback()
+    
+    results: List[Tuple[str, List[str], Dict[str, Any]]] = []
+    sizes: Dict[str, float] = {}
+    for key, sql in extract_statements().items():
+        if key not in PARAMS:
+            results.append((key, ['no sample parameters registered in explain_check.PARAMS'], {}))
+            continue
+        budget = budgets.get(key, DEFAULT_BUFFER_BUDGET)
+        try:
+            params = PARAMS[key](sample)
+            if ':PREPARED_STATEMENTS.' in key:
+                # Check the generic plan: that is what a long-lived pooled connection ends up using
+                cur.execute("SET LOCAL plan_cache_mode = force_generic_plan")
+                cur.execute('PREPARE explain_check AS ' + sql)
+                cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) EXECUTE explain_check (%s)'
+                            % ', '.join(['%s'] * len(params)), params)
+            else:
+                cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, params)
+            plan = cur.fetchone()['QUERY PLAN'][0]['Plan']
+            annotate_relation_sizes(cur, plan, sizes)
+            problems = check_plan(plan, budget)
+            stats = {'ms': plan.get('Actual Total Time'),
+                     'buffers': plan.get('Shared Hit Blocks', 0) + plan.get('Shared Read Blocks', 0),
+                     'budget': budget}
+        except psycopg2.Error as e:
+            problems, stats = [f'error: {e.pgerror or e}'.strip()], {}
+        finally:
+            # Writes are explained for real, so never keep them
+            conn.rollback()
+            cur.execute("DEALLOCATE ALL")
+        results.append((key, problems, stats))
+    
+    cur.close()
+    conn.close()
+    
+    failed = [key for key, problems, _ in results if problems]
+    print(json.dumps({key: {'ok': not problems, 'problems': problems, **stats} for key, problems, stats in results},
+                     indent=2, ensure_ascii=False, default=str))
+    print(f'{len(results) - len(failed)}/{len(results)} statements within plan budget', file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
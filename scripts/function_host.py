@@ -0,0 +1,124 @@
+'''
+Business: Local host for the backend functions - serves every backend/*/index.py handler over HTTP
+Args: --port - port to listen on, --functions - comma-separated subset (default: all)
+Returns: runs until interrupted; requests to /<function>/... are turned into handler events
+
+The event and context passed to handler(event, context) mirror what the cloud
+runtime builds: httpMethod, headers, queryStringParameters, body, requestContext.
+    DATABASE_URL=... python scripts/function_host.py --port 8000
+'''
+
+import argparse
+import importlib.util
+import json
+import os
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import ModuleType
+from typing import Dict, Any, Optional, Callable
+from urllib.parse import urlsplit, parse_qsl
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+
+class Context:
+    '''Minimal stand-in for the cloud function context object'''
+    
+    def __init__(self, function_name: str):
+        self.request_id = str(uuid.uuid4())
+        self.function_name = function_name
+        self.function_version = 'local'
+        self.memory_limit_in_mb = 128
+
+def list_functions() -> list:
+    '''Names of all functions under backend/'''
+    return sorted(
+        name for name in os.listdir(BACKEND_DIR)
+        if os.path.isfile(os.path.join(BACKEND_DIR, name, 'index.py'))
+    )
+
+def load_function(name: str) -> ModuleType:
+    '''Import backend/<name>/index.py under a unique module name'''
+    path = os.path.join(BACKEND_DIR, name, 'index.py')
+    spec = importlib.util.spec_from_file_location(f'backend_{name}_index', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def build_event(method: str, url: str, headers: Dict[str, str], body: str, source_ip: str) -> Dict[str, Any]:
+    '''Build the handler event dict for an HTTP request'''
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query, keep_blank_values=True))
+    return {
+        'httpMethod': method,
+        'headers': headers,
+        'queryStringParameters': query or None,
+        'body': body,
+        'isBase64Encoded': False,
+        'requestContext': {
+            'identity': {'sourceIp': source_ip},
+            'httpMethod': method
+        }
+    }
+
+def make_request_handler(handlers: Dict[str, Callable[[Dict[str, Any], Any], Dict[str, Any]]]):
+    '''HTTP request handler class dispatching /<function>/... to handlers'''
+    
+    class FunctionRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def _dispatch(self) -> None:
+            parts = urlsplit(self.path)
+            name, _, rest = parts.path.lstrip('/').partition('/')
+            if name not in handlers:
+                self._send(404, {'Content-Type': 'application/json'}, json.dumps({'error': f'Unknown function {name}'}))
+                return
+            
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length).decode('utf-8') if length else ''
+            url = '/' + rest + ('?' + parts.query if parts.query else '')
+            event = build_event(self.command, url, dict(self.headers.items()), body, self.client_address[0])
+            
+            response = handlers[name](event, Context(name))
+            self._send(response.get('statusCode', 200), response.get('headers') or {}, response.get('body') or '')
+        
+        def _send(self, status: int, headers: Dict[str, str], body: str) -> None:
+            payload = body.encode('utf-8')
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        
+        do_GET = do_POST = do_PUT = do_DELETE = do_OPTIONS = _dispatch
+        
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+    
+    return FunctionRequestHandler
+
+def serve(port: int, names: Optional[list] = None) -> ThreadingHTTPServer:
+    '''Create a threaded HTTP server hosting the given functions (not started)'''
+    handlers = {name: load_function(name).handler for name in (names or list_functions())}
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_request_handler(handlers))
+    server.daemon_threads = True
+    return server
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Serve backend functions locally')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--functions', default='')
+    args = parser.parse_args()
+    
+    names = [n for n in args.functions.split(',') if n] or None
+    server = serve(args.port, names)
+    print(f'Serving {", ".join(names or list_functions())} on http://127.0.0.1:{args.port}/<function>/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+'''
+Business: Single-process gateway - auth, loans, card and referrals behind one router with shared warm state
+Args: --host/--port - address to listen on, --workers - request threads (each holds one connection per database),
+      --functions - comma-separated subset (default: all), --token-cache-size - verified tokens kept
+Returns: runs until interrupted; requests to /<function>/... go to that function's handler,
+         GET /health reports the mounted functions and token cache hits
+
+Deployed separately, every function keeps its own cold start, connections,
+token checks and shard map. Here the handlers are imported once and, before
+any worker starts, each is handed the first one's shared_state() through its
+use_shared_state():
+    - one pool: thread-local connections per database and one circuit
+      breaker per database, plus the prepared-statement, shard map and
+      query fingerprint registries that describe those connections
+    - one request-timing local, so db and encode phases land in the
+      Server-Timing of whichever function is serving the request
+    - one verify_token backed by an LRU cache of decoded tokens
+    - one read cache with one set of LISTEN connections for its invalidations
+Requests run on a fixed pool of worker threads, so the thread-local
+connections are reused instead of opened per request, and each worker
+prewarms every function when it starts. A worker serves one connection at a
+time, so a connection is kept alive only while every accepted connection
+has a worker; under load it is closed after its response and an idle
+client cannot keep queued connections waiting. CORS preflights are answered
+here and never reach a handler.
+    DATABASE_URL=... python scripts/gateway.py --port 8080 --workers 16
+Point the frontend at it with VITE_GATEWAY_URL=http://host:8080.
+'''
+
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+from types import ModuleType
+from typing import Dict, Any, Optional, Callable, List
+
+from function_host import list_functions, load_function, make_request_handler
+
+TOKEN_CACHE_TTL_SECONDS = 300  # cap on how long a decoded token is trusted without re-checking the signature
+KEEPALIVE_SECONDS = 5  # idle keep-alive connections give their worker back after this
+
+PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, X-Admin-Token',
+    'Access-Control-Max-Age': '86400'
+}
+
+class TokenCache:
+    '''LRU of verified token payloads, kept until the token expires or the TTL cap runs out'''
+    
+    def __init__(self, verify: Callable[[str], Optional[Dict[str, Any]]], max_size: int):
+        self.verify_uncached = verify
+        self.max_size = max_size
+        self.entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def verify(self, token: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(token)
+                self.hits += 1
+                return dict(entry[1])
+            self.misses += 1
+        
+        payload = self.verify_uncached(token)
+        if payload is None:
+            return None
+        
+        expires_at = min(float(payload.get('exp', now)), now + TOKEN_CACHE_TTL_SECONDS)
+        with self.lock:
+            self.entries[token] = (expires_at, payload)
+            self.entries.move_to_end(token)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return dict(payload)
+
+def check_prepared_statements(modules: Dict[str, ModuleType]) -> None:
+    '''Shared connections need every prepared statement name to mean the same SQL in every function'''
+    owners: Dict[str, tuple] = {}
+    for name, module in modules.items():
+        for statement, sql in module.PREPARED_STATEMENTS.items():
+            owner, owner_sql = owners.setdefault(statement, (name, sql))
+            if owner_sql != sql:
+                raise SystemExit(f'prepared statement {statement!r} differs between {owner} and {name}')
+
+def share_state(modules: Dict[str, ModuleType], token_cache_size: int) -> TokenCache:
+    '''Hand every function the first one's pool, registries and read cache, with a cached token check'''
+    check_prepared_statements(modules)
+    primary = next(iter(modules.values()))
+    state = primary.shared_state()
+    token_cache = TokenCache(state['verify_token'], token_cache_size)
+    state['verify_token'] = token_cache.verify
+    for module in modules.values():
+        module.use_shared_state(state)
+    return token_cache
+
+class PooledHTTPServer(HTTPServer):
+    '''HTTP server handling connections on a fixed pool of worker threads'''
+    
+    def __init__(self, address: tuple, handler_class: type, workers: int, initializer: Callable[[], None]):
+        super().__init__(address, handler_class)
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gateway', initializer=initializer)
+        # Accepted connections not yet closed: served by a worker or queued for one
+        self.connections = 0
+        self.connections_lock = threading.Lock()
+    
+    def saturated(self) -> bool:
+        '''Every worker has a connection: keeping one alive would leave the next connection queued behind it'''
+        return self.connections >= self.workers
+    
+    def process_request(self, request, client_address) -> None:
+        with self.connections_lock:
+            self.connections += 1
+        self.pool.submit(self._process, request, client_address)
+    
+    def _process(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self.connections_lock:
+                self.connections -= 1
+            self.shutdown_request(request)
+    
+    def server_close(self) -> None:
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+def serve(host: str, port: int, workers: int, names: Optional[List[str]] = None,
+          token_cache_size: int = 10000) -> PooledHTTPServer:
+    '''Create the gateway server hosting the given functions (not started)'''
+    # Workers prewarm on start; import-time prewarm would only warm the main thread
+    os.environ.pop('DB_PREWARM', None)
+    modules = {name: load_function(name) for name in (names or list_functions())}
+    token_cache = share_state(modules, token_cache_size)
+    
+    def prewarm_worker() -> None:
+        for module in modules.values():
+            module.prewarm()
+    
+    base = make_request_handler({name: module.handler for name, module in modules.items()})
+    
+    class GatewayRequestHandler(base):
+        timeout = KEEPALIVE_SECONDS
+        
+        def _send(self, status: int, headers: Dict[str, str], body: str) -> None:
+            if self.server.saturated():
+                self.close_connection = True
+                headers = {**headers, 'Connection': 'close'}
+            super()._send(status, headers, body)
+        
+        def do_OPTIONS(self) -> None:
+            self._send(200, PREFLIGHT_HEADERS, '')
+        
+        def do_GET(self) -> None:
+            if self.path != '/health':
+                self._dispatch()
+                return
+            self._send(200, {'Content-Type': 'application/json'}, json.dumps({
+                'functions': list(modules),
+                'workers': workers,
+                'token_cache': {'size': len(token_cache.entries), 'hits': token_cache.hits, 'misses': token_cache.misses}
+            }))
+    
+    return PooledHTTPServer((host, port), GatewayRequestHandler, workers, prewarm_worker)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Serve all backend functions from one process')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--functions', default='')
+    parser.add_argument('--token-cache-size', type=int, default=10000)
+    args = parser.parse_args()
+    
+    names = [n for n in args.functions.split(',') if n] or None
+    server = serve(args.host, args.port, args.workers, names, args.token_cache_size)
+    print(f'Gateway serving {", ".join(names or list_functions())} on http://{args.host}:{args.port}/<function>/ '
+          f'with {args.workers} workers')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
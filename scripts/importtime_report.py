@@ -0,0 +1,80 @@
+'''
+Business: Cold-start import budget per backend function, measured with python -X importtime
+Args: --budget-ms - fail if any function's total import time exceeds this,
+      --top - number of heaviest top-level imports to list per function,
+      --runs - repeat and keep the fastest run to reduce noise
+Returns: exit code 1 if over budget; prints a JSON report
+
+The import runs in a fresh interpreter with DB_PREWARM unset, so the report
+covers module import only, not the optional connection pre-warm:
+    python scripts/importtime_report.py --budget-ms 150
+'''
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, Any, List
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def measure(function_dir: str) -> List[Dict[str, Any]]:
+    '''Import index.py in a fresh interpreter and parse the importtime trace'''
+    env = {k: v for k, v in os.environ.items() if k != 'DB_PREWARM'}
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import index'],
+        cwd=function_dir, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    
+    entries = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            entries.append({
+                'module': match.group(4),
+                'self_us': int(match.group(1)),
+                'cumulative_us': int(match.group(2)),
+                'depth': (len(match.group(3)) - 1) // 2
+            })
+    return entries
+
+def report(name: str, runs: int, top: int) -> Dict[str, Any]:
+    best = None
+    for _ in range(runs):
+        entries = measure(os.path.join(BACKEND_DIR, name))
+        total = sum(e['self_us'] for e in entries)
+        if best is None or total < best[0]:
+            best = (total, entries)
+    
+    total, entries = best
+    top_level = sorted((e for e in entries if e['depth'] == 0), key=lambda e: -e['cumulative_us'])
+    return {
+        'total_ms': round(total / 1000, 2),
+        'modules': len(entries),
+        'heaviest': [{'module': e['module'], 'ms': round(e['cumulative_us'] / 1000, 2)} for e in top_level[:top]]
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Import-time budget report for backend functions')
+    parser.add_argument('--budget-ms', type=float, default=0)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+    
+    names = sorted(n for n in os.listdir(BACKEND_DIR) if os.path.isfile(os.path.join(BACKEND_DIR, n, 'index.py')))
+    results = {name: report(name, args.runs, args.top) for name in names}
+    print(json.dumps(results, indent=2))
+    
+    over = [name for name, r in results.items() if args.budget_ms and r['total_ms'] > args.budget_ms]
+    for name in over:
+        print(f"{name}: {results[name]['total_ms']} ms > budget {args.budget_ms} ms", file=sys.stderr)
+    sys.exit(1 if over else 0)
+
+if __name__ == '__main__':
+    main()
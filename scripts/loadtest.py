@@ -0,0 +1,370 @@
+'''
+Business: Local load test - drives mixed dashboard/transfer/registration workloads at a target RPS
+Args: --config - JSON workload file (see DEFAULT_CONFIG), --database-url - existing database,
+      --throwaway-db - start a temporary Postgres with initdb/pg_ctl and apply db_migrations,
+      --shards - with --throwaway-db, number of temporary Postgres shards (first one is the directory),
+      --target - base URL of an already running host (default: in-process function_host),
+      --gateway - serve in-process through scripts/gateway.py with this many workers instead,
+      --out - where to write the JSON report
+Returns: exit code 0; writes per-action p50/p95/p99 latency, throughput and error rate as JSON
+
+Reports are sorted and stable so runs from two commits can be diffed directly:
+    python scripts/loadtest.py --throwaway-db --out before.json
+    python scripts/loadtest.py --throwaway-db --shards 3 --out sharded.json
+    python scripts/loadtest.py --throwaway-db --gateway 16 --out gateway.json
+
+A few hundred users making transfers several times a minute would trip the
+card function's SBP velocity limits, so in-process hosts run with every
+limit multiplied by velocity_limit_scale. Every simulated user also gets its
+own address in X-Forwarded-For, which in-process hosts trust as one proxy hop
+so the per-IP login limit applies per user. A host passed with --target must
+be started with VELOCITY_LIMIT_SCALE and RATE_LIMIT_TRUSTED_PROXY_HOPS=1 itself.
+'''
+
+import argparse
+import glob
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import psycopg2
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MIGRATIONS_DIR = os.path.join(ROOT_DIR, 'db_migrations')
+
+DEFAULT_CONFIG: Dict[str, Any] = {
+    'rps': 100,
+    'duration_seconds': 30,
+    'warmup_seconds': 5,
+    'users': 200,
+    'concurrency': 64,
+    'seed': 42,
+    'starting_balance': 100000,
+    # VELOCITY_LIMIT_SCALE of in-process hosts: 200 users at 20 transfers/s exceed the real limits in seconds
+    'velocity_limit_scale': 1000,
+    # Relative weights of each scenario in the mix
+    'mix': {
+        'dashboard': 70,
+        'transfer': 20,
+        'register': 10
+    }
+}
+
+# Requests issued by one dashboard load, in the order the frontend makes them
+DASHBOARD_REQUESTS: List[Tuple[str, str, str]] = [
+    ('dashboard.card', 'GET', '/card/'),
+    ('dashboard.loan_stats', 'GET', '/loans/?stats=true'),
+    ('dashboard.loans', 'GET', '/loans/'),
+    ('dashboard.referral_stats', 'GET', '/referrals/?stats=true'),
+    ('dashboard.transactions', 'GET', '/card/?transactions=true')
+]
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class ThrowawayPostgres:
+    '''Temporary Postgres cluster in a temp dir, removed on stop()'''
+    
+    def __init__(self):
+        self.data_dir = tempfile.mkdtemp(prefix='labubu-pg-')
+        self.port = free_port()
+        self.bin_dir = self._find_bin_dir()
+    
+    @staticmethod
+    def _find_bin_dir() -> str:
+        if shutil.which('initdb'):
+            return os.path.dirname(shutil.which('initdb'))
+        try:
+            return subprocess.check_output(['pg_config', '--bindir'], text=True).strip()
+        except (OSError, subprocess.CalledProcessError):
+            raise SystemExit('initdb not found: install PostgreSQL or pass --database-url')
+    
+    def start(self) -> str:
+        run = lambda *cmd: subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        run(os.path.join(self.bin_dir, 'initdb'), '-D', self.data_dir, '-U', 'postgres', '--auth=trust')
+        run(os.path.join(self.bin_dir, 'pg_ctl'), '-D', self.data_dir, '-w', '-l', os.path.join(self.data_dir, 'server.log'),
+            '-o', f'-p {self.port} -k {self.data_dir} -c listen_addresses=127.0.0.1 -c max_connections=300', 'start')
+        return f'postgresql://postgres@127.0.0.1:{self.port}/postgres'
+    
+    def stop(self) -> None:
+        subprocess.run([os.path.join(self.bin_dir, 'pg_ctl'), '-D', self.data_dir, '-m', 'fast', 'stop'],
+                       stdout=subprocess.DEVNULL)
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+def apply_migrations(database_url: str) -> None:
+    '''Apply db_migrations/V*.sql in version order'''
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    cur = conn.cursor()
+    for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, 'V*.sql'))):
+        with open(path, encoding='utf-8') as f:
+            cur.execute(f.read())
+    cur.close()
+    conn.close()
+
+class Client:
+    '''Keep-alive HTTP client, one connection per worker thread'''
+    
+    def __init__(self, base_url: str):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.local = threading.local()
+    
+    def request(self, method: str, path: str, headers: Dict[str, str], body: Optional[Dict[str, Any]] = None) -> Tuple[int, Dict[str, Any]]:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        payload = json.dumps(body) if body is not None else None
+        try:
+            conn.request(method, self.prefix + path, body=payload, headers={'Content-Type': 'application/json', **headers})
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self.local.conn = None
+            raise
+        try:
+            return response.status, json.loads(data) if data else {}
+        except ValueError:
+            return response.status, {}
+
+class Recorder:
+    '''Collects per-action latency samples and error counts'''
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, Dict[str, int]] = {}
+        self.recording = False
+    
+    def record(self, action: str, latency_ms: float, error: Optional[str]) -> None:
+        if not self.recording:
+            return
+        with self.lock:
+            self.samples.setdefault(action, []).append(latency_ms)
+            if error:
+                counts = self.errors.setdefault(action, {})
+                counts[error] = counts.get(error, 0) + 1
+    
+    def report(self, duration: float) -> Dict[str, Any]:
+        actions = {}
+        for action in sorted(self.samples):
+            values = sorted(self.samples[action])
+            pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))], 3)
+            errors = self.errors.get(action, {})
+            actions[action] = {
+                'count': len(values),
+                'throughput_rps': round(len(values) / duration, 2),
+                'error_rate': round(sum(errors.values()) / len(values), 4),
+                'errors': dict(sorted(errors.items())),
+                'latency_ms': {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': round(values[-1], 3)}
+            }
+        return actions
+
+class Workload:
+    '''Scenario implementations over a pool of registered users'''
+    
+    def __init__(self, client: Client, recorder: Recorder, rng: random.Random):
+        self.client = client
+        self.recorder = recorder
+        self.rng = rng
+        self.users: List[Dict[str, str]] = []
+        self.counter = 0
+        self.lock = threading.Lock()
+    
+    def call(self, action: str, method: str, path: str, headers: Dict[str, str], body: Optional[Dict[str, Any]] = None,
+             scheduled_at: Optional[float] = None) -> Dict[str, Any]:
+        # Latency counts from the scheduled send time so that a stalled server
+        # is not hidden by the generator falling behind (coordinated omission)
+        started = scheduled_at or time.perf_counter()
+        error = None
+        result: Dict[str, Any] = {}
+        try:
+            status, result = self.client.request(method, path, headers, body)
+            if status >= 400:
+                error = str(status)
+        except Exception as e:
+            error = type(e).__name__
+        self.recorder.record(action, (time.perf_counter() - started) * 1000, error)
+        return result
+    
+    def next_identity(self) -> Tuple[str, str]:
+        with self.lock:
+            self.counter += 1
+            n = self.counter
+        return f'load-{os.getpid()}-{n}@example.com', f'10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}'
+    
+    def register(self, scheduled_at: Optional[float] = None) -> Optional[Dict[str, str]]:
+        email, ip = self.next_identity()
+        result = self.call('register', 'POST', '/auth/', {'X-Forwarded-For': ip}, {
+            'action': 'register', 'email': email, 'password': 'LoadTest123',
+            'phone': '+7999' + str(self.rng.randrange(10 ** 7)).zfill(7), 'name': 'Load Test'
+        }, scheduled_at)
+        if result.get('token'):
+            return {'token': result['token'], 'ip': ip}
+        return None
+    
+    def dashboard(self, scheduled_at: Optional[float] = None) -> None:
+        user = self.rng.choice(self.users)
+        for action, method, path in DASHBOARD_REQUESTS:
+            self.call(action, method, path, {'X-Auth-Token': user['token'], 'X-Forwarded-For': user['ip']},
+                      scheduled_at=scheduled_at)
+            scheduled_at = None
+    
+    def transfer(self, scheduled_at: Optional[float] = None) -> None:
+        user = self.rng.choice(self.users)
+        self.call('transfer', 'POST', '/card/', {'X-Auth-Token': user['token'], 'X-Forwarded-For': user['ip']}, {
+            'action': 'sbp_transfer', 'phone': '+7900' + str(self.rng.randrange(10 ** 7)).zfill(7),
+            'amount': round(self.rng.uniform(10, 500), 2), 'comment': 'load test'
+        }, scheduled_at)
+
+def seed_users(workload: Workload, count: int, database_urls: List[str], starting_balance: float) -> None:
+    '''Register users through the API, issue their cards and credit them via the ledger'''
+    while len(workload.users) < count:
+        user = workload.register()
+        if user:
+            workload.users.append(user)
+            workload.call('setup.card', 'GET', '/card/', {'X-Auth-Token': user['token']})
+    if not workload.users:
+        raise SystemExit('Could not register any load test users')
+    for database_url in database_urls:
+        conn = psycopg2.connect(database_url)
+        cur = conn.cursor()
+        cur.execute(
+            """WITH credited AS (
+                   UPDATE virtual_cards SET balance = balance + %(amount)s
+                   WHERE user_id IN (SELECT id FROM users WHERE email LIKE 'load-%%')
+                   RETURNING id
+               )
+               INSERT INTO card_transactions (card_id, type, amount, signed_amount, comment, status, created_at)
+               SELECT id, 'deposit', %(amount)s, %(amount)s, 'load test funding', 'completed', NOW() FROM credited""",
+            {'amount': starting_balance}
+        )
+        conn.commit()
+        cur.close()
+        conn.close()
+
+def run(workload: Workload, config: Dict[str, Any]) -> float:
+    '''Open-loop scheduler: start scenarios at the target rate regardless of response times'''
+    scenarios = list(config['mix'].keys())
+    weights = list(config['mix'].values())
+    interval = 1.0 / config['rps']
+    total = config['warmup_seconds'] + config['duration_seconds']
+    
+    with ThreadPoolExecutor(max_workers=config['concurrency']) as pool:
+        start = time.perf_counter()
+        measured_from = start + config['warmup_seconds']
+        n = 0
+        while True:
+            scheduled_at = start + n * interval
+            if scheduled_at - start >= total:
+                break
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            workload.recorder.recording = scheduled_at >= measured_from
+            scenario = workload.rng.choices(scenarios, weights)[0]
+            pool.submit(getattr(workload, scenario), scheduled_at)
+            n += 1
+    return config['duration_seconds']
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Local load test for the backend functions')
+    parser.add_argument('--config', help='JSON file overriding DEFAULT_CONFIG keys')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--throwaway-db', action='store_true')
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--target', help='base URL of a running host, e.g. http://127.0.0.1:8000')
+    parser.add_argument('--gateway', type=int, default=0, help='in-process gateway workers (0 = function_host)')
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args()
+    
+    config = dict(DEFAULT_CONFIG)
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            config.update(json.load(f))
+    
+    clusters: List[ThrowawayPostgres] = []
+    server = None
+    try:
+        database_urls = [args.database_url] if args.database_url else []
+        if args.throwaway_db:
+            database_urls = []
+            for _ in range(max(1, args.shards)):
+                clusters.append(ThrowawayPostgres())
+                database_urls.append(clusters[-1].start())
+                apply_migrations(database_urls[-1])
+        
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        if len(database_urls) > 1:
+            # Imported late so routing sees DATABASE_SHARDS
+            os.environ['DATABASE_SHARDS'] = json.dumps(database_urls)
+            import shard_rebalance
+            shard_rebalance.init(spread=True)
+        
+        target = args.target
+        if not target:
+            if not database_urls:
+                raise SystemExit('Pass --database-url, --throwaway-db or --target')
+            os.environ['DATABASE_URL'] = database_urls[0]
+            os.environ['VELOCITY_LIMIT_SCALE'] = str(config['velocity_limit_scale'])
+            os.environ['RATE_LIMIT_TRUSTED_PROXY_HOPS'] = '1'
+            # Imported late so handlers see DATABASE_URL and the limit settings
+            port = free_port()
+            if args.gateway:
+                import gateway
+                server = gateway.serve('127.0.0.1', port, args.gateway)
+            else:
+                import function_host
+                server = function_host.serve(port)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            target = f'http://127.0.0.1:{port}'
+        
+        recorder = Recorder()
+        workload = Workload(Client(target), recorder, random.Random(config['seed']))
+        seed_users(workload, config['users'], database_urls, config['starting_balance'])
+        
+        duration = run(workload, config)
+        report = {
+            'commit': git_commit(),
+            'config': config,
+            'shards': len(database_urls),
+            'host': args.target or ('gateway' if args.gateway else 'function_host'),
+            'actions': recorder.report(duration)
+        }
+    finally:
+        if server:
+            server.shutdown()
+        for cluster in clusters:
+            cluster.stop()
+    
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.out == '-':
+        print(output)
+    else:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
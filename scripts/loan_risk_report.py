@@ -0,0 +1,193 @@
+'''
+Business: Daily loan portfolio risk report - aging buckets, expected vs paid and default rates
+Args: --as-of - report date (default today), --chunk-size - loans per column chunk,
+      --workers - processes aggregating chunks (0 = in-process), --dry-run - print without saving
+Returns: exit code 0; writes the cube to loan_risk_reports and prints default rates by term and amount band
+
+Loans are streamed from a server-side cursor in chunks, each chunk becomes one
+float64 array (a column per field) and is reduced to a small cube with
+bincount, so memory stays at a few chunks however large the table is:
+    DATABASE_URL=... python scripts/loan_risk_report.py --workers 4
+
+Definitions, all as of the report date:
+  aging    - days past due_date of a disbursed loan with an unpaid balance:
+             current (not yet due), 1-30, 31-60, 60+; closed when fully paid,
+             not_disbursed for pending, approved and rejected applications
+  matured  - disbursed and due_date passed; expected = total_repayment, paid = paid_amount
+  default  - matured with an unpaid balance more than 60 days past due
+With DATABASE_SHARDS set every shard is scanned and the report goes to the directory.
+'''
+
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Dict, Any, List
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+
+from sharding import shard_urls, directory_url
+
+AMOUNT_BAND_EDGES = [5000, 20000, 50000]
+AMOUNT_BANDS = ['<5000', '5000-19999', '20000-49999', '50000+']
+AGING_BUCKETS = ['not_disbursed', 'closed', 'current', '1-30', '31-60', '60+']
+METRICS = ['loans', 'outstanding_amount', 'matured_loans', 'expected_amount', 'paid_amount', 'defaulted_loans']
+DEFAULT_DAYS_PAST_DUE = 60
+
+# Every column as float8 so a chunk converts to one array in a single call
+LOAN_COLUMNS_SQL = """SELECT term_days::float8,
+                             amount::float8,
+                             total_repayment::float8,
+                             COALESCE(paid_amount, 0)::float8,
+                             EXTRACT(EPOCH FROM due_date) / 86400,
+                             (disbursed_at IS NOT NULL)::int::float8
+                      FROM loans"""
+
+CUBE_SHAPE = (len(AMOUNT_BANDS), len(AGING_BUCKETS), len(METRICS))
+
+def aggregate_chunk(chunk: np.ndarray, as_of_day: float) -> Dict[int, np.ndarray]:
+    '''Reduce a (rows, 6) chunk to {term_days: cube[band, aging, metric]}'''
+    term, amount, total, paid, due_day, disbursed = chunk.T
+    disbursed = disbursed > 0
+
+    outstanding = np.where(disbursed, np.maximum(total - paid, 0), 0)
+    days_past_due = np.floor(as_of_day - due_day)
+    aging = np.select(
+        [~disbursed, outstanding <= 0, days_past_due <= 0, days_past_due <= 30, days_past_due <= 60],
+        [0, 1, 2, 3, 4],
+        default=5
+    )
+    matured = disbursed & (due_day <= as_of_day)
+    defaulted = matured & (outstanding > 0) & (days_past_due > DEFAULT_DAYS_PAST_DUE)
+    band = np.searchsorted(AMOUNT_BAND_EDGES, amount, side='right')
+
+    terms, term_index = np.unique(term.astype(np.int64), return_inverse=True)
+    cells = len(AMOUNT_BANDS) * len(AGING_BUCKETS)
+    key = (term_index * len(AMOUNT_BANDS) + band) * len(AGING_BUCKETS) + aging
+    size = len(terms) * cells
+
+    weights = [None, outstanding, matured, np.where(matured, total, 0), np.where(matured, paid, 0), defaulted]
+    sums = np.stack([np.bincount(key, weights=w, minlength=size) for w in weights], axis=-1)
+    sums = sums.reshape(len(terms), *CUBE_SHAPE)
+    return {int(t): sums[i] for i, t in enumerate(terms)}
+
+def merge(total: Dict[int, np.ndarray], part: Dict[int, np.ndarray]) -> None:
+    for term, cube in part.items():
+        if term in total:
+            total[term] += cube
+        else:
+            total[term] = cube.copy()
+
+def stream_chunks(database_url: str, chunk_size: int):
+    '''Yield (rows, 6) float64 arrays from a server-side cursor'''
+    conn = psycopg2.connect(database_url)
+    conn.set_session(readonly=True)
+    cur = conn.cursor(name='loan_risk_report')
+    cur.itersize = chunk_size
+    cur.execute(LOAN_COLUMNS_SQL)
+    try:
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield np.array(rows, dtype=np.float64)
+    finally:
+        cur.close()
+        conn.close()
+
+def build_cube(urls: List[str], as_of_day: float, chunk_size: int, workers: int) -> Dict[int, np.ndarray]:
+    cube: Dict[int, np.ndarray] = {}
+    if workers <= 0:
+        for url in urls:
+            for chunk in stream_chunks(url, chunk_size):
+                merge(cube, aggregate_chunk(chunk, as_of_day))
+        return cube
+
+    # At most two chunks per worker in flight keeps memory bounded while the
+    # main process keeps fetching
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for url in urls:
+            for chunk in stream_chunks(url, chunk_size):
+                pending.append(pool.submit(aggregate_chunk, chunk, as_of_day))
+                if len(pending) >= workers * 2:
+                    merge(cube, pending.pop(0).result())
+        for future in pending:
+            merge(cube, future.result())
+    return cube
+
+def cube_rows(report_date: date, cube: Dict[int, np.ndarray]) -> List[tuple]:
+    rows = []
+    for term in sorted(cube):
+        for b, band in enumerate(AMOUNT_BANDS):
+            for a, aging in enumerate(AGING_BUCKETS):
+                values = cube[term][b, a]
+                if values[0] == 0:
+                    continue
+                loans, outstanding, matured, expected, paid, defaulted = values
+                rows.append((report_date, term, band, aging, int(loans), round(float(outstanding), 2), int(matured),
+                             round(float(expected), 2), round(float(paid), 2), int(defaulted)))
+    return rows
+
+def save(report_date: date, rows: List[tuple]) -> None:
+    '''Replace the report for report_date in one transaction'''
+    conn = psycopg2.connect(directory_url())
+    cur = conn.cursor()
+    cur.execute("DELETE FROM loan_risk_reports WHERE report_date = %s", (report_date,))
+    execute_values(
+        cur,
+        """INSERT INTO loan_risk_reports
+           (report_date, term_days, amount_band, aging_bucket, loans, outstanding_amount,
+            matured_loans, expected_amount, paid_amount, defaulted_loans)
+           VALUES %s""",
+        rows
+    )
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def summary(cube: Dict[int, np.ndarray]) -> Dict[str, Any]:
+    '''Aging totals, expected vs paid and default rates by term and by amount band'''
+    def rate(values: np.ndarray) -> Dict[str, Any]:
+        matured, defaulted = values[2], values[5]
+        return {'matured_loans': int(matured), 'defaulted_loans': int(defaulted),
+                'default_rate': round(float(defaulted / matured), 4) if matured else None}
+
+    stacked = np.stack(list(cube.values())) if cube else np.zeros((1, *CUBE_SHAPE))
+    by_aging = stacked.sum(axis=(0, 1))
+    totals = by_aging.sum(axis=0)
+    return {
+        'aging': {aging: {'loans': int(v[0]), 'outstanding_amount': round(float(v[1]), 2)}
+                  for aging, v in zip(AGING_BUCKETS, by_aging)},
+        'expected_amount': round(float(totals[3]), 2),
+        'paid_amount': round(float(totals[4]), 2),
+        'default_rate_by_term': {term: rate(cube[term].sum(axis=(0, 1))) for term in sorted(cube)},
+        'default_rate_by_amount_band': {band: rate(v) for band, v in zip(AMOUNT_BANDS, stacked.sum(axis=(0, 2)))},
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Loan portfolio risk and aging report')
+    parser.add_argument('--as-of', type=date.fromisoformat, default=date.today())
+    parser.add_argument('--chunk-size', type=int, default=200000)
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    # End of the report day, in the same epoch-day units as the streamed due dates
+    as_of_day = (datetime.combine(args.as_of + timedelta(days=1), datetime.min.time()) - datetime(1970, 1, 1)).total_seconds() / 86400
+
+    started = datetime.now()
+    cube = build_cube(shard_urls(), as_of_day, args.chunk_size, args.workers)
+    rows = cube_rows(args.as_of, cube)
+    if not args.dry_run:
+        save(args.as_of, rows)
+
+    report = summary(cube)
+    report.update({'report_date': args.as_of.isoformat(), 'rows': len(rows),
+                   'seconds': round((datetime.now() - started).total_seconds(), 1)})
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+'''
+Business: Outbox worker - dispatch events written by the functions to downstream consumers
+Args: --consumer - consumer name, optionally name=module:callable for a custom handler (repeatable),
+      --batch - events claimed per transaction, --poll-seconds - wake-up interval without NOTIFY,
+      --retain-days - prune events every consumer has processed after this many days (0 = keep),
+      --once - drain every consumer once and exit,
+      --shard - index into DATABASE_SHARDS of the outbox to drain (run one worker per shard)
+Returns: runs until interrupted; prints a JSON line per processed batch
+
+Functions append to outbox_events in the same transaction as the change, and a
+trigger sends NOTIFY outbox_events. The worker LISTENs, and for each consumer
+locks its offset row FOR UPDATE SKIP LOCKED, reads the next batch after the
+offset, runs the handler and advances the offset in one transaction, so
+database side effects of a handler happen exactly once and parallel workers
+never process the same batch. A failing batch is rolled back and retried.
+    DATABASE_URL=... python scripts/outbox_worker.py --consumer log
+
+Handlers take (cursor, events) and run inside the claiming transaction; custom
+ones are loaded with --consumer audit=mypackage.consumers:handle_audit. The
+only built-in one, log, forwards events to analytics: the outbox moves side
+effects off the request path and adds no business rules of its own.
+'''
+
+import argparse
+import importlib
+import json
+import select
+import sys
+import time
+from typing import Dict, Any, List, Callable, Tuple
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from sharding import shard_urls
+
+NOTIFY_CHANNEL = 'outbox_events'
+
+Handler = Callable[[Any, List[Dict[str, Any]]], None]
+
+HANDLERS: Dict[str, Handler] = {}
+
+def handler(name: str) -> Callable[[Handler], Handler]:
+    '''Register a built-in consumer handler under name'''
+    def register(fn: Handler) -> Handler:
+        HANDLERS[name] = fn
+        return fn
+    return register
+
+@handler('log')
+def log_events(cur, events: List[Dict[str, Any]]) -> None:
+    '''Emit events as JSON lines for the analytics pipeline'''
+    for event in events:
+        print(json.dumps({
+            'event': event['event_type'],
+            'event_id': event['id'],
+            'user_id': event['user_id'],
+            'payload': event['payload'],
+            'created_at': event['created_at'].isoformat()
+        }, ensure_ascii=False))
+
+def load_handler(spec: str) -> Tuple[str, Handler]:
+    '''Resolve "name" to a built-in handler or "name=module:callable" to a custom one'''
+    name, _, target = spec.partition('=')
+    if not target:
+        if name not in HANDLERS:
+            raise SystemExit(f'unknown consumer {name!r}; built-in: {", ".join(sorted(HANDLERS))}')
+        return name, HANDLERS[name]
+
+    module_name, _, attr = target.partition(':')
+    return name, getattr(importlib.import_module(module_name), attr)
+
+def claim_batch(conn, consumer: str, handle: Handler, batch: int) -> int:
+    '''Process the next batch for consumer; returns events processed (0 if idle or owned elsewhere)'''
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """SELECT last_txid, last_event_id FROM outbox_consumer_offsets
+               WHERE consumer = %s FOR UPDATE SKIP LOCKED""",
+            (consumer,)
+        )
+        offset = cur.fetchone()
+        if not offset:
+            conn.rollback()
+            return 0
+
+        # Events are read in (txid, id) order and only from transactions older
+        # than every running one, so nothing can later commit behind the offset
+        cur.execute(
+            """SELECT id, txid, event_type, user_id, payload, created_at
+               FROM outbox_events
+               WHERE (txid, id) > (%s, %s)
+                 AND txid < txid_snapshot_xmin(txid_current_snapshot())
+               ORDER BY txid, id
+               LIMIT %s""",
+            (offset['last_txid'], offset['last_event_id'], batch)
+        )
+        events = cur.fetchall()
+        if not events:
+            conn.rollback()
+            return 0
+
+        handle(cur, events)
+
+        last = events[-1]
+        cur.execute(
+            """UPDATE outbox_consumer_offsets
+               SET last_txid = %s, last_event_id = %s, processed = processed + %s, updated_at = NOW()
+               WHERE consumer = %s""",
+            (last['txid'], last['id'], len(events), consumer)
+        )
+        conn.commit()
+        return len(events)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def drain(conn, consumers: List[Tuple[str, Handler]], batch: int) -> None:
+    '''Run every consumer until it has no full batch left'''
+    for consumer, handle in consumers:
+        while True:
+            started = time.perf_counter()
+            try:
+                processed = claim_batch(conn, consumer, handle, batch)
+            except psycopg2.OperationalError:
+                raise
+            except Exception as e:
+                # Offset is unchanged: the batch is retried on the next wake-up
+                print(json.dumps({'consumer': consumer, 'error': str(e)}, ensure_ascii=False), file=sys.stderr)
+                break
+
+            if processed:
+                print(json.dumps({
+                    'consumer': consumer,
+                    'processed': processed,
+                    'ms': round((time.perf_counter() - started) * 1000, 1)
+                }))
+            if processed < batch:
+                break
+
+def prune(conn, retain_days: int) -> int:
+    '''Delete old events that every consumer has already processed'''
+    cur = conn.cursor()
+    cur.execute(
+        """DELETE FROM outbox_events
+           WHERE created_at < NOW() - make_interval(days => %s)
+             AND (txid, id) <= ALL (SELECT last_txid, last_event_id FROM outbox_consumer_offsets)""",
+        (retain_days,)
+    )
+    deleted = cur.rowcount
+    conn.commit()
+    cur.close()
+    return deleted
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Dispatch transactional outbox events')
+    parser.add_argument('--consumer', action='append', required=True)
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--poll-seconds', type=float, default=5)
+    parser.add_argument('--retain-days', type=int, default=7)
+    parser.add_argument('--once', action='store_true')
+    parser.add_argument('--shard', type=int, default=0, help='shard whose outbox to drain (one worker per shard)')
+    args = parser.parse_args()
+
+    database_url = shard_urls()[args.shard]
+
+    consumers = [load_handler(spec) for spec in args.consumer]
+
+    conn = psycopg2.connect(database_url, cursor_factory=RealDictCursor)
+    cur = conn.cursor()
+    # New consumers start from the beginning of the retained outbox
+    cur.execute(
+        """INSERT INTO outbox_consumer_offsets (consumer)
+           SELECT unnest(%s::varchar[])
+           ON CONFLICT (consumer) DO NOTHING""",
+        ([name for name, _ in consumers],)
+    )
+    conn.commit()
+    cur.close()
+
+    listener = psycopg2.connect(database_url)
+    listener.autocommit = True
+    listener.cursor().execute(f'LISTEN {NOTIFY_CHANNEL}')
+
+    last_prune = 0.0
+    try:
+        while True:
+            drain(conn, consumers, args.batch)
+            if args.once:
+                break
+
+            if args.retain_days > 0 and time.monotonic() - last_prune > 3600:
+                deleted = prune(conn, args.retain_days)
+                if deleted:
+                    print(json.dumps({'pruned': deleted}))
+                last_prune = time.monotonic()
+
+            # The timeout also picks up events held back by a long-running
+            # transaction, which sends no further NOTIFY once it ends
+            if select.select([listener], [], [], args.poll_seconds)[0]:
+                listener.poll()
+                listener.notifies.clear()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+'''
+Business: Card ledger reconciliation - verify cached card balances against the ledger
+Args: --chunk-size - cards per chunk, --workers - parallel connections,
+      --snapshot - write a new balance snapshot for every card with new entries
+Returns: exit code 1 if any card balance differs from its ledger; prints a JSON summary,
+         with the cards skipped because a transfer kept them locked on every pass
+
+Each card's ledger balance is its latest snapshot plus the completed
+card_transactions after the snapshot's ledger position, so a run only reads
+entries since the previous snapshot instead of the whole table:
+    DATABASE_URL=... python scripts/reconcile_card_ledger.py --workers 8 --snapshot
+With DATABASE_SHARDS set, every shard's cards are reconciled on that shard.
+'''
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Dict, Any, List, Tuple
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from sharding import shard_urls
+
+LOCK_BATCH = 100  # cards locked per transaction; transfers to them wait at most one batch's ledger sums
+BUSY_RETRIES = 3  # passes over cards that were locked by a transfer before they are reported as skipped
+BUSY_RETRY_SECONDS = 0.5
+
+def reconcile_cards(conn, card_ids: List[int], snapshot: bool, result: Dict[str, Any]) -> List[int]:
+    '''Reconcile card_ids in one short transaction, adding to result; returns the ids busy in a transfer'''
+    cur = conn.cursor()
+    
+    # Transfers lock the card row, so holding FOR SHARE means no debit is in
+    # flight and the ledger position below never skips an uncommitted entry.
+    # Cards a transfer holds right now are skipped rather than waited for, and
+    # the lock is held for one small batch, so transfers never queue behind a
+    # long reconciliation and hit their statement timeout
+    cur.execute("SELECT id FROM virtual_cards WHERE id = ANY(%s) FOR SHARE SKIP LOCKED", (card_ids,))
+    locked = [row['id'] for row in cur.fetchall()]
+    cur.execute(
+        """SELECT c.id, c.balance AS cached_balance,
+                  COALESCE(s.balance, 0) + COALESCE(t.delta, 0) AS ledger_balance,
+                  COALESCE(t.position, s.ledger_position) AS position,
+                  t.position IS NOT NULL AS has_new_entries
+           FROM virtual_cards c
+           LEFT JOIN LATERAL (
+               SELECT ledger_position, balance FROM card_balance_snapshots
+               WHERE card_id = c.id
+               ORDER BY ledger_position DESC
+               LIMIT 1
+           ) s ON true
+           LEFT JOIN LATERAL (
+               SELECT SUM(signed_amount) FILTER (WHERE status = 'completed') AS delta, MAX(id) AS position
+               FROM card_transactions
+               WHERE card_id = c.id AND id > COALESCE(s.ledger_position, 0)
+           ) t ON true
+           WHERE c.id = ANY(%s)""",
+        (locked,)
+    )
+    rows = cur.fetchall()
+    
+    new_snapshots: List[Tuple[int, int, Decimal]] = []
+    for row in rows:
+        if row['cached_balance'] != row['ledger_balance']:
+            result['mismatches'].append({
+                'card_id': row['id'],
+                'cached_balance': str(row['cached_balance']),
+                'ledger_balance': str(row['ledger_balance'])
+            })
+        elif snapshot and row['has_new_entries']:
+            new_snapshots.append((row['id'], row['position'], row['ledger_balance']))
+    
+    if new_snapshots:
+        cur.executemany(
+            "INSERT INTO card_balance_snapshots (card_id, ledger_position, balance, taken_at) VALUES (%s, %s, %s, NOW())",
+            new_snapshots
+        )
+    
+    conn.commit()
+    cur.close()
+    
+    result['cards'] += len(rows)
+    result['snapshots'] += len(new_snapshots)
+    locked_ids = set(locked)
+    return [card_id for card_id in card_ids if card_id not in locked_ids]
+
+def reconcile_chunk(url: str, first_id: int, last_id: int, snapshot: bool) -> Dict[str, Any]:
+    '''Reconcile cards with ids in [first_id, last_id] of one shard on a dedicated connection'''
+    conn = psycopg2.connect(url, cursor_factory=RealDictCursor)
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM virtual_cards WHERE id BETWEEN %s AND %s ORDER BY id", (first_id, last_id))
+    card_ids = [row['id'] for row in cur.fetchall()]
+    conn.commit()
+    cur.close()
+    
+    result: Dict[str, Any] = {'cards': 0, 'mismatches': [], 'snapshots': 0}
+    busy: List[int] = []
+    for start in range(0, len(card_ids), LOCK_BATCH):
+        busy += reconcile_cards(conn, card_ids[start:start + LOCK_BATCH], snapshot, result)
+    
+    for _ in range(BUSY_RETRIES):
+        if not busy:
+            break
+        time.sleep(BUSY_RETRY_SECONDS)
+        busy = reconcile_cards(conn, busy, snapshot, result)
+    
+    conn.close()
+    result['skipped'] = busy
+    return result
+
+def shard_chunks(shard: int, url: str, chunk_size: int) -> List[Tuple[int, str, int, int]]:
+    '''(shard, url, first id, last id) of every chunk of one shard's cards'''
+    conn = psycopg2.connect(url)
+    cur = conn.cursor()
+    cur.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), -1) FROM virtual_cards")
+    min_id, max_id = cur.fetchone()
+    cur.close()
+    conn.close()
+    return [(shard, url, start, min(start + chunk_size - 1, max_id)) for start in range(min_id, max_id + 1, chunk_size)]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Reconcile virtual card balances against the ledger')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--snapshot', action='store_true')
+    args = parser.parse_args()
+    
+    chunks = [chunk for shard, url in enumerate(shard_urls()) for chunk in shard_chunks(shard, url, args.chunk_size)]
+    
+    def run(chunk: Tuple[int, str, int, int]) -> Dict[str, Any]:
+        shard, url, first_id, last_id = chunk
+        result = reconcile_chunk(url, first_id, last_id, args.snapshot)
+        for mismatch in result['mismatches']:
+            mismatch['shard'] = shard
+        result['skipped'] = [{'card_id': card_id, 'shard': shard} for card_id in result['skipped']]
+        return result
+    
+    summary: Dict[str, Any] = {'cards': 0, 'snapshots': 0, 'mismatches': [], 'skipped': []}
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for result in pool.map(run, chunks):
+            summary['cards'] += result['cards']
+            summary['snapshots'] += result['snapshots']
+            summary['mismatches'].extend(result['mismatches'])
+            summary['skipped'].extend(result['skipped'])
+    
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    sys.exit(1 if summary['mismatches'] else 0)
+
+if __name__ == '__main__':
+    main()
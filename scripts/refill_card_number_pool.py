@@ -0,0 +1,85 @@
+'''
+Business: Background refill of the pre-generated virtual card number pool
+Args: --target - pool size to keep, --batch - numbers inserted per statement,
+      --interval - seconds between checks (0 = run once)
+Returns: exit code 0; prints the number of card numbers added per run
+
+Run from cron or as a long-lived worker next to the card function:
+    DATABASE_URL=... python scripts/refill_card_number_pool.py --interval 30
+With DATABASE_SHARDS set, every shard's pool is kept at the target size.
+'''
+
+import argparse
+import secrets
+import time
+from typing import List
+
+import psycopg2
+
+from sharding import shard_urls
+
+# Must match backend/card/index.py
+CARD_BIN = '220070'
+
+def luhn_check_digit(digits: str) -> str:
+    '''Compute Luhn check digit for a string of digits'''
+    total = 0
+    for i, ch in enumerate(reversed(digits)):
+        d = int(ch)
+        if i % 2 == 0:
+            d *= 2
+            if d > 9:
+                d -= 9
+        total += d
+    return str((10 - total % 10) % 10)
+
+def generate_card_number() -> str:
+    '''Generate random Luhn-valid virtual card number'''
+    body = CARD_BIN + str(secrets.randbelow(10 ** (15 - len(CARD_BIN)))).zfill(15 - len(CARD_BIN))
+    return body + luhn_check_digit(body)
+
+def refill(conn, target: int, batch: int) -> int:
+    '''Top the pool up to target size, skipping numbers already issued'''
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM card_number_pool")
+    missing = target - cur.fetchone()[0]
+    
+    added = 0
+    while missing > 0:
+        numbers: List[str] = [generate_card_number() for _ in range(min(batch, missing))]
+        cur.execute(
+            """INSERT INTO card_number_pool (card_number)
+               SELECT n FROM unnest(%s::varchar[]) AS n
+               WHERE NOT EXISTS (SELECT 1 FROM virtual_cards WHERE card_number = n)
+               ON CONFLICT DO NOTHING""",
+            (numbers,)
+        )
+        conn.commit()
+        added += cur.rowcount
+        missing -= cur.rowcount
+    
+    cur.close()
+    return added
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Refill the virtual card number pool')
+    parser.add_argument('--target', type=int, default=10000)
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--interval', type=float, default=0)
+    args = parser.parse_args()
+    
+    conns = [psycopg2.connect(url) for url in shard_urls()]
+    try:
+        while True:
+            for shard, conn in enumerate(conns):
+                added = refill(conn, args.target, args.batch)
+                print(f'card_number_pool: added {added}' + (f' on shard {shard}' if len(conns) > 1 else ''))
+            if args.interval <= 0:
+                break
+            time.sleep(args.interval)
+    finally:
+        for conn in conns:
+            conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+'''
+Business: Shard directory setup and resumable rebalancing of users between shards
+Args: init [--spread]          - create the bucket map, backfill the directory from every shard's
+                                 users and interleave id sequences so rows can move without clashes
+      status                   - buckets and users per shard, moves in progress
+      move --buckets 1,2 --to N - move buckets to shard N
+      rebalance [--batch N] [--max-buckets N] - even out buckets across shards, N buckets per move
+      resume                   - finish moves interrupted by a crash
+Returns: exit code 0 on success; prints JSON progress lines
+
+Scaling out from one database: add the new shards to DATABASE_SHARDS (the
+existing database first), apply db_migrations to each, then
+    DATABASE_SHARDS='["postgres://a/...", "postgres://b/..."]' python scripts/shard_rebalance.py init
+    ... deploy the functions with the same DATABASE_SHARDS ...
+    DATABASE_SHARDS=... python scripts/shard_rebalance.py init      # picks up late registrations
+    DATABASE_SHARDS=... python scripts/shard_rebalance.py rebalance --batch 32
+
+A move freezes its buckets (users get 503 for about a minute), waits until
+every function instance has reloaded the map, copies the rows to the target
+in one transaction, switches the map and deletes the source rows. Each phase
+is recorded in shard_moves and is idempotent, so "resume" after a crash
+continues from the last completed phase.
+'''
+
+import argparse
+import json
+import tempfile
+import time
+from typing import Dict, Any, List, Tuple
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from sharding import SHARD_BUCKETS, SHARD_MAP_TTL_SECONDS, shard_urls, directory_url
+
+# Ids of moved rows must not clash with the target's own: shard i hands out ids
+# congruent to i + 1 modulo SHARD_ID_STRIDE
+SHARD_ID_STRIDE = 64
+SEQUENCE_HEADROOM = 100000
+SEQUENCE_TABLES = ('loans', 'virtual_cards', 'card_transactions', 'card_balance_snapshots', 'referral_bonuses',
+                   'outbox_events')
+
+# In-flight requests that loaded the map just before the freeze finish within
+# the longest statement timeout of the functions
+FREEZE_MARGIN_SECONDS = 10
+
+# Parents first; deletes run in reverse
+CARD_PREDICATE = 'card_id IN (SELECT id FROM virtual_cards WHERE user_id % {n} IN ({buckets}))'
+MOVE_TABLES: List[Tuple[str, str]] = [
+    ('users', 'id % {n} IN ({buckets})'),
+    ('virtual_cards', 'user_id % {n} IN ({buckets})'),
+    ('card_transactions', CARD_PREDICATE),
+    ('card_balance_snapshots', CARD_PREDICATE),
+    ('loans', 'user_id % {n} IN ({buckets})'),
+    ('referral_bonuses', 'user_id % {n} IN ({buckets})'),
+    ('outbox_events', 'user_id % {n} IN ({buckets})'),
+]
+
+# Only outbox events some consumer has not processed yet are copied (the rest
+# is history that outbox_worker would prune) and they are restamped with the
+# copying transaction's txid: consumer offsets on the target are in its own
+# txid space. A consumer that was part way through gets those events again,
+# which the at-least-once outbox already allows. Without any consumer yet
+# every event is unprocessed and copied.
+COPY_FILTERS = {
+    'outbox_events': """NOT EXISTS (SELECT 1 FROM outbox_consumer_offsets)
+        OR EXISTS (SELECT 1 FROM outbox_consumer_offsets o
+                   WHERE (outbox_events.txid, outbox_events.id) > (o.last_txid, o.last_event_id))"""
+}
+
+BACKFILL_BATCH = 5000
+COPY_SPOOL_BYTES = 64 * 1024 * 1024
+
+def log(**fields: Any) -> None:
+    print(json.dumps(fields, default=str), flush=True)
+
+def predicate(template: str, buckets: List[int]) -> str:
+    return template.format(n=SHARD_BUCKETS, buckets=', '.join(str(int(b)) for b in buckets))
+
+def init(spread: bool) -> None:
+    '''Create the bucket map, backfill the directory and interleave id sequences'''
+    urls = shard_urls()
+    if len(urls) > SHARD_ID_STRIDE:
+        raise SystemExit(f'at most {SHARD_ID_STRIDE} shards are supported')
+
+    directory = psycopg2.connect(directory_url())
+    cur = directory.cursor()
+    # Existing rows are kept: init only fills gaps. --spread is for empty deployments.
+    cur.execute(
+        """INSERT INTO shard_buckets (bucket, shard)
+           SELECT b, CASE WHEN %s THEN b %% %s ELSE 0 END FROM generate_series(0, %s - 1) AS b
+           ON CONFLICT (bucket) DO NOTHING""",
+        (spread, len(urls), SHARD_BUCKETS)
+    )
+    directory.commit()
+
+    max_user_id = 0
+    for index, url in enumerate(urls):
+        shard = psycopg2.connect(url)
+        source = shard.cursor(name='directory_backfill')
+        source.itersize = BACKFILL_BATCH
+        source.execute("SELECT id, email, referral_code, referred_by, created_at FROM users ORDER BY id")
+        copied = 0
+        while True:
+            rows = source.fetchmany(BACKFILL_BATCH)
+            if not rows:
+                break
+            execute_values(
+                cur,
+                """INSERT INTO user_directory (user_id, email, referral_code, referred_by, created_at)
+                   VALUES %s ON CONFLICT DO NOTHING""",
+                rows
+            )
+            directory.commit()
+            copied += len(rows)
+            max_user_id = max(max_user_id, rows[-1][0])
+        source.close()
+        shard.close()
+        log(phase='directory_backfill', shard=index, users=copied)
+
+    cur.execute(
+        "SELECT setval(pg_get_serial_sequence('user_directory', 'user_id'), GREATEST(%s, (SELECT COALESCE(MAX(user_id), 0) FROM user_directory)) + %s)",
+        (max_user_id, SEQUENCE_HEADROOM)
+    )
+    directory.commit()
+    cur.close()
+    directory.close()
+
+    interleave_sequences(urls)
+
+def interleave_sequences(urls: List[str]) -> None:
+    '''Make shard i allocate ids congruent to i + 1 modulo SHARD_ID_STRIDE, above every existing id'''
+    conns = [psycopg2.connect(url) for url in urls]
+    try:
+        for table in SEQUENCE_TABLES:
+            highest = 0
+            for conn in conns:
+                cur = conn.cursor()
+                cur.execute(f"SELECT COALESCE(MAX(id), 0), pg_get_serial_sequence('{table}', 'id') FROM {table}")
+                max_id, sequence = cur.fetchone()
+                cur.execute(f"SELECT last_value FROM {sequence}")
+                highest = max(highest, max_id, cur.fetchone()[0])
+                cur.close()
+                conn.commit()
+
+            base = (highest // SHARD_ID_STRIDE + 1) * SHARD_ID_STRIDE + SEQUENCE_HEADROOM
+            for index, conn in enumerate(conns):
+                cur = conn.cursor()
+                cur.execute(f"SELECT pg_get_serial_sequence('{table}', 'id')")
+                sequence = cur.fetchone()[0]
+                cur.execute(f"ALTER SEQUENCE {sequence} INCREMENT BY {SHARD_ID_STRIDE}")
+                cur.execute("SELECT setval(%s, %s, false)", (sequence, base + index + 1))
+                conn.commit()
+                cur.close()
+            log(phase='interleave', table=table, next_base=base)
+    finally:
+        for conn in conns:
+            conn.close()
+
+def status() -> Dict[str, Any]:
+    urls = shard_urls()
+    directory = psycopg2.connect(directory_url())
+    cur = directory.cursor()
+    cur.execute("SELECT shard, COUNT(*), COUNT(*) FILTER (WHERE moving) FROM shard_buckets GROUP BY shard ORDER BY shard")
+    buckets = {shard: {'buckets': count, 'frozen': frozen} for shard, count, frozen in cur.fetchall()}
+    cur.execute("SELECT source, target, phase, COUNT(*) FROM shard_moves GROUP BY source, target, phase")
+    moves = [{'source': s, 'target': t, 'phase': p, 'buckets': c} for s, t, p, c in cur.fetchall()]
+    cur.close()
+    directory.close()
+
+    shards = []
+    for index, url in enumerate(urls):
+        conn = psycopg2.connect(url)
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM users")
+        shards.append({'shard': index, 'users': cur.fetchone()[0], **buckets.get(index, {'buckets': 0, 'frozen': 0})})
+        conn.close()
+    return {'shards': shards, 'moves': moves}
+
+def start_move(buckets: List[int], target: int) -> None:
+    '''Freeze buckets and record the move; buckets already on target are skipped'''
+    directory = psycopg2.connect(directory_url())
+    cur = directory.cursor()
+    cur.execute(
+        """WITH frozen AS (
+               UPDATE shard_buckets SET moving = TRUE, updated_at = NOW()
+               WHERE bucket = ANY(%s) AND shard <> %s AND NOT moving
+               RETURNING bucket, shard
+           )
+           INSERT INTO shard_moves (bucket, source, target, phase)
+           SELECT bucket, shard, %s, 'frozen' FROM frozen""",
+        (buckets, target, target)
+    )
+    directory.commit()
+    cur.close()
+    directory.close()
+
+def pending_moves() -> List[Tuple[int, int, str, List[int], float]]:
+    '''Moves in progress grouped by (source, target, phase), with seconds since the phase began'''
+    directory = psycopg2.connect(directory_url())
+    cur = directory.cursor()
+    cur.execute(
+        """SELECT source, target, phase, array_agg(bucket ORDER BY bucket),
+                  EXTRACT(EPOCH FROM NOW() - MIN(phase_started_at))
+           FROM shard_moves GROUP BY source, target, phase
+           ORDER BY MIN(phase_started_at)"""
+    )
+    moves = [(s, t, p, list(b), float(age)) for s, t, p, b, age in cur.fetchall()]
+    cur.close()
+    directory.close()
+    return moves
+
+def set_phase(buckets: List[int], phase: str, switch_to: int = None) -> None:
+    directory = psycopg2.connect(directory_url())
+    cur = directory.cursor()
+    if switch_to is not None:
+        cur.execute(
+            "UPDATE shard_buckets SET shard = %s, moving = FALSE, updated_at = NOW() WHERE bucket = ANY(%s)",
+            (switch_to, buckets)
+        )
+    if phase == 'done':
+        cur.execute("DELETE FROM shard_moves WHERE bucket = ANY(%s)", (buckets,))
+    else:
+        cur.execute(
+            "UPDATE shard_moves SET phase = %s, phase_started_at = NOW() WHERE bucket = ANY(%s)",
+            (phase, buckets)
+        )
+    directory.commit()
+    cur.close()
+    directory.close()
+
+def copy_buckets(source_url: str, target_url: str, buckets: List[int]) -> Dict[str, int]:
+    '''Replace the buckets' rows on the target with the source's in one transaction'''
+    source = psycopg2.connect(source_url)
+    source.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    target = psycopg2.connect(target_url)
+    src = source.cursor()
+    dst = target.cursor()
+    # Skip FK checks, the append-only ledger trigger and change notifications for bulk rows
+    dst.execute("SET session_replication_role = replica")
+
+    # Rows left by an earlier interrupted attempt
+    for table, template in reversed(MOVE_TABLES):
+        dst.execute(f"DELETE FROM {table} WHERE {predicate(template, buckets)}")
+
+    src.execute(f"SELECT MIN(created_at) FROM card_transactions WHERE {predicate(CARD_PREDICATE, buckets)}")
+    oldest = src.fetchone()[0]
+    if oldest is not None:
+        dst.execute("SELECT create_card_transaction_partitions(%s::date, 3)", (oldest,))
+
+    copied = {}
+    for table, template in MOVE_TABLES:
+        where = predicate(template, buckets)
+        selected = f'{where} AND ({COPY_FILTERS[table]})' if table in COPY_FILTERS else where
+        with tempfile.SpooledTemporaryFile(max_size=COPY_SPOOL_BYTES) as spool:
+            src.copy_expert(f"COPY (SELECT * FROM {table} WHERE {selected}) TO STDOUT", spool)
+            spool.seek(0)
+            dst.copy_expert(f"COPY {table} FROM STDIN", spool)
+        if table == 'outbox_events':
+            dst.execute(f"UPDATE outbox_events SET txid = txid_current() WHERE {where}")
+
+        src.execute(f"SELECT COUNT(*) FROM {table} WHERE {selected}")
+        expected = src.fetchone()[0]
+        dst.execute(f"SELECT COUNT(*) FROM {table} WHERE {where}")
+        actual = dst.fetchone()[0]
+        if actual != expected:
+            target.rollback()
+            raise RuntimeError(f'{table}: copied {actual} rows, expected {expected}')
+        copied[table] = actual
+
+    target.commit()
+    source.rollback()
+    source.close()
+    target.close()
+    return copied
+
+def delete_buckets(url: str, buckets: List[int]) -> None:
+    conn = psycopg2.connect(url)
+    cur = conn.cursor()
+    cur.execute("SET session_replication_role = replica")
+    for table, template in reversed(MOVE_TABLES):
+        cur.execute(f"DELETE FROM {table} WHERE {predicate(template, buckets)}")
+    conn.commit()
+    conn.close()
+
+def advance(source: int, target: int, phase: str, buckets: List[int], age: float) -> None:
+    '''Run a move from its recorded phase to the end'''
+    urls = shard_urls()
+    if phase == 'frozen':
+        wait = SHARD_MAP_TTL_SECONDS + FREEZE_MARGIN_SECONDS - age
+        if wait > 0:
+            log(phase='frozen', buckets=len(buckets), waiting_seconds=round(wait, 1))
+            time.sleep(wait)
+        copied = copy_buckets(urls[source], urls[target], buckets)
+        log(phase='copied', source=source, target=target, buckets=len(buckets), rows=copied)
+        set_phase(buckets, 'copied')
+        phase = 'copied'
+    if phase == 'copied':
+        set_phase(buckets, 'switched', switch_to=target)
+        log(phase='switched', source=source, target=target, buckets=len(buckets))
+        phase = 'switched'
+    if phase == 'switched':
+        # Every instance saw the buckets frozen, so nothing routes to the source any more
+        delete_buckets(urls[source], buckets)
+        set_phase(buckets, 'done')
+        log(phase='done', source=source, target=target, buckets=len(buckets))
+
+def resume() -> None:
+    for source, target, phase, buckets, age in pending_moves():
+        advance(source, target, phase, buckets, age)
+
+def move(buckets: List[int], target: int) -> None:
+    if target >= len(shard_urls()):
+        raise SystemExit(f'shard {target} is not in DATABASE_SHARDS')
+    resume()
+    start_move(buckets, target)
+    resume()
+
+def plan_rebalance() -> List[Tuple[int, List[int]]]:
+    '''Buckets to move off over-full shards, as (target, buckets) pairs'''
+    count = len(shard_urls())
+    directory = psycopg2.connect(directory_url())
+    cur = directory.cursor()
+    cur.execute("SELECT bucket, shard FROM shard_buckets ORDER BY bucket")
+    owned: Dict[int, List[int]] = {shard: [] for shard in range(count)}
+    for bucket, shard in cur.fetchall():
+        owned.setdefault(shard, []).append(bucket)
+    directory.close()
+
+    quota = {shard: SHARD_BUCKETS // count + (1 if shard < SHARD_BUCKETS % count else 0) for shard in range(count)}
+    surplus = [b for shard, buckets in owned.items() for b in buckets[quota.get(shard, 0):]]
+    plan = []
+    for shard in range(count):
+        need = quota[shard] - len(owned[shard])
+        if need > 0:
+            plan.append((shard, surplus[:need]))
+            surplus = surplus[need:]
+    return plan
+
+def rebalance(batch: int, max_buckets: int) -> None:
+    resume()
+    moved = 0
+    for target, buckets in plan_rebalance():
+        if max_buckets:
+            buckets = buckets[:max_buckets - moved]
+        for i in range(0, len(buckets), batch):
+            start_move(buckets[i:i + batch], target)
+            resume()
+        moved += len(buckets)
+        if max_buckets and moved >= max_buckets:
+            return
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Shard directory setup and rebalancing')
+    commands = parser.add_subparsers(dest='command', required=True)
+    init_parser = commands.add_parser('init')
+    init_parser.add_argument('--spread', action='store_true', help='spread buckets evenly (empty deployments only)')
+    commands.add_parser('status')
+    move_parser = commands.add_parser('move')
+    move_parser.add_argument('--buckets', required=True)
+    move_parser.add_argument('--to', type=int, required=True)
+    rebalance_parser = commands.add_parser('rebalance')
+    rebalance_parser.add_argument('--batch', type=int, default=32)
+    rebalance_parser.add_argument('--max-buckets', type=int, default=0)
+    commands.add_parser('resume')
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        init(args.spread)
+    elif args.command == 'status':
+        print(json.dumps(status(), indent=2))
+    elif args.command == 'move':
+        move([int(b) for b in args.buckets.split(',') if b], args.to)
+    elif args.command == 'rebalance':
+        rebalance(args.batch, args.max_buckets)
+    elif args.command == 'resume':
+        resume()
+
+if __name__ == '__main__':
+    main()
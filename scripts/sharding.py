@@ -0,0 +1,44 @@
+'''
+Business: Shard routing shared by the scripts - the same bucket map the backend functions use
+Args: none (imported by shard_rebalance.py, outbox_worker.py, event_stream.py, loadtest.py
+      and the card maintenance scripts)
+Returns: shard DSNs, the directory DSN and the bucket -> shard map
+
+DATABASE_SHARDS is a JSON list of shard DSNs; unset means one database at
+DATABASE_URL. DATABASE_DIRECTORY_URL defaults to the first shard.
+'''
+
+import json
+import os
+from typing import List, Optional
+
+import psycopg2.extensions
+
+# Must match backend/*/index.py
+SHARD_BUCKETS = 1024
+SHARD_MAP_TTL_SECONDS = 30
+
+def shard_urls() -> List[str]:
+    '''DSN of every shard; just DATABASE_URL when sharding is off'''
+    shards = json.loads(os.environ.get('DATABASE_SHARDS') or '[]')
+    return shards or [os.environ['DATABASE_URL']]
+
+def directory_url() -> str:
+    return os.environ.get('DATABASE_DIRECTORY_URL') or shard_urls()[0]
+
+def is_sharded() -> bool:
+    return bool(os.environ.get('DATABASE_SHARDS'))
+
+def bucket_of(user_id: int) -> int:
+    return user_id % SHARD_BUCKETS
+
+def load_shard_map(conn) -> List[Optional[int]]:
+    '''Shard index per bucket from the directory; None for buckets frozen by a move'''
+    buckets: List[Optional[int]] = [0] * SHARD_BUCKETS
+    cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+    cur.execute("SELECT bucket, shard, moving FROM shard_buckets")
+    for bucket, shard, moving in cur.fetchall():
+        buckets[bucket] = None if moving else shard
+    cur.close()
+    conn.commit()
+    return buckets
@@ -0,0 +1,92 @@
+'''
+Unit tests for scripts/card_transactions_partitions.py: python -m pytest scripts
+'''
+
+import json
+import os
+from datetime import date
+
+import pytest
+
+import card_transactions_partitions as partitions
+
+class FakeCursor:
+    '''Records statements into the connection log; a named cursor streams the partition rows'''
+
+    def __init__(self, conn, rows=()):
+        self.conn = conn
+        self.rows = list(rows)
+        self.itersize = 0
+
+    def execute(self, query, vars=None):
+        self.conn.log.append(' '.join(query.split()))
+
+    def fetchall(self):
+        return self.conn.tables.pop(0)
+
+    def __iter__(self):
+        if self.conn.fail_stream:
+            raise RuntimeError('connection lost')
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, tables=(), fail_stream=False):
+        self.log = []
+        self.tables = list(tables)
+        self.fail_stream = fail_stream
+
+    def cursor(self, name=None):
+        return FakeCursor(self, [{'id': 1, 'amount': '10.00'}] if name else ())
+
+    def commit(self):
+        self.log.append('COMMIT')
+
+    def rollback(self):
+        self.log.append('ROLLBACK')
+
+PARTITION = {'name': 'card_transactions_2024_01', 'from': date(2024, 1, 1), 'to': date(2024, 2, 1)}
+
+def test_partition_is_detached_only_after_it_is_dumped_and_recorded(tmp_path):
+    conn = FakeConnection()
+    recorded = []
+
+    def record(entry):
+        recorded.append(entry)
+        conn.log.append('RECORD')
+
+    entry = partitions.archive_partition(conn, PARTITION, str(tmp_path), keep=False, attached=True, record=record)
+
+    assert conn.log[-4:] == ['RECORD', 'ALTER TABLE card_transactions DETACH PARTITION card_transactions_2024_01',
+                             'DROP TABLE card_transactions_2024_01', 'COMMIT']
+    assert 'COMMIT' not in conn.log[:-1]
+    assert entry['rows'] == 1 and recorded == [entry]
+    assert os.path.exists(tmp_path / 'card_transactions_2024_01.ndjson.gz')
+
+def test_failed_dump_leaves_the_partition_attached(tmp_path):
+    conn = FakeConnection(fail_stream=True)
+
+    with pytest.raises(RuntimeError):
+        partitions.archive_partition(conn, PARTITION, str(tmp_path), keep=False, attached=True,
+                                     record=lambda entry: pytest.fail('recorded'))
+
+    assert not any('DETACH' in statement or 'COMMIT' in statement for statement in conn.log)
+
+def test_archive_resumes_tables_detached_but_never_archived(tmp_path, monkeypatch):
+    with open(tmp_path / 'manifest.json', 'w', encoding='utf-8') as f:
+        json.dump([{'partition': 'card_transactions_2023_12', 'file': 'kept.ndjson.gz'}], f)
+    # Detached tables (one kept by an earlier --keep run), then attached partitions
+    conn = FakeConnection(tables=[
+        [{'name': 'card_transactions_2023_11'}, {'name': 'card_transactions_2023_12'}, {'name': 'users'}],
+        [],
+    ])
+
+    result = partitions.archive(conn, 12, str(tmp_path), keep=False)
+
+    assert [entry['partition'] for entry in result['archived']] == ['card_transactions_2023_11']
+    assert 'DROP TABLE card_transactions_2023_11' in conn.log
+    assert not any('DETACH' in statement for statement in conn.log)
+    with open(tmp_path / 'manifest.json', encoding='utf-8') as f:
+        assert [e['partition'] for e in json.load(f)] == ['card_transactions_2023_12', 'card_transactions_2023_11']
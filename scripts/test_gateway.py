@@ -0,0 +1,69 @@
+'''
+Unit tests for scripts/gateway.py: python -m pytest scripts
+'''
+
+import http.client
+import threading
+
+import pytest
+
+import function_host
+import gateway
+
+@pytest.fixture
+def functions(monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', 'postgresql://test/test')
+    monkeypatch.delenv('DATABASE_SHARDS', raising=False)
+    monkeypatch.delenv('DB_PREWARM', raising=False)
+    loaded = []
+
+    def load_function(name):
+        module = function_host.load_function(name)
+        # Workers would connect to the database as they start
+        module.prewarm = lambda: None
+        loaded.append(module)
+        return module
+
+    monkeypatch.setattr(gateway, 'load_function', load_function)
+    return loaded
+
+def test_functions_share_the_first_ones_state(functions):
+    modules = {name: gateway.load_function(name) for name in ('loans', 'referrals')}
+
+    token_cache = gateway.share_state(modules, 10)
+
+    loans, referrals = modules['loans'], modules['referrals']
+    assert referrals.db_breakers is loans.db_breakers and referrals.read_cache is loans.read_cache
+    assert referrals._db_local is loans._db_local and referrals.shard_map is loans.shard_map
+    assert referrals.DatabaseUnavailable is loans.DatabaseUnavailable
+    assert loans.verify_token == token_cache.verify and referrals.verify_token == token_cache.verify
+
+def test_a_function_that_already_ran_statements_refuses_shared_state(functions):
+    loans, referrals = gateway.load_function('loans'), gateway.load_function('referrals')
+    referrals.fingerprint_sql('SELECT 1')
+
+    with pytest.raises(RuntimeError):
+        referrals.use_shared_state(loans.shared_state())
+
+    assert referrals.db_breakers is not loans.db_breakers
+
+def health(server):
+    conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+    conn.request('GET', '/health')
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response
+
+@pytest.mark.parametrize('workers, closed', [(1, True), (2, False)])
+def test_keep_alive_only_while_a_worker_is_free(functions, workers, closed):
+    server = gateway.serve('127.0.0.1', 0, workers, ['loans'])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        response = health(server)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert response.status == 200
+    assert response.will_close is closed
@@ -0,0 +1,46 @@
+'''
+Unit tests for scripts/loan_risk_report.py: python -m pytest scripts
+'''
+
+import numpy as np
+
+import loan_risk_report as report
+
+AS_OF_DAY = 100.0
+
+# term_days, amount, total_repayment, paid_amount, due day, disbursed
+LOANS = np.array([
+    [30, 1000, 1100, 0, 110, 0],           # pending application
+    [30, 10000, 11000, 11000, 90, 1],      # repaid
+    [30, 10000, 11000, 5000, 120, 1],      # not yet due
+    [14, 60000, 62520, 0, 20, 1],          # 80 days past due: defaulted
+    [14, 25000, 26050, 1000, 60, 1],       # 40 days past due
+], dtype=np.float64)
+
+def cell(cube, band, aging):
+    return dict(zip(report.METRICS, cube[report.AMOUNT_BANDS.index(band), report.AGING_BUCKETS.index(aging)]))
+
+def test_aggregate_chunk_buckets_loans_by_term_band_and_aging():
+    cubes = report.aggregate_chunk(LOANS, AS_OF_DAY)
+    
+    assert sorted(cubes) == [14, 30]
+    assert cell(cubes[30], '<5000', 'not_disbursed') == {**dict.fromkeys(report.METRICS, 0), 'loans': 1}
+    assert cell(cubes[30], '5000-19999', 'closed') == {'loans': 1, 'outstanding_amount': 0, 'matured_loans': 1,
+                                                       'expected_amount': 11000, 'paid_amount': 11000,
+                                                       'defaulted_loans': 0}
+    assert cell(cubes[30], '5000-19999', 'current') == {'loans': 1, 'outstanding_amount': 6000, 'matured_loans': 0,
+                                                        'expected_amount': 0, 'paid_amount': 0, 'defaulted_loans': 0}
+    assert cell(cubes[14], '50000+', '60+') == {'loans': 1, 'outstanding_amount': 62520, 'matured_loans': 1,
+                                                'expected_amount': 62520, 'paid_amount': 0, 'defaulted_loans': 1}
+    assert cell(cubes[14], '20000-49999', '31-60')['defaulted_loans'] == 0
+    assert sum(cube[..., 0].sum() for cube in cubes.values()) == len(LOANS)
+
+def test_merged_chunks_match_one_chunk():
+    whole = report.aggregate_chunk(LOANS, AS_OF_DAY)
+    merged = {}
+    for chunk in (LOANS[:2], LOANS[2:]):
+        report.merge(merged, report.aggregate_chunk(chunk, AS_OF_DAY))
+    
+    assert sorted(merged) == sorted(whole)
+    for term in whole:
+        np.testing.assert_array_equal(merged[term], whole[term])
@@ -0,0 +1,57 @@
+'''
+Unit tests for scripts/reconcile_card_ledger.py: python -m pytest scripts
+'''
+
+import reconcile_card_ledger as reconcile
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query, vars=None):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, card_ids):
+        self.card_ids = card_ids
+
+    def cursor(self):
+        return FakeCursor([{'id': card_id} for card_id in self.card_ids])
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+def test_cards_are_locked_in_small_batches_and_busy_ones_retried(monkeypatch):
+    monkeypatch.setattr(reconcile.psycopg2, 'connect', lambda *args, **kwargs: FakeConnection(list(range(250))))
+    monkeypatch.setattr(reconcile.time, 'sleep', lambda seconds: None)
+    batches = []
+    # Passes each card stays locked by a transfer: 7 for its first pass, 9 for all of them
+    locked_passes = {7: 1, 9: 100}
+
+    def reconcile_cards(conn, card_ids, snapshot, result):
+        batches.append(list(card_ids))
+        busy = [card_id for card_id in card_ids if locked_passes.get(card_id, 0) > 0]
+        for card_id in busy:
+            locked_passes[card_id] -= 1
+        result['cards'] += len(card_ids) - len(busy)
+        return busy
+
+    monkeypatch.setattr(reconcile, 'reconcile_cards', reconcile_cards)
+
+    result = reconcile.reconcile_chunk('postgresql://test/test', 0, 249, snapshot=False)
+
+    assert [len(batch) for batch in batches[:3]] == [100, 100, 50]
+    assert all(len(batch) <= reconcile.LOCK_BATCH for batch in batches)
+    assert batches[3] == [7, 9] and batches[4] == [9]
+    assert result['cards'] == 249
+    assert len(batches) == 3 + reconcile.BUSY_RETRIES
+    assert result['skipped'] == [9]
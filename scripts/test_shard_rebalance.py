@@ -0,0 +1,59 @@
+'''
+Unit tests for scripts/shard_rebalance.py: python -m pytest scripts
+'''
+
+import glob
+import os
+import re
+import sqlite3
+
+import shard_rebalance
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'db_migrations')
+
+# Directory tables live on the directory database and are kept by init, not moved
+DIRECTORY_TABLES = {'user_directory'}
+
+def per_user_tables():
+    '''Tables created by the migrations whose rows belong to one user or card'''
+    tables = set()
+    for path in glob.glob(os.path.join(MIGRATIONS_DIR, '*.sql')):
+        with open(path, encoding='utf-8') as f:
+            sql = f.read()
+        for name, body in re.findall(r'CREATE TABLE IF NOT EXISTS (\w+)\s*\((.*?)\n\)', sql, re.S):
+            if re.search(r'^\s+(user_id|card_id)\s', body, re.M):
+                tables.add(name)
+    return tables - DIRECTORY_TABLES
+
+def test_every_per_user_table_moves_with_its_buckets():
+    moved = {table for table, _ in shard_rebalance.MOVE_TABLES}
+    
+    assert per_user_tables() - moved == set()
+
+def test_moved_tables_with_id_sequences_are_interleaved():
+    moved = {table for table, _ in shard_rebalance.MOVE_TABLES}
+    
+    assert set(shard_rebalance.SEQUENCE_TABLES) <= moved
+    assert 'outbox_events' in shard_rebalance.SEQUENCE_TABLES
+
+def test_bucket_predicate():
+    template = dict(shard_rebalance.MOVE_TABLES)['outbox_events']
+    
+    assert shard_rebalance.predicate(template, [3, 7]) == f'user_id % {shard_rebalance.SHARD_BUCKETS} IN (3, 7)'
+
+def copied_outbox_events(offsets):
+    '''Ids of outbox events the copy filter selects, evaluated in SQLite'''
+    db = sqlite3.connect(':memory:')
+    db.execute("CREATE TABLE outbox_events (id INTEGER, txid INTEGER, user_id INTEGER)")
+    db.execute("CREATE TABLE outbox_consumer_offsets (consumer TEXT, last_txid INTEGER, last_event_id INTEGER)")
+    db.executemany("INSERT INTO outbox_events VALUES (?, ?, 3)", [(1, 100), (2, 100), (3, 105)])
+    db.executemany("INSERT INTO outbox_consumer_offsets VALUES (?, ?, ?)", offsets)
+    where = shard_rebalance.COPY_FILTERS['outbox_events']
+    return [row[0] for row in db.execute(f"SELECT id FROM outbox_events WHERE {where} ORDER BY id")]
+
+def test_outbox_copy_keeps_events_any_consumer_has_not_processed():
+    assert copied_outbox_events([('log', 100, 2), ('audit', 100, 1)]) == [2, 3]
+    assert copied_outbox_events([('log', 105, 3)]) == []
+
+def test_outbox_copy_takes_every_event_when_there_is_no_consumer():
+    assert copied_outbox_events([]) == [1, 2, 3]
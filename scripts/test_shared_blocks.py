@@ -0,0 +1,44 @@
+'''
+Checks that blocks copied into every backend function have not drifted: python -m pytest scripts
+'''
+
+import os
+import re
+
+import pytest
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+FUNCTIONS = ('auth', 'card', 'loans', 'referrals')
+
+# (first line, last line) of each block marked as shared in the functions
+SHARED_BLOCKS = [
+    ('# Per-request phase timings', '# End of the shared instrumentation block'),
+    ('# Fail fast while the database is slow or down', '# End of the shared connection pool block'),
+    ('# Names prepared on each pooled connection', '# End of the shared prepared statements block'),
+    ('# Read-through cache for per-user reads that rarely change', '# End of the shared read cache block'),
+    ('# Pool, registries and read cache handed between the functions', '# End of the shared state block'),
+    ('def handler(event', '# End of the shared handler block'),
+]
+
+def read_function(function: str) -> str:
+    with open(os.path.join(BACKEND_DIR, function, 'index.py'), encoding='utf-8') as f:
+        return f.read()
+
+def extract_block(function: str, first: str, last: str) -> str:
+    source = read_function(function)
+    start = source.index(first)
+    return source[start:source.index(last, start) + len(last)]
+
+@pytest.mark.parametrize('first, last', SHARED_BLOCKS)
+def test_shared_block_is_identical_in_every_function(first, last):
+    blocks = {function: extract_block(function, first, last) for function in FUNCTIONS}
+
+    drifted = [function for function, block in blocks.items() if block != blocks[FUNCTIONS[0]]]
+
+    assert not drifted, f'{first!r} block differs from {FUNCTIONS[0]} in {drifted}'
+
+@pytest.mark.parametrize('function', FUNCTIONS)
+def test_every_marked_block_is_compared(function):
+    ends = re.findall(r'^# End of the shared .* block$', read_function(function), re.MULTILINE)
+
+    assert sorted(ends) == sorted(last for _, last in SHARED_BLOCKS)
@@ -1,8 +1,15 @@
 import { authService } from './auth';
 
-const LOANS_API_URL = 'https://functions.poehali.dev/f988b207-088e-4ea8-b22f-973a9f06acc9';
-const REFERRALS_API_URL = 'https://functions.poehali.dev/7722ad06-a755-46eb-afe3-8cd3338d341c';
-const CARD_API_URL = 'https://functions.poehali.dev/6b4c4b2a-e3ab-4a14-a254-adfab3583370';
+// With VITE_GATEWAY_URL set, every function is reached through scripts/gateway.py
+const GATEWAY_URL = import.meta.env.VITE_GATEWAY_URL;
+
+const LOANS_API_URL = GATEWAY_URL ? `${GATEWAY_URL}/loans/` : 'https://functions.poehali.dev/f988b207-088e-4ea8-b22f-973a9f06acc9';
+const REFERRALS_API_URL = GATEWAY_URL ? `${GATEWAY_URL}/referrals/` : 'https://functions.poehali.dev/7722ad06-a755-46eb-afe3-8cd3338d341c';
+const CARD_API_URL = GATEWAY_URL ? `${GATEWAY_URL}/card/` : 'https://functions.poehali.dev/6b4c4b2a-e3ab-4a14-a254-adfab3583370';
+
+// Live dashboard updates from scripts/event_stream.py; without it the dashboard
+// refetches only after the user's own actions
+const EVENTS_URL = import.meta.env.VITE_EVENTS_URL;
 
 export interface Loan {
   id: number;
@@ -115,16 +122,19 @@ export const referralsAPI = {
     return response.json();
   },
 
-  async getList() {
-    const response = await fetch(`${REFERRALS_API_URL}?list=true`, {
+  // Pages are newest first; pass the previous page's next_cursor to get the next one
+  async getList(cursor?: string | null) {
+    const page = cursor ? `&cursor=${encodeURIComponent(cursor)}` : '';
+    const response = await fetch(`${REFERRALS_API_URL}?list=true${page}`, {
       method: 'GET',
       headers: getAuthHeaders(),
     });
     return response.json();
   },
 
-  async getBonusHistory() {
-    const response = await fetch(`${REFERRALS_API_URL}?bonuses=true`, {
+  async getBonusHistory(cursor?: string | null) {
+    const page = cursor ? `&cursor=${encodeURIComponent(cursor)}` : '';
+    const response = await fetch(`${REFERRALS_API_URL}?bonuses=true${page}`, {
       method: 'GET',
       headers: getAuthHeaders(),
     });
@@ -133,12 +143,17 @@ export const referralsAPI = {
 };
 
 export const cardAPI = {
-  async getCard(): Promise<{ success: boolean; card: VirtualCard }> {
+  async getCard(): Promise<{ success: boolean; card: VirtualCard; token?: string }> {
     const response = await fetch(CARD_API_URL, {
       method: 'GET',
       headers: getAuthHeaders(),
     });
-    return response.json();
+    const data = await response.json();
+    // The token is re-issued with the card id once the card exists
+    if (data.token) {
+      authService.saveToken(data.token);
+    }
+    return data;
   },
 
   async getTransactions(): Promise<{
@@ -166,3 +181,48 @@ export const cardAPI = {
     return response.json();
   },
 };
+
+export type ChangedResource = 'card' | 'loans' | 'referrals';
+
+const ALL_RESOURCES: ChangedResource[] = ['card', 'loans', 'referrals'];
+
+// Calls onChange with the resources to refetch, pushed by the event stream.
+// Does nothing when VITE_EVENTS_URL is not set, and stops if the stream fails
+// for good (e.g. it rejects the token): there is no polling fallback.
+// Returns a function that stops the subscription.
+export function subscribeToChanges(onChange: (resources: ChangedResource[]) => void): () => void {
+  let source: EventSource | null = null;
+  let connectedBefore = false;
+
+  const open = () => {
+    const token = authService.getToken();
+    if (!EVENTS_URL || typeof EventSource === 'undefined' || !token) return;
+
+    source = new EventSource(`${EVENTS_URL}/events?token=${encodeURIComponent(token)}`);
+    source.addEventListener('ready', () => {
+      // Changes made while the stream was reconnecting were never delivered
+      if (connectedBefore) onChange(ALL_RESOURCES);
+      connectedBefore = true;
+    });
+    source.addEventListener('change', (event) => {
+      onChange([JSON.parse((event as MessageEvent).data).resource]);
+    });
+    source.addEventListener('resync', () => onChange(ALL_RESOURCES));
+    source.addEventListener('token_expired', () => {
+      // The browser would reconnect with the old token; reopen with the current one
+      source?.close();
+      open();
+    });
+    source.onerror = () => {
+      // Network errors reconnect on their own; a closed source will not
+      if (source?.readyState === EventSource.CLOSED) source = null;
+    };
+  };
+
+  open();
+
+  return () => {
+    source?.close();
+    source = null;
+  };
+}
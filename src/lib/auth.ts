@@ -1,4 +1,5 @@
-const AUTH_API_URL = 'https://functions.poehali.dev/feeb1c64-e0bd-49f0-85dd-f32b777141fd';
+const GATEWAY_URL = import.meta.env.VITE_GATEWAY_URL;
+const AUTH_API_URL = GATEWAY_URL ? `${GATEWAY_URL}/auth/` : 'https://functions.poehali.dev/feeb1c64-e0bd-49f0-85dd-f32b777141fd';
 
 export interface User {
   id: number;
@@ -3,7 +3,7 @@ import { useNavigate } from 'react-router-dom';
 import { Button } from '@/components/ui/button';
 import Icon from '@/components/ui/icon';
 import { authService, User } from '@/lib/auth';
-import { loansAPI, referralsAPI, cardAPI, LoanStats, ReferralStats, VirtualCard, Loan } from '@/lib/api';
+import { loansAPI, referralsAPI, cardAPI, subscribeToChanges, LoanStats, ReferralStats, VirtualCard, Loan } from '@/lib/api';
 import DashboardHeader from '@/components/dashboard/DashboardHeader';
 import LoansList from '@/components/dashboard/LoansList';
 import VirtualCardView from '@/components/dashboard/VirtualCardView';
@@ -72,6 +72,34 @@ export default function DashboardPage() {
     loadData();
   }, [user]);
 
+  // Refetch only what changed on the server, pushed by the event stream when one is configured
+  useEffect(() => {
+    if (!user) return;
+
+    return subscribeToChanges(async (resources) => {
+      try {
+        await Promise.all(resources.map(async (resource) => {
+          if (resource === 'card') {
+            const cardRes = await cardAPI.getCard();
+            if (cardRes.success) setVirtualCard(cardRes.card);
+          } else if (resource === 'loans') {
+            const [statsRes, loansRes] = await Promise.all([loansAPI.getStats(), loansAPI.getAll()]);
+            if (statsRes.success) setLoanStats(statsRes.stats);
+            if (loansRes.success) setLoans(loansRes.loans);
+          } else {
+            const refRes = await referralsAPI.getStats();
+            if (refRes.success) {
+              setReferralStats(refRes.stats);
+              setReferralCode(refRes.referral_code);
+            }
+          }
+        }));
+      } catch (error) {
+        console.error('Error refreshing data:', error);
+      }
+    });
+  }, [user]);
+
   const handleLogout = () => {
     authService.logout();
     navigate('/');